@@ -0,0 +1,161 @@
+"""
+    Artifact archives: JSON metadata plus one file per frame array, encoded or as memory-mappable .npy, loaded
+    lazily. A lighter alternative to pickling whole Artifact objects.
+"""
+
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Dict, List
+import json
+
+import cv2
+import numpy as np
+
+from artifact import Artifact
+from errors import InputError, ProcessingError
+from image import Image
+from masks import Mask
+
+OUTPUT_FORMATS = ("pickle", "archive")
+PIXEL_FORMATS = ("png", "jpg", "npy")
+
+METADATA_FILE = "artifact.json"
+
+# Fast PNG compression: archives are written on the critical path
+WRITE_PARAMS = {".png": [cv2.IMWRITE_PNG_COMPRESSION, 1], ".jpg": [cv2.IMWRITE_JPEG_QUALITY, 95]}
+
+
+def _write_array(path: Path, array: np.ndarray) -> None:
+    if path.suffix == ".npy":
+        np.save(path, array)
+    elif not cv2.imwrite(str(path), array, WRITE_PARAMS[path.suffix]):
+        raise ProcessingError(f"Cannot write {path}")
+
+
+def _read_array(path: Path, mmap: bool = True) -> np.ndarray:
+    if path.suffix == ".npy":
+        return np.load(path, mmap_mode="r" if mmap else None)
+    array = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if array is None:
+        raise InputError(f"Cannot read archived frame {path}")
+    return array
+
+
+def write_archive(artifact: Artifact, directory: Path, pixel_format: str = "png") -> None:
+    """
+    Writes an artifact to `directory`: metadata, detections and caption in
+    artifact.json, and the `image` and `original` arrays of every frame in
+    frames/, once per frame even if the frame is also the best image.
+    """
+    if pixel_format not in PIXEL_FORMATS:
+        raise ProcessingError(f"Unsupported archive pixel format: {pixel_format}")
+
+    frames_dir = directory / "frames"
+    frames_dir.mkdir(parents=True, exist_ok=True)
+
+    images = list(artifact.images)
+    best = next((i for i, image in enumerate(images) if image is artifact.best_image), None)
+    if best is None and artifact.best_image is not None:
+        images.append(artifact.best_image)
+        best = len(images) - 1
+
+    records = []
+    for i, image in enumerate(images):
+        files = {}
+        for name in ("image", "original"):
+            array = getattr(image, name)
+            if array is None:
+                continue
+            files[name] = f"frames/{i:05d}_{name}.{pixel_format}"
+            _write_array(directory / files[name], array)
+        records.append(
+            {
+                "path": str(image.path),
+                "scale": image.scale,
+                "object_detection": image.object_detection,
+                "object_segmentation": image.object_segmentation,
+                "masks": [mask.to_dict() for mask in image.masks],
+                "files": files,
+            }
+        )
+
+    metadata = {
+        "name": artifact.name,
+        "caption": artifact.caption,
+        "frame_count": artifact.frame_count or len(artifact.images),
+        "best_image": best,
+        # The best image may be stored only for being the best one
+        "images": len(artifact.images),
+        "frames": records,
+    }
+    with open(directory / METADATA_FILE, "w") as f:
+        json.dump(metadata, f)
+
+
+class LazyImageList(Sequence):
+    """
+    Read-only list of the frames of an archive, read from disk on access.
+    .npy frames are memory-mapped.
+    """
+
+    def __init__(self, directory: Path, records: List[Dict[str, Any]], mmap: bool = True):
+        self.directory = directory
+        self.records = records
+        self.mmap = mmap
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        record = self.records[index]
+        files = record["files"]
+        return Image(
+            image=_read_array(self.directory / files["image"], self.mmap),
+            original=_read_array(self.directory / files["original"], self.mmap)
+            if "original" in files
+            else None,
+            path=Path(record["path"]),
+            object_detection=record["object_detection"],
+            object_segmentation=record["object_segmentation"],
+            scale=record["scale"],
+            # Archives written before masks were decoded have none
+            masks=[Mask.from_dict(mask) for mask in record.get("masks", [])],
+        )
+
+
+def read_metadata(directory: Path) -> Dict[str, Any]:
+    path = Path(directory) / METADATA_FILE
+    if not path.is_file():
+        raise InputError(f"Not an artifact archive: {directory}")
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_archive(directory: Path, mmap: bool = True) -> Artifact:
+    """
+    Loads an artifact archive. Only the metadata and the best image are read:
+    the other frames are read when `Artifact.images` is indexed.
+    """
+    directory = Path(directory)
+    metadata = read_metadata(directory)
+    frames = LazyImageList(directory, metadata["frames"], mmap)
+    best = metadata["best_image"]
+
+    return Artifact(
+        images=LazyImageList(directory, metadata["frames"][: metadata["images"]], mmap),
+        name=metadata["name"],
+        best_image=frames[best] if best is not None else None,
+        caption=metadata["caption"],
+        frame_count=metadata["frame_count"],
+    )
+
+
+def load_archives(output_dir: Path, mmap: bool = True) -> List[Artifact]:
+    directories = sorted(
+        (path.parent for path in Path(output_dir).glob(f"artifact*/{METADATA_FILE}")),
+        key=lambda path: int(path.name[len("artifact"):]),
+    )
+    return [load_archive(directory, mmap) for directory in directories]
+
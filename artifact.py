@@ -3,11 +3,12 @@
 """
 
 from dataclasses import dataclass
-from typing import List, Any, Optional
+from typing import Iterable, List, Any, Optional
 from pathlib import Path
 from image import Image, select_best_image
+from quality import QualityScorer, RunningBest
+import logging
 import pickle
-import cv2
 
 
 @dataclass
@@ -17,21 +18,40 @@ class Artifact:
     best_image: Optional[Image] = None
     caption: Optional[str] = None
     model_3d: Optional[Any] = None
+    # Number of frames of the artifact, when `images` does not hold all of them
+    frame_count: Optional[int] = None
 
     def __post_init__(self):
-        self.best_image, best_image_path = select_best_image(
-            self.images, return_path=True
+        if self.best_image is None and self.images:
+            self.best_image, best_image_path = select_best_image(
+                self.images, return_path=True
+            )
+
+            print(f"Best image: {best_image_path}")
+
+    @classmethod
+    def from_frames(
+        cls,
+        name: str,
+        frames: Iterable[Image],
+        scorer: Optional[QualityScorer] = None,
+        keep_images: bool = False,
+    ) -> "Artifact":
+        """
+        Builds an artifact from a stream of frames, tracking the best one as
+        they arrive. Unless `keep_images` is set, only the best frame is kept.
+        """
+        running = RunningBest(scorer, keep_images=keep_images).extend(frames)
+        if running.best is not None:
+            logging.debug(f"Best image: {running.best.path}")
+
+        images = running.images if keep_images or running.best is None else [running.best]
+        return cls(
+            images=images, name=name, best_image=running.best, frame_count=running.count
         )
 
-        cv2.imwrite(
-            "output/" + self.best_image.path.stem + "_processed.jpg",
-            self.best_image.image,
-        )
-
-        print(f"Best image: {best_image_path}")
-
     def __repr__(self):
-        return f"\nArtifact(name={self.name}, images={len(self.images)}, best_image={self.best_image.path if self.best_image else None}, caption={self.caption})\n"
+        return f"\nArtifact(name={self.name}, images={self.frame_count or len(self.images)}, best_image={self.best_image.path if self.best_image else None}, caption={self.caption})\n"
 
     def to_pickle(self, saving_path: Path) -> None:
         with open(saving_path, "wb") as f:
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+    Batch mode: runs the pipeline on every dive of a manifest, in one long-lived process or a small pool of
+    processes, each sharing its clients, caches and prompts across the dives it runs (see pipeline.Services).
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+
+import click
+from dotenv import load_dotenv
+
+from errors import InputError, PipelineError
+from pipeline import SERVICE_OPTIONS, Services, create_services, main as pipeline_command, run_pipeline
+
+logger = logging.getLogger("multimodal_pipeline.batch")
+
+# Services of the current process, created once per worker
+_services: Optional[Services] = None
+
+
+@dataclass
+class Dive:
+    """
+    A run of the manifest: its name and the parameters of the pipeline
+    command, or the error that makes them invalid.
+    """
+
+    name: str
+    options: Dict[str, Any]
+    error: Optional[str] = None
+
+
+@dataclass
+class DiveResult:
+    name: str
+    input: str
+    output: str
+    status: str
+    frames: int = 0
+    artifacts: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(asdict(self), fps=self.fps)
+
+
+def option_args(values: Dict[str, Any], base_dir: Path) -> List[str]:
+    """
+    Converts manifest options, keyed by the long option names of the pipeline
+    command without dashes, to command line arguments. Paths are relative to
+    `base_dir`, the folder of the manifest.
+    """
+    params = {opt[2:]: param for param in pipeline_command.params for opt in param.opts}
+    args = []
+    for name, value in values.items():
+        param = params.get(name)
+        if param is None:
+            raise InputError(f"Unknown pipeline option: {name}")
+        if param.is_flag:
+            if value:
+                args.append(param.opts[0])
+            elif param.secondary_opts:
+                args.append(param.secondary_opts[0])
+            continue
+        for item in value if isinstance(value, list) else [value]:
+            if isinstance(item, bool):
+                item = str(item).lower()
+            elif isinstance(param.type, click.Path):
+                item = base_dir / Path(item).expanduser()
+            args += [param.opts[0], str(item)]
+    return args
+
+
+def load_manifest(path: Path, output_root: Path) -> List[Dive]:
+    """
+    Reads a manifest: a JSON object with the options of every dive in "dives",
+    and the options they share in "defaults". A dive is named by its "name",
+    or the name of its input, and is written to <output_root>/<name> unless it
+    sets its "output". Dives with invalid options are returned with their
+    error, so that they fail alone.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise InputError(f"Cannot read manifest {path}: {str(e)}")
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("dives"), list):
+        raise InputError(f"Manifest {path} must be an object with a list of dives")
+    defaults = manifest.get("defaults", {})
+
+    dives, names = [], set()
+    for index, entry in enumerate(manifest["dives"]):
+        values = dict(entry)
+        name = str(values.pop("name", None) or Path(str(values.get("input", f"dive{index}"))).stem)
+        if name in names:
+            name = f"{name}_{index}"
+        names.add(name)
+        dive = Dive(name=name, options={})
+        try:
+            # The clients and caches are shared, so their options can only be set for the whole batch
+            overridden = [
+                key for key in values
+                if key.replace("-", "_") in SERVICE_OPTIONS and values[key] != defaults.get(key)
+            ]
+            if overridden:
+                raise InputError(f"Options {', '.join(overridden)} can only be set in the defaults of the batch")
+            values = dict(defaults, **values)
+            values.setdefault("output", str((output_root / name).resolve()))
+            args = option_args(values, path.parent)
+            dive.options = pipeline_command.make_context("pipeline", args).params
+        except (PipelineError, click.ClickException) as e:
+            dive.error = e.format_message() if isinstance(e, click.ClickException) else str(e)
+        dives.append(dive)
+    return dives
+
+
+def _close_services() -> None:
+    if _services is not None:
+        _services.close()
+
+
+def _init_services(options: Dict[str, Any], profile_dir: Optional[Path] = None, worker: bool = False) -> None:
+    """
+    Creates the services of this process. The services of a worker process
+    are closed, and their profile saved to `profile_dir`, when it exits.
+    """
+    global _services
+    load_dotenv()
+    _services = create_services(options)
+    if worker:
+        if profile_dir is not None:
+            Finalize(_services, _services.save_profile, args=(profile_dir / f"worker{os.getpid()}",), exitpriority=20)
+        Finalize(_services, _close_services, exitpriority=10)
+
+
+def run_dive(dive: Dive) -> DiveResult:
+    """
+    Runs a dive with the services of this process, and logs it to
+    <output>/pipeline.log as well. Errors fail the dive, not the batch.
+    """
+    options = dive.options
+    result = DiveResult(
+        name=dive.name,
+        input=str(options["input_path"]),
+        output=str(options["output_dir"]),
+        status="completed",
+    )
+    output_dir = Path(options["output_dir"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(output_dir / "pipeline.log")
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logging.getLogger().addHandler(handler)
+
+    logger.info(f"Starting dive {dive.name} from {result.input}")
+    start = time.perf_counter()
+    try:
+        stats = run_pipeline(_services, **options)
+        result.frames, result.artifacts = stats.frames, stats.artifacts
+    except PipelineError as e:
+        result.status, result.error = "failed", str(e)
+        logger.error(f"Dive {dive.name} failed: {str(e)}")
+    except Exception as e:
+        result.status, result.error = "failed", f"{type(e).__name__}: {str(e)}"
+        logger.error(f"Dive {dive.name} failed: {traceback.format_exc()}")
+    finally:
+        result.seconds = time.perf_counter() - start
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+    if result.status == "completed":
+        logger.info(
+            f"Dive {dive.name} completed: {result.frames} frames, {result.artifacts} artifacts "
+            f"in {result.seconds:.1f}s ({result.fps:.2f} frames/s)"
+        )
+    return result
+
+
+def run_batch(dives: List[Dive], processes: int = 1, profile_dir: Optional[Path] = None) -> List[DiveResult]:
+    """
+    Runs the valid dives in this process, or on `processes` worker processes,
+    and returns the results of all the dives in manifest order.
+    """
+    results: Dict[int, DiveResult] = {}
+    valid = {}
+    for index, dive in enumerate(dives):
+        if dive.error is None:
+            valid[index] = dive
+        else:
+            logger.error(f"Dive {dive.name} skipped: {dive.error}")
+            results[index] = DiveResult(
+                name=dive.name,
+                input=str(dive.options.get("input_path", "")),
+                output=str(dive.options.get("output_dir", "")),
+                status="invalid",
+                error=dive.error,
+            )
+    if not valid:
+        return [results[index] for index in range(len(dives))]
+
+    # Valid dives agree on the service options
+    service_options = next(iter(valid.values())).options
+    if processes == 1:
+        _init_services(service_options)
+        try:
+            for index, dive in valid.items():
+                results[index] = run_dive(dive)
+        finally:
+            if profile_dir is not None:
+                _services.save_profile(profile_dir)
+            _close_services()
+    else:
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_services,
+            initargs=(service_options, profile_dir, True),
+        ) as executor:
+            futures = {executor.submit(run_dive, dive): index for index, dive in valid.items()}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died (e.g. out of memory): its dive and the pending ones fail
+                    dive = valid[index]
+                    results[index] = DiveResult(
+                        name=dive.name,
+                        input=str(dive.options["input_path"]),
+                        output=str(dive.options["output_dir"]),
+                        status="failed",
+                        error=f"Worker process died: {str(e)}",
+                    )
+                    logger.error(f"Dive {dive.name} failed: worker process died")
+    return [results[index] for index in range(len(dives))]
+
+
+def write_report(results: List[DiveResult], path: Path, wall: float, processes: int) -> Dict[str, Any]:
+    frames = sum(result.frames for result in results)
+    report = {
+        "processes": processes,
+        "wall_seconds": wall,
+        "dives": len(results),
+        "completed": sum(result.status == "completed" for result in results),
+        "failed": sum(result.status != "completed" for result in results),
+        "frames": frames,
+        "artifacts": sum(result.artifacts for result in results),
+        "fps": frames / wall if wall else 0.0,
+        "results": [result.to_dict() for result in results],
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+@click.command()
+@click.option(
+    "--manifest",
+    "manifest_path",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON manifest of the dives, with their pipeline options and shared defaults",
+)
+@click.option(
+    "--output",
+    "output_root",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="Output directory of the batch report, and of the dives without an output",
+)
+@click.option(
+    "--processes",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of worker processes; 1 runs the dives one after another in this process",
+)
+def main(manifest_path: str, output_root: str, processes: int) -> None:
+    output_root = Path(output_root)
+    try:
+        dives = load_manifest(Path(manifest_path), output_root)
+    except PipelineError as e:
+        logger.error(f"Batch error: {str(e)}")
+        sys.exit(1)
+
+    profile = any(dive.options.get("profile") for dive in dives)
+    logger.info(f"Starting batch of {len(dives)} dives on {processes} process(es)")
+    start = time.perf_counter()
+    results = run_batch(dives, processes, profile_dir=output_root / "profile" if profile else None)
+    report = write_report(results, output_root / "batch_report.json", time.perf_counter() - start, processes)
+
+    for result in results:
+        status = result.status if result.error is None else f"{result.status} ({result.error})"
+        logger.info(
+            f"  {result.name}: {status}, {result.frames} frames, {result.artifacts} artifacts, "
+            f"{result.seconds:.1f}s"
+        )
+    logger.info(
+        f"Batch completed: {report['completed']}/{report['dives']} dives, {report['frames']} frames and "
+        f"{report['artifacts']} artifacts in {report['wall_seconds']:.1f}s ({report['fps']:.2f} frames/s)"
+    )
+    if report["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Baselines of the benchmarks
+
+Measurements are compared with the values stored in baselines.json: a measurement regresses when it is worse
+than its baseline by more than the threshold ratio of its metric, or the default threshold. Baselines are
+specific to the machine they were measured on; refresh them with --update-baselines after a deliberate
+change, or on a new machine.
+"""
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+BASELINES_PATH = Path(__file__).resolve().parent / "baselines.json"
+DEFAULT_THRESHOLD = 1.25
+
+
+@dataclass
+class Measurement:
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"value": self.value, "unit": self.unit, "higher_is_better": self.higher_is_better}
+
+
+def load_baselines(path: Path = BASELINES_PATH) -> Dict[str, Any]:
+    if not path.is_file():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_baselines(suite: str, measurements: List[Measurement], path: Path = BASELINES_PATH) -> None:
+    # Per-metric thresholds of the previous baselines are kept
+    baselines = load_baselines(path)
+    previous = baselines.get(suite, {})
+    entries = {}
+    for measurement in measurements:
+        entry = measurement.to_dict()
+        if "threshold" in previous.get(measurement.name, {}):
+            entry["threshold"] = previous[measurement.name]["threshold"]
+        entries[measurement.name] = entry
+    baselines[suite] = entries
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent=2)
+        f.write("\n")
+    print(f"Updated the {suite} baselines in {path}")
+
+
+def compare(
+    suite: str,
+    measurements: List[Measurement],
+    path: Path = BASELINES_PATH,
+    threshold: Optional[float] = None,
+) -> List[str]:
+    """
+    Prints the measurements next to their baselines and returns the names of
+    the regressed ones. `threshold` overrides every stored threshold.
+    """
+    baselines = load_baselines(path)
+    default = baselines.get("default_threshold", DEFAULT_THRESHOLD)
+    stored = baselines.get(suite, {})
+
+    regressions = []
+    print(f"{'benchmark':<32} {'value':>12} {'baseline':>12} {'ratio':>7}  unit")
+    for measurement in measurements:
+        baseline = stored.get(measurement.name)
+        if baseline is None or not baseline["value"]:
+            print(f"{measurement.name:<32} {measurement.value:>12.2f} {'-':>12} {'-':>7}  {measurement.unit}")
+            continue
+
+        # Ratios above 1 are always worse than the baseline
+        ratio = measurement.value / baseline["value"]
+        if measurement.higher_is_better:
+            ratio = 1 / ratio if ratio else float("inf")
+        limit = threshold or baseline.get("threshold", default)
+        status = ""
+        if ratio > limit:
+            status = f"  REGRESSION (threshold {limit:.2f})"
+            regressions.append(measurement.name)
+        print(
+            f"{measurement.name:<32} {measurement.value:>12.2f} {baseline['value']:>12.2f} "
+            f"{ratio:>7.2f}  {measurement.unit}{status}"
+        )
+    return regressions
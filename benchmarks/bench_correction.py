@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Correction benchmark
+
+Times fused_underwater_correction against the reference simple_underwater_correction
+and checks that the fused kernel stays within its documented tolerance.
+Exits with status 1 if the tolerance is exceeded.
+"""
+
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import click
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from preprocessing2 import (  # noqa: E402
+    simple_underwater_correction,
+    fused_underwater_correction,
+    FUSED_MAX_ABS_ERROR,
+    FUSED_MEAN_ABS_ERROR,
+)
+
+DEFAULT_INPUT = (
+    Path(__file__).resolve().parent.parent / "example_images" / "Main (1982)" / "baseline"
+)
+
+
+def load_images(input_dir: Path, limit: int, size: int) -> List[np.ndarray]:
+    paths = sorted(
+        p for p in input_dir.iterdir() if p.suffix.lower() in {".jpg", ".jpeg", ".png"}
+    )[:limit]
+    images = [cv2.imread(str(p)) for p in paths]
+    images = [img for img in images if img is not None]
+    if size:
+        images = [cv2.resize(img, (size, size * img.shape[0] // img.shape[1])) for img in images]
+    return images
+
+
+def time_correction(correction, images: List[np.ndarray], repeat: int) -> float:
+    correction(images[0])  # Warm-up: allocates the workspace of the fused kernel
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for img in images:
+            correction(img)
+    return (time.perf_counter() - start) / (repeat * len(images))
+
+
+@click.command()
+@click.option("--input", "input_dir", default=str(DEFAULT_INPUT), type=click.Path(exists=True))
+@click.option("--limit", default=10, type=int, help="Number of images to use")
+@click.option("--size", default=0, type=int, help="Resize the images to this width, 0 to keep them")
+@click.option("--repeat", default=3, type=int, help="Timed passes over the images")
+def main(input_dir: str, limit: int, size: int, repeat: int) -> None:
+    images = load_images(Path(input_dir), limit, size)
+    if not images:
+        raise click.ClickException(f"No images found in {input_dir}")
+
+    max_error, mean_error = 0, 0.0
+    for img in images:
+        diff = np.abs(
+            simple_underwater_correction(img).astype(np.int16)
+            - fused_underwater_correction(img).astype(np.int16)
+        )
+        max_error = max(max_error, int(diff.max()))
+        mean_error = max(mean_error, float(diff.mean()))
+
+    reference = time_correction(simple_underwater_correction, images, repeat)
+    fused = time_correction(fused_underwater_correction, images, repeat)
+
+    h, w = images[0].shape[:2]
+    print(f"{len(images)} images, {w}x{h}")
+    print(f"reference: {reference * 1000:.1f} ms/frame")
+    print(f"fused:     {fused * 1000:.1f} ms/frame ({reference / fused:.2f}x)")
+    print(
+        f"max abs error {max_error} (tolerance {FUSED_MAX_ABS_ERROR}), "
+        f"mean abs error {mean_error:.3f} (tolerance {FUSED_MEAN_ABS_ERROR})"
+    )
+
+    if max_error > FUSED_MAX_ABS_ERROR or mean_error > FUSED_MEAN_ABS_ERROR:
+        print("FAILED: fused correction outside of tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark
+
+Runs the whole pipeline on a synthetic sequence (see synthetic.py), with the remote services replaced by the
+local fakes of fakes.py and their latency simulated, and reports the throughput in frames per second and the
+peak memory of every configuration. Each configuration runs in its own process, so that peak RSS is its own,
+with --profile, and the stage times of its profile are reported as well. With --check, exits with status 1 if
+a configuration regressed beyond the thresholds of baselines.json.
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from baselines import Measurement, compare, update_baselines  # noqa: E402
+from synthetic import parse_size, write_sequence  # noqa: E402
+
+SUITE = "pipeline"
+PROMPTS = ROOT / "prompts_main_1982"
+
+# Pipeline options of every configuration
+CONFIGS = {
+    "batch": [],
+    "streaming": ["--streaming"],
+    "proxy": ["--streaming", "--proxy-size", "640", "--decode-reduction", "auto"],
+    "concurrent": ["--streaming", "--detection-concurrency", "4", "--detection-batch-size", "2"],
+    "pipelined": ["--pipelined", "--detection-concurrency", "4", "--detection-batch-size", "2"],
+}
+
+
+def run_child(spec: Dict[str, Any]) -> None:
+    """
+    Runs one configuration in this process, with the fakes patched in, and
+    writes its measurements to spec["result"].
+    """
+    import logging
+
+    from fakes import FakeOpenAI, FakeWorkflowClient
+
+    import pipeline
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def workflow_client(**kwargs):
+        return FakeWorkflowClient(spec["detection_latency"], spec["jitter"])
+
+    pipeline.InferenceHTTPClient = workflow_client
+    pipeline.PooledWorkflowClient = workflow_client
+    pipeline.create_captioning_client = lambda: FakeOpenAI(spec["caption_latency"], spec["jitter"])
+
+    output_dir = Path(spec["output"])
+    args = [
+        "--input", spec["input"],
+        "--prompt", str(PROMPTS),
+        "--output", str(output_dir),
+        "--profile",
+    ] + spec["options"]
+
+    start = time.perf_counter()
+    pipeline.main.main(args, standalone_mode=False)
+    wall = time.perf_counter() - start
+
+    with open(output_dir / "profile.json") as f:
+        profile = json.load(f)
+    result = {
+        "wall_s": wall,
+        "fps": spec["frames"] / wall,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        "stages": {name: stage["self_wall_s"] for name, stage in profile["stages"].items()},
+    }
+    with open(spec["result"], "w") as f:
+        json.dump(result, f)
+
+
+def run_config(name: str, spec: Dict[str, Any], tmp: Path) -> Dict[str, Any]:
+    spec = dict(spec, options=CONFIGS[name], output=str(tmp / name), result=str(tmp / f"{name}.json"))
+    process = subprocess.run(
+        [sys.executable, __file__, "--child", json.dumps(spec)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if process.returncode != 0 or not Path(spec["result"]).is_file():
+        raise click.ClickException(f"Configuration {name} failed:\n{process.stderr[-2000:]}")
+    with open(spec["result"]) as f:
+        return json.load(f)
+
+
+@click.command()
+@click.option("--frames", default=48, type=click.IntRange(min=1), help="Number of synthetic frames")
+@click.option("--size", default="1280x720", help="Frame size, WIDTHxHEIGHT")
+@click.option(
+    "--config",
+    "configs",
+    multiple=True,
+    type=click.Choice(list(CONFIGS)),
+    help="Configurations to run, all by default",
+)
+@click.option("--detection-latency", default=0.05, type=float, help="Seconds per image of the fake workflow")
+@click.option("--caption-latency", default=0.3, type=float, help="Seconds per request of the fake captioning")
+@click.option("--jitter", default=0.0, type=float, help="Mean extra delay of a fake request, in seconds")
+@click.option("--json", "json_path", default=None, type=click.Path(), help="Also write the results to this file")
+@click.option("--check/--no-check", default=False, help="Exit with status 1 on a regression")
+@click.option("--threshold", default=None, type=float, help="Regression ratio, overrides baselines.json")
+@click.option("--update-baselines", "update", is_flag=True, help="Store the measurements as the new baselines")
+@click.option("--child", default=None, hidden=True)
+def main(
+    frames: int,
+    size: str,
+    configs: List[str],
+    detection_latency: float,
+    caption_latency: float,
+    jitter: float,
+    json_path: str,
+    check: bool,
+    threshold: float,
+    update: bool,
+    child: str,
+) -> None:
+    if child is not None:
+        run_child(json.loads(child))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_sequence(tmp / "input", frames, parse_size(size))
+        spec = {
+            "input": str(tmp / "input"),
+            "frames": frames,
+            "detection_latency": detection_latency,
+            "caption_latency": caption_latency,
+            "jitter": jitter,
+        }
+        for name in configs or CONFIGS:
+            results[name] = run_config(name, spec, tmp)
+            stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in results[name]["stages"].items())
+            print(f"  {name}: {results[name]['fps']:.2f} frames/s ({stages})", file=sys.stderr)
+
+    measurements = []
+    for name, result in results.items():
+        measurements.append(Measurement(f"{name}.fps", result["fps"], "frames/s", higher_is_better=True))
+        measurements.append(Measurement(f"{name}.peak_rss_mb", result["peak_rss_mb"], "MB"))
+
+    print(
+        f"{frames} frames, {size}, detection latency {detection_latency}s/image, "
+        f"caption latency {caption_latency}s"
+    )
+    regressions = compare(SUITE, measurements, threshold=threshold)
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+    if update:
+        update_baselines(SUITE, measurements)
+    elif check and regressions:
+        print(f"FAILED: {len(regressions)} measurements regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
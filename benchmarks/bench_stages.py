@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Stage micro-benchmarks
+
+Times every stage of the pipeline on its own, on synthetic frames (see synthetic.py) and with the local fakes
+of the remote services (see fakes.py): decoding, correction, PSNR, quality scoring, deduplication, upload
+encoding, detection parsing, frame selection and saving. Each stage is timed as the best of --repeat passes
+and reported per frame. With --check, exits with status 1 if a stage regressed beyond the
+thresholds of baselines.json.
+"""
+
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from baselines import Measurement, compare, update_baselines  # noqa: E402
+from fakes import FakeWorkflowClient  # noqa: E402
+from synthetic import generate_frames, parse_size, write_sequence  # noqa: E402
+
+from dedup import dhash  # noqa: E402
+from encoding import PayloadEncoder  # noqa: E402
+from image import Image, compute_psnr  # noqa: E402
+from loader import FrameLoader  # noqa: E402
+from preprocessing2 import (  # noqa: E402
+    TemporalCorrector,
+    apply_temporal_correction,
+    fused_underwater_correction,
+    simple_underwater_correction,
+)
+from processing import detect_and_segment_batch, frame_selection  # noqa: E402
+from quality import QualityScorer  # noqa: E402
+from utility import save_artifact  # noqa: E402
+
+SUITE = "stages"
+
+
+def best_of(repeat: int, run: Callable[[], None]) -> float:
+    # Fastest of `repeat` passes, the least disturbed by the rest of the machine
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmarks(frames: int, size: str, repeat: int) -> List[Measurement]:
+    measurements = []
+
+    def record(name: str, seconds: float, count: int) -> None:
+        measurements.append(Measurement(name, seconds / count * 1000, "ms/frame"))
+        print(f"  {name}: {seconds / count * 1000:.2f} ms/frame", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_sequence(tmp / "frames", frames, parse_size(size))
+        raw = list(generate_frames(frames, parse_size(size)))
+
+        record("decode", best_of(repeat, lambda: list(FrameLoader(tmp / "frames", workers=1))), frames)
+        record(
+            "decode_reduced_4",
+            best_of(repeat, lambda: list(FrameLoader(tmp / "frames", workers=1, reduction=4))),
+            frames,
+        )
+
+        for name, correction in (
+            ("correction_fused", fused_underwater_correction),
+            ("correction_reference", simple_underwater_correction),
+        ):
+            correction(raw[0])  # Warm-up: allocates the workspace of the fused kernel
+            record(name, best_of(repeat, lambda: [correction(frame) for frame in raw]), frames)
+
+        def temporal_pass() -> None:
+            # A new sequence every pass, estimated as the pipeline does
+            corrector = TemporalCorrector()
+            for frame in raw:
+                apply_temporal_correction(frame, corrector.estimate(frame))
+
+        record("correction_temporal", best_of(repeat, temporal_pass), frames)
+
+        corrected = [fused_underwater_correction(frame) for frame in raw]
+        images = [
+            Image(image=image, original=frame, path=Path(f"frame_{i:05d}.jpg"))
+            for i, (image, frame) in enumerate(zip(corrected, raw))
+        ]
+
+        record(
+            "psnr",
+            best_of(repeat, lambda: [compute_psnr(frame, image) for frame, image in zip(raw, corrected)]),
+            frames,
+        )
+        scorer = QualityScorer({"psnr": 1.0, "sharpness": 1.0, "exposure": 1.0})
+        record("quality_score", best_of(repeat, lambda: scorer.score(images)), frames)
+        record("dedup_dhash", best_of(repeat, lambda: [dhash(image) for image in corrected]), frames)
+
+        encoder = PayloadEncoder(max_dimension=1024)
+        record("encode_upload", best_of(repeat, lambda: [encoder.encode(image) for image in corrected]), frames)
+
+        # The fake detector runs in the same process: this is the cost of the
+        # client side (encoding, result parsing, rescaling) plus the fake itself
+        client = FakeWorkflowClient()
+        record(
+            "detect_fake",
+            best_of(
+                repeat,
+                lambda: [detect_and_segment_batch(client, [image], "", encoder=encoder) for image in images],
+            ),
+            frames,
+        )
+
+        record("select", best_of(repeat, lambda: frame_selection(images)), frames)
+
+        artifacts = frame_selection(images)
+        saved_frames = sum(len(artifact.images) for artifact in artifacts)
+        for output_format in ("pickle", "archive"):
+            output_dir = tmp / output_format
+
+            def save():
+                for index, artifact in enumerate(artifacts):
+                    save_artifact(artifact, output_dir, index, output_format=output_format)
+
+            record(f"save_{output_format}", best_of(repeat, save), saved_frames)
+
+    return measurements
+
+
+@click.command()
+@click.option("--frames", default=16, type=click.IntRange(min=2), help="Number of synthetic frames")
+@click.option("--size", default="1280x720", help="Frame size, WIDTHxHEIGHT")
+@click.option("--repeat", default=3, type=click.IntRange(min=1), help="Timed passes, the fastest is kept")
+@click.option("--json", "json_path", default=None, type=click.Path(), help="Also write the measurements to this file")
+@click.option("--check/--no-check", default=False, help="Exit with status 1 on a regression")
+@click.option("--threshold", default=None, type=float, help="Regression ratio, overrides baselines.json")
+@click.option("--update-baselines", "update", is_flag=True, help="Store the measurements as the new baselines")
+def main(
+    frames: int,
+    size: str,
+    repeat: int,
+    json_path: str,
+    check: bool,
+    threshold: float,
+    update: bool,
+) -> None:
+    measurements = run_benchmarks(frames, size, repeat)
+    print(f"{frames} frames, {size}, best of {repeat}")
+    regressions = compare(SUITE, measurements, threshold=threshold)
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({m.name: m.to_dict() for m in measurements}, f, indent=2)
+    if update:
+        update_baselines(SUITE, measurements)
+    elif check and regressions:
+        print(f"FAILED: {len(regressions)} stages regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
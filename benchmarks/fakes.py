@@ -0,0 +1,184 @@
+"""
+Local stand-ins for the remote services
+
+FakeWorkflowClient replaces InferenceHTTPClient.run_workflow and FakeOpenAI the OpenAI Responses API, with a
+configurable latency, so that the pipeline can be benchmarked offline. Their outputs are deterministic: the
+workflow finds the rust-colored objects of the synthetic frames (see synthetic.py) and labels them by shape, and the
+captions are derived from a hash of the uploaded image.
+"""
+
+import base64
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Any, Dict, List, Union
+
+import cv2
+import numpy as np
+
+# Longest side of the image the fake detector runs on
+DETECTION_SIZE = 320
+# Smallest object, as a fraction of the image area
+MIN_AREA = 0.002
+# Smallest difference of the b* (blue-yellow) channel between an object and the water
+MIN_CONTRAST = 15
+
+
+def decode_payload(image: Union[np.ndarray, str]) -> np.ndarray:
+    # Workflow inputs are arrays, or base64 uploads from encoding.PayloadEncoder
+    if isinstance(image, np.ndarray):
+        return image
+    if image.startswith("data:"):
+        image = image.partition(",")[2]
+    decoded = cv2.imdecode(np.frombuffer(base64.b64decode(image), np.uint8), cv2.IMREAD_COLOR)
+    if decoded is None:
+        raise ValueError("Cannot decode the uploaded image")
+    return decoded
+
+
+def label_for(width: float, height: float) -> str:
+    aspect = width / max(height, 1.0)
+    if aspect > 1.8:
+        return "cannon"
+    if aspect < 0.7:
+        return "anchor"
+    return "amphora"
+
+
+def detect_objects(image: np.ndarray) -> Dict[str, Any]:
+    """
+    Finds the objects yellower than the water on the b* channel, which the
+    seabed texture and the correction of the frames barely change, and
+    returns them in the format of the Roboflow workflow outputs: boxes in
+    `model.parsed_output` and polygons in `model_1.predictions`, in the
+    coordinates of `image`.
+    """
+    h, w = image.shape[:2]
+    factor = max(1, int(np.ceil(max(h, w) / DETECTION_SIZE)))
+    small = cv2.resize(image, (w // factor, h // factor), interpolation=cv2.INTER_AREA)
+    yellowness = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2LAB)[..., 2], (5, 5), 0)
+    threshold, _ = cv2.threshold(yellowness, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    threshold = max(threshold, float(np.median(yellowness)) + MIN_CONTRAST)
+    _, mask = cv2.threshold(yellowness, threshold, 255, cv2.THRESH_BINARY)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8))
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = MIN_AREA * small.shape[0] * small.shape[1]
+    bboxes: List[List[float]] = []
+    labels: List[str] = []
+    predictions = []
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True):
+        if cv2.contourArea(contour) < min_area:
+            break
+        x, y, bw, bh = cv2.boundingRect(contour)
+        label = label_for(bw, bh)
+        box = [float(x * factor), float(y * factor), float((x + bw) * factor), float((y + bh) * factor)]
+        polygon = cv2.approxPolyDP(contour, 2.0, True).reshape(-1, 2) * factor
+        bboxes.append(box)
+        labels.append(label)
+        predictions.append(
+            {
+                "x": (box[0] + box[2]) / 2,
+                "y": (box[1] + box[3]) / 2,
+                "width": box[2] - box[0],
+                "height": box[3] - box[1],
+                "class": label,
+                "confidence": 0.9,
+                "points": [{"x": float(px), "y": float(py)} for px, py in polygon],
+            }
+        )
+    return {
+        "model": {"parsed_output": {"bboxes": bboxes, "labels": labels}},
+        "model_1": {"predictions": predictions},
+    }
+
+
+class _Latency:
+    """
+    Base latency plus a deterministic jitter drawn from the payload hash, in
+    seconds. Sleeping releases the GIL, as waiting on a socket would.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+
+    def wait(self, key: int, items: int = 1) -> None:
+        if not self.latency and not self.jitter:
+            return
+        noise = np.random.default_rng(key).exponential(self.jitter) if self.jitter else 0.0
+        time.sleep(self.latency * items + noise)
+
+
+class FakeWorkflowClient:
+    """
+    Stand-in for InferenceHTTPClient: `run_workflow` detects the objects of
+    every input image after `latency` seconds per image.
+
+    Args:
+        latency (float): Seconds per image.
+        jitter (float): Mean of the exponential extra delay of a request, in seconds.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, **kwargs):
+        self._latency = _Latency(latency, jitter)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.images = 0
+
+    def run_workflow(
+        self,
+        workspace_name: str = "",
+        workflow_id: str = "",
+        images: Dict[str, Any] = None,
+        parameters: Dict[str, Any] = None,
+        **kwargs,
+    ) -> List[Dict[str, Any]]:
+        inputs = images["input_image"]
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        frames = [decode_payload(image) for image in inputs]
+        with self._lock:
+            self.calls += 1
+            self.images += len(frames)
+        self._latency.wait(zlib.crc32(frames[0][::16, ::16].tobytes()), len(frames))
+        return [detect_objects(frame) for frame in frames]
+
+    def close(self) -> None:
+        pass
+
+
+class FakeOpenAI:
+    """
+    Stand-in for the OpenAI client: `responses.create` answers after
+    `latency` seconds with a caption derived from the uploaded image.
+
+    Args:
+        latency (float): Seconds per request.
+        jitter (float): Mean of the exponential extra delay of a request, in seconds.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, **kwargs):
+        self._latency = _Latency(latency, jitter)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.responses = SimpleNamespace(create=self._create)
+
+    def _create(self, model: str = "", input: List[Dict[str, Any]] = None, **kwargs) -> SimpleNamespace:
+        image_url = next(
+            part["image_url"]
+            for message in input
+            for part in message["content"]
+            if part["type"] == "input_image"
+        )
+        key = zlib.crc32(image_url.encode())
+        with self._lock:
+            self.calls += 1
+        self._latency.wait(key)
+        text = (
+            f'{{"caption": "Synthetic artifact {key:08x}", "model": "{model}", '
+            f'"upload_bytes": {len(image_url)}}}'
+        )
+        content = SimpleNamespace(type="output_text", text=text)
+        return SimpleNamespace(output=[SimpleNamespace(content=[content])], output_text=text)
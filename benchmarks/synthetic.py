@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Synthetic underwater footage
+
+Renders sequences of frames that look enough like the real footage for the benchmarks: a blue-green water
+gradient with haze, red attenuation, marine snow and sensor noise, and a few light objects (anchor, cannon,
+amphora) drifting across the view. The objects are rust-colored and have distinct shapes, so the fake
+workflow of fakes.py can detect and label them from the pixels alone. Everything is derived from a seed.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import click
+import cv2
+import numpy as np
+
+# Label, width / height of the object
+OBJECTS = (("anchor", 0.45), ("cannon", 3.0), ("amphora", 1.0))
+
+WATER_TOP = np.array([120, 110, 40], dtype=np.float32)  # BGR
+WATER_BOTTOM = np.array([60, 70, 15], dtype=np.float32)
+
+
+@dataclass
+class SceneObject:
+    label: str
+    center: Tuple[float, float]  # Relative to the frame size
+    height: float  # Relative to the frame height
+    aspect: float
+    color: Tuple[int, int, int]
+    velocity: Tuple[float, float]  # Relative to the frame size, per frame
+
+    def bbox(self, size: Tuple[int, int], t: int) -> Tuple[int, int, int, int]:
+        w, h = size
+        cx = (self.center[0] + self.velocity[0] * t) * w
+        cy = (self.center[1] + self.velocity[1] * t) * h
+        half_h = self.height * h / 2
+        half_w = half_h * self.aspect
+        return int(cx - half_w), int(cy - half_h), int(cx + half_w), int(cy + half_h)
+
+
+def make_scene(rng: np.random.Generator, objects: int = 2) -> List[SceneObject]:
+    scene = []
+    for i in range(objects):
+        label, aspect = OBJECTS[(i + int(rng.integers(len(OBJECTS)))) % len(OBJECTS)]
+        scene.append(
+            SceneObject(
+                label=label,
+                center=(float(rng.uniform(0.25, 0.75)), float(rng.uniform(0.3, 0.7))),
+                height=float(rng.uniform(0.15, 0.3)) / max(1.0, aspect / 2),
+                aspect=aspect,
+                # Rust and ochre, BGR
+                color=(int(rng.integers(40, 90)), int(rng.integers(90, 150)), int(rng.integers(170, 230))),
+                velocity=(float(rng.uniform(-0.004, 0.004)), float(rng.uniform(-0.002, 0.002))),
+            )
+        )
+    return scene
+
+
+def make_background(rng: np.random.Generator, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Water gradient over a seabed of low-frequency texture, in the lower half.
+    """
+    w, h = size
+    depth = np.linspace(0.0, 1.0, h, dtype=np.float32)[:, None, None]
+    background = WATER_TOP * (1 - depth) + WATER_BOTTOM * depth
+    texture = rng.uniform(-1.0, 1.0, size=(max(1, h // 24), max(1, w // 24))).astype(np.float32)
+    texture = cv2.resize(texture, (w, h), interpolation=cv2.INTER_CUBIC)[..., None]
+    seabed = np.clip(depth * 2 - 1, 0, 1)
+    return np.broadcast_to(background + 18.0 * texture * seabed, (h, w, 3)).astype(np.float32)
+
+
+def render_frame(
+    scene: List[SceneObject],
+    size: Tuple[int, int],
+    t: int,
+    rng: np.random.Generator,
+    background: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Renders frame `t` of a scene at `size` (width, height), as a BGR uint8 image.
+    """
+    w, h = size
+    frame = (background if background is not None else make_background(rng, size)).copy()
+
+    for obj in scene:
+        x1, y1, x2, y2 = obj.bbox(size, t)
+        center = ((x1 + x2) // 2, (y1 + y2) // 2)
+        axes = (max(1, (x2 - x1) // 2), max(1, (y2 - y1) // 2))
+        if obj.label == "amphora":
+            cv2.ellipse(frame, center, axes, 0, 0, 360, obj.color, -1)
+        else:
+            cv2.rectangle(frame, (x1, y1), (x2, y2), obj.color, -1)
+
+    # Red is absorbed first, and scattering veils everything with the water color
+    frame[..., 2] *= 0.55
+    depth = np.linspace(0.0, 1.0, h, dtype=np.float32)[:, None, None]
+    haze = 0.25 + 0.1 * depth
+    frame = frame * (1 - haze) + WATER_TOP * haze
+
+    # Marine snow
+    count = w * h // 4000
+    xs, ys = rng.integers(0, w, count), rng.integers(0, h, count)
+    frame[ys, xs] = 230
+
+    frame += rng.normal(0.0, 4.0, size=(h, w, 1)).astype(np.float32)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def generate_frames(
+    count: int, size: Tuple[int, int] = (1280, 720), seed: int = 0, cut_every: int = 24
+) -> Iterator[np.ndarray]:
+    """
+    Yields `count` frames; a new scene starts every `cut_every` frames, so
+    that the sequence holds several artifacts.
+    """
+    rng = np.random.default_rng(seed)
+    scene, background = None, None
+    for t in range(count):
+        if t % cut_every == 0:
+            scene = make_scene(rng, objects=1 + (t // cut_every) % 2)
+            background = make_background(rng, size)
+        yield render_frame(scene, size, t % cut_every, rng, background)
+
+
+def write_sequence(
+    output_dir: Path, count: int, size: Tuple[int, int] = (1280, 720), seed: int = 0, quality: int = 90
+) -> List[Path]:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for t, frame in enumerate(generate_frames(count, size, seed)):
+        path = output_dir / f"frame_{t:05d}.jpg"
+        cv2.imwrite(str(path), frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        paths.append(path)
+    return paths
+
+
+def write_video(
+    path: Path, count: int, size: Tuple[int, int] = (1280, 720), seed: int = 0, fps: float = 24.0
+) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), fps, size)
+    if not writer.isOpened():
+        raise RuntimeError(f"Cannot write video {path}")
+    try:
+        for frame in generate_frames(count, size, seed):
+            writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+def parse_size(value: str) -> Tuple[int, int]:
+    w, _, h = value.lower().partition("x")
+    return int(w), int(h)
+
+
+@click.command()
+@click.option("--output", "output", required=True, type=click.Path(), help="Folder of the frames, or path of the video")
+@click.option("--frames", default=96, type=click.IntRange(min=1))
+@click.option("--size", default="1280x720", help="Frame size, WIDTHxHEIGHT")
+@click.option("--seed", default=0, type=int)
+@click.option("--video/--images", default=False, help="Write an MJPG .avi instead of JPEG frames")
+def main(output: str, frames: int, size: str, seed: int, video: bool) -> None:
+    if video:
+        write_video(Path(output), frames, parse_size(size), seed)
+    else:
+        write_sequence(Path(output), frames, parse_size(size), seed)
+    print(f"Wrote {frames} frames to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+    ResultCache is a persistent, size-bounded LRU cache of JSON results, used to avoid repeating remote calls across runs.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Any, Optional
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+from errors import ProcessingError
+
+# Seconds a connection waits for the lock of a cache file held by another process
+BUSY_TIMEOUT = 30.0
+
+# Entries evicted per query of the least recently used ones
+EVICT_BATCH = 64
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    # Lookups and writes given up on because the file stayed locked
+    errors: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate), "
+            f"{self.evictions} evictions, {self.errors} errors"
+        )
+
+
+def hash_key(*parts: Any) -> str:
+    """
+    Content hash of the given parts: arrays contribute their shape, dtype and
+    pixels, everything else its string representation.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(f"{part.shape}{part.dtype}".encode())
+            digest.update(np.ascontiguousarray(part).data)
+        else:
+            digest.update(str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot cache a value of type {type(value)}")
+
+
+class ResultCache:
+    """
+    Stores JSON-serializable values in a SQLite file, zlib-compressed, under
+    string keys. When the stored size exceeds `max_bytes` the least recently
+    used entries are evicted. Safe to share between threads, and between the
+    processes of a batch opening the same file: the stored size is kept in
+    the file and updated in the transaction of every write, and a file that stays locked
+    makes a lookup miss or a write be skipped rather than fail the run.
+
+    Args:
+        path (Path): SQLite file of the cache, created if missing.
+        max_bytes (int): Maximum size of the stored values.
+        namespace (str): Prefix isolating the keys of different kinds of results.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 512 * 2**20, namespace: str = ""):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.stats = CacheStats()
+        self._lock = Lock()
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Transactions are opened explicitly, see put
+            self._db = sqlite3.connect(
+                str(self.path), timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}")
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+            )
+            # Single row holding the stored size, summed once for files written before it existed
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)"
+            )
+            self._db.execute(
+                "INSERT OR IGNORE INTO usage (id, size) SELECT 0, COALESCE(SUM(size), 0) FROM entries"
+            )
+        except sqlite3.Error as e:
+            raise ProcessingError(f"Cannot open cache {self.path}: {str(e)}")
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT value FROM entries WHERE key = ?", (self._key(key),)
+                ).fetchone()
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Cache {self.path} lookup failed: {str(e)}")
+                self.stats.errors += 1
+                row = None
+            if row is None:
+                self.stats.misses += 1
+                return None
+            try:
+                self._db.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?",
+                    (time.time(), self._key(key)),
+                )
+            except sqlite3.OperationalError as e:
+                # Only the eviction order is lost
+                logging.warning(f"Cache {self.path} access time not updated: {str(e)}")
+                self.stats.errors += 1
+            self.stats.hits += 1
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: str, value: Any) -> None:
+        blob = zlib.compress(json.dumps(value, default=_to_json).encode("utf-8"))
+        with self._lock:
+            try:
+                # Takes the write lock of the file up front, so that the stored size holds until the commit
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    replaced = self._db.execute(
+                        "SELECT size FROM entries WHERE key = ?", (self._key(key),)
+                    ).fetchone()
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                        (self._key(key), blob, len(blob), time.time()),
+                    )
+                    self._db.execute(
+                        "UPDATE usage SET size = size + ? WHERE id = 0",
+                        (len(blob) - (replaced[0] if replaced else 0),),
+                    )
+                    self._evict()
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+            except sqlite3.OperationalError as e:
+                # The result is not cached, it will be fetched again next time
+                logging.warning(f"Cache {self.path} write failed: {str(e)}")
+                self.stats.errors += 1
+
+    def _evict(self) -> None:
+        # Other processes may write to the same file, so the size is that of the file, not of this cache's writes
+        size = self._db.execute("SELECT size FROM usage WHERE id = 0").fetchone()[0]
+        evicted = 0
+        while size > self.max_bytes:
+            # Walks the index on the access time, only as far as the entries evicted
+            entries = self._db.execute(
+                "SELECT key, size FROM entries ORDER BY accessed LIMIT ?", (EVICT_BATCH,)
+            ).fetchall()
+            if not entries:
+                break
+            for key, entry_size in entries:
+                if size <= self.max_bytes:
+                    break
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                size -= entry_size
+                evicted += entry_size
+                self.stats.evictions += 1
+
+        if evicted:
+            self._db.execute("UPDATE usage SET size = size - ? WHERE id = 0", (evicted,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+        logging.info(f"Cache {self.path} ({self.namespace}): {self.stats}")
@@ -0,0 +1,206 @@
+"""
+    CaptioningEngine captions artifacts with an LMM through the OpenAI Responses API, concurrently, rate-limited and cached.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Iterable, Iterator, List, Optional
+import logging
+import os
+import random
+import time
+
+from openai import OpenAI, APIStatusError, APIConnectionError, RateLimitError
+from openai.types.responses.response import Response
+
+from artifact import Artifact
+from cache import ResultCache, hash_key
+from encoding import PayloadEncoder
+from errors import CaptioningError, ProcessingError
+
+DEFAULT_MODEL = "gpt-4.1-nano"
+
+
+def create_captioning_client() -> OpenAI:
+    # OPENAI_BASE_URL, if set, points the client to another Responses endpoint (e.g. a local fake)
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+
+class RateLimiter:
+    """
+    Spaces out the requests so that at most `requests_per_minute` start in any
+    minute, and lets a 429 response pause every thread for its retry-after delay.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next = 0.0
+        self._lock = Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+def _retry_after(error: APIStatusError) -> Optional[float]:
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class CaptioningEngine:
+    """
+    Captions the best image of each artifact and writes the result to
+    `Artifact.caption`.
+
+    Args:
+        client (OpenAI): Client shared by all requests, and so its connection pool.
+        prompt (str): Captioning prompt, the CAPTIONING_PROMPT returned by load_prompts.
+        model (str): Model name.
+        max_concurrency (int): Maximum number of requests in flight.
+        requests_per_minute (Optional[float]): Client-side request rate limit.
+        cache (Optional[ResultCache]): Cache of the captions, keyed by image, model, prompt and encoder settings.
+        retries (int): Retries of a rate-limited or failed request.
+        backoff (float): Initial retry delay in seconds, doubled at every attempt.
+        encoder (Optional[PayloadEncoder]): Encoder of the uploaded images, full-size JPEG by default.
+            With a `roi_margin`, images are cropped around their object (see Image.roi), and with
+            `mask_background` the background outside its mask is blanked.
+        rate_limiter (Optional[RateLimiter]): Limiter shared with other engines, replacing the one of `requests_per_minute`.
+    """
+
+    def __init__(
+        self,
+        client: OpenAI,
+        prompt: str,
+        model: str = DEFAULT_MODEL,
+        max_concurrency: int = 4,
+        requests_per_minute: Optional[float] = None,
+        cache: Optional[ResultCache] = None,
+        retries: int = 5,
+        backoff: float = 1.0,
+        encoder: Optional[PayloadEncoder] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
+        self.client = client
+        self.prompt = prompt
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(requests_per_minute)
+        self.encoder = encoder if encoder is not None else PayloadEncoder()
+
+    def encode_image(self, artifact: Artifact) -> str:
+        best = artifact.best_image
+        return self.encoder.encode(
+            best.image, roi=best.roi(), mask=best.largest_mask(), mask_scale=best.scale
+        ).data_url()
+
+    def request(self, image_url: str) -> Response:
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            try:
+                return self.client.responses.create(
+                    model=self.model,
+                    input=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "input_text", "text": self.prompt},
+                                {
+                                    "type": "input_image",
+                                    "image_url": image_url,
+                                },
+                            ],
+                        }
+                    ],
+                )
+            except (APIConnectionError, APIStatusError) as e:
+                retryable = isinstance(e, (APIConnectionError, RateLimitError)) or (
+                    e.status_code >= 500
+                )
+                if attempt >= self.retries or not retryable:
+                    raise CaptioningError(f"Captioning request failed: {str(e)}") from e
+
+                delay = self.backoff * 2**attempt * (1 + random.random() / 2)
+                if isinstance(e, RateLimitError):
+                    delay = _retry_after(e) or delay
+                logging.warning(f"Captioning request failed ({str(e)}), retrying in {delay:.1f}s")
+                if isinstance(e, RateLimitError):
+                    # Every worker backs off, not only the one that was rejected
+                    self.rate_limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+                attempt += 1
+
+    @staticmethod
+    def parse_caption(response: Response) -> str:
+        # output_text joins the text parts of all the output items, which may start with a reasoning item
+        caption = response.output_text
+        if not caption:
+            raise ProcessingError(f"Captioning response {response.id} has no text output (status: {response.status})")
+        return caption
+
+    def caption(self, artifact: Artifact) -> Artifact:
+        if artifact.best_image is None:
+            return artifact
+
+        key = None
+        if self.cache is not None:
+            mask = artifact.best_image.largest_mask() if self.encoder.mask_background else None
+            key = hash_key(
+                artifact.best_image.image,
+                # The crop depends on the detection only when cropping is enabled
+                artifact.best_image.roi() if self.encoder.roi_margin is not None else None,
+                self.model,
+                self.prompt,
+                self.encoder.signature(),
+                # Existing keys are unchanged without masking
+                *([mask.to_dict()] if mask is not None else []),
+            )
+            cached = self.cache.get(key)
+            if cached is not None:
+                artifact.caption = cached
+                return artifact
+
+        artifact.caption = self.parse_caption(self.request(self.encode_image(artifact)))
+
+        if self.cache is not None:
+            self.cache.put(key, artifact.caption)
+
+        return artifact
+
+    def caption_stream(self, artifacts: Iterable[Artifact]) -> Iterator[Artifact]:
+        # Keeps up to max_concurrency requests in flight and yields the artifacts in input order
+        if self.max_concurrency <= 1:
+            for artifact in artifacts:
+                yield self.caption(artifact)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = deque()
+            try:
+                for artifact in artifacts:
+                    pending.append(executor.submit(self.caption, artifact))
+                    if len(pending) >= self.max_concurrency:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def caption_all(self, artifacts: List[Artifact]) -> List[Artifact]:
+        return list(self.caption_stream(artifacts))
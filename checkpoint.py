@@ -0,0 +1,277 @@
+"""
+    RunCheckpoint persists the output of every pipeline stage to a run directory, so that an interrupted run can be
+    resumed, skipping the completed stages and the completed items of a partially finished stage.
+"""
+
+from collections import deque
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import json
+import logging
+
+import cv2
+import numpy as np
+
+from artifact import Artifact
+from errors import InputError, ProcessingError
+from image import Image
+from masks import Mask, decode_masks, strip_polygons
+from preprocessing2 import CorrectionParameters, TemporalCorrector
+from video import VideoFrame
+
+STAGES = ("preprocess", "detect", "select", "caption", "save")
+
+# Fast lossless compression of the checkpointed frames
+PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+
+class RunCheckpoint:
+    """
+    Run directory layout:
+
+        state.json          configuration of the run and completed stages
+        frames/             preprocessed frames as PNG: <index>.png, <index>_original.png, <index>_full.png,
+                            and <index>_sample.png, the sample of the temporal correction
+        frames.jsonl        one record per preprocessed frame (path, scale, stored arrays, temporal correction state)
+        detections.jsonl    one record per detected frame (detection, segmentation and masks)
+        artifacts.json      artifacts as indices into the detected frames
+        captions.jsonl      one record per captioned artifact
+        saved.jsonl         one record per saved artifact
+
+    Records are appended and flushed one by one, so a crash loses at most the
+    item being written. A disabled checkpoint (no run directory) writes and
+    restores nothing.
+
+    Args:
+        run_dir (Optional[Path]): Run directory, None to disable checkpointing.
+        config (Dict[str, Any]): Options the outputs depend on; a resumed run must have the same.
+        resume (bool): Continue the run in `run_dir` instead of starting a new one.
+    """
+
+    def __init__(self, run_dir: Optional[Path], config: Dict[str, Any], resume: bool = False):
+        self.run_dir = Path(run_dir) if run_dir is not None else None
+        self.config = config
+        self.completed: List[str] = []
+        if self.run_dir is None:
+            return
+
+        state_path = self.run_dir / "state.json"
+        if resume and state_path.is_file():
+            with open(state_path) as f:
+                state = json.load(f)
+            changed = sorted(
+                key
+                for key in set(state["config"]) | set(config)
+                if state["config"].get(key) != config.get(key)
+            )
+            if changed:
+                raise InputError(
+                    f"Cannot resume {self.run_dir}: options changed ({', '.join(changed)})"
+                )
+            self.completed = state["completed"]
+            logging.info(f"Resuming run {self.run_dir}, completed stages: {self.completed}")
+        else:
+            self._clear()
+            self._write_state()
+
+    @property
+    def enabled(self) -> bool:
+        return self.run_dir is not None
+
+    def _clear(self) -> None:
+        # Only the files of a previous run are removed
+        for name in ("state.json", "frames.jsonl", "detections.jsonl", "artifacts.json", "captions.jsonl", "saved.jsonl"):
+            (self.run_dir / name).unlink(missing_ok=True)
+        frames_dir = self.run_dir / "frames"
+        if frames_dir.is_dir():
+            for path in frames_dir.glob("*.png"):
+                path.unlink()
+        frames_dir.mkdir(parents=True, exist_ok=True)
+
+    def _write_state(self) -> None:
+        with open(self.run_dir / "state.json", "w") as f:
+            json.dump({"config": self.config, "completed": self.completed}, f, indent=2)
+
+    def is_complete(self, stage: str) -> bool:
+        return stage in self.completed
+
+    def complete(self, stage: str) -> None:
+        if not self.enabled or stage in self.completed:
+            return
+        self.completed.append(stage)
+        self._write_state()
+        logging.info(f"Checkpoint: stage {stage} completed")
+
+    def _append(self, name: str, record: Dict[str, Any]) -> None:
+        with open(self.run_dir / name, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+
+    def _read(self, name: str) -> List[Dict[str, Any]]:
+        if not self.enabled or not (self.run_dir / name).is_file():
+            return []
+        records = []
+        with open(self.run_dir / name) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # Truncated by a crash
+        return records
+
+    # Preprocess
+
+    def _write_png(self, name: str, array: np.ndarray) -> None:
+        if not cv2.imwrite(str(self.run_dir / "frames" / name), array, PNG_PARAMS):
+            raise ProcessingError(f"Cannot write checkpoint frame {name}")
+
+    def _read_png(self, name: str) -> np.ndarray:
+        array = cv2.imread(str(self.run_dir / "frames" / name), cv2.IMREAD_UNCHANGED)
+        if array is None:
+            raise InputError(f"Missing checkpoint frame {self.run_dir / 'frames' / name}")
+        return array
+
+    def record_frames(
+        self, frames: Iterable[Image], start: int = 0, corrector: Optional[TemporalCorrector] = None
+    ) -> Iterator[Image]:
+        # `frames` are corrected in order with the estimates of `corrector`, whose state is recorded with every frame
+        if self.enabled and corrector is not None:
+            corrector.history = deque()
+        for index, image in enumerate(frames, start):
+            if self.enabled:
+                self._write_png(f"{index:06d}.png", image.image)
+                if image.original is not None:
+                    self._write_png(f"{index:06d}_original.png", image.original)
+                if image.full_resolution is not None:
+                    self._write_png(f"{index:06d}_full.png", image.full_resolution)
+                record = {
+                    "index": index,
+                    "path": str(image.path),
+                    "scale": image.scale,
+                    "original": image.original is not None,
+                    "full_resolution": image.full_resolution is not None,
+                }
+                if image.video_frame is not None:
+                    record["video_frame"] = [str(image.video_frame.video_path), image.video_frame.position]
+                if image.correction_parameters is not None:
+                    record["correction"] = [image.correction_parameters.a_mean, image.correction_parameters.b_mean]
+                if corrector is not None:
+                    record["temporal"], sample = corrector.history.popleft()
+                    self._write_png(f"{index:06d}_sample.png", sample)
+                self._append("frames.jsonl", record)
+            yield image
+        if corrector is not None:
+            corrector.history = None
+
+    def restore_corrector(self, corrector: TemporalCorrector) -> bool:
+        """
+        Restores the state of `corrector` after the last recorded frame, so
+        that the remaining frames get the parameters of an uninterrupted run.
+        Returns False if the frames were recorded without a state.
+        """
+        records = self._read("frames.jsonl")
+        if not records or "temporal" not in records[-1]:
+            return False
+        index = records[-1]["index"]
+        corrector.restore(records[-1]["temporal"], self._read_png(f"{index:06d}_sample.png"))
+        return True
+
+    def load_frames(self) -> List[Image]:
+        frames = []
+        for record in self._read("frames.jsonl"):
+            index = record["index"]
+            frames.append(
+                Image(
+                    image=self._read_png(f"{index:06d}.png"),
+                    original=self._read_png(f"{index:06d}_original.png") if record["original"] else None,
+                    path=Path(record["path"]),
+                    scale=record["scale"],
+                    full_resolution=self._read_png(f"{index:06d}_full.png") if record["full_resolution"] else None,
+                    video_frame=VideoFrame(Path(record["video_frame"][0]), record["video_frame"][1])
+                    if "video_frame" in record
+                    else None,
+                    correction_parameters=CorrectionParameters(*record["correction"]) if "correction" in record else None,
+                )
+            )
+        return frames
+
+    # Detect
+
+    def load_detections(self) -> Dict[int, Dict[str, Any]]:
+        return {record["index"]: record for record in self._read("detections.jsonl")}
+
+    def record_detections(self, detected: Iterable[Tuple[int, Image]]) -> Iterator[Tuple[int, Image]]:
+        for index, image in detected:
+            if self.enabled:
+                self._append(
+                    "detections.jsonl",
+                    {
+                        "index": index,
+                        "detection": image.object_detection,
+                        "segmentation": image.object_segmentation,
+                        "masks": [mask.to_dict() for mask in image.masks],
+                    },
+                )
+            yield index, image
+
+    @staticmethod
+    def apply_detection(image: Image, record: Dict[str, Any]) -> Image:
+        # Checkpointed detections are already in full-resolution coordinates
+        image.object_detection = record["detection"]
+        if "masks" in record:
+            image.object_segmentation = record["segmentation"]
+            image.masks = [Mask.from_dict(mask) for mask in record["masks"]]
+        else:
+            # Checkpoints written before masks were decoded keep the polygons
+            image.object_segmentation = strip_polygons(record["segmentation"])
+            image.masks = decode_masks(record["segmentation"])
+        return image
+
+    # Select
+
+    def save_artifacts(self, artifacts: List[Artifact], frames: List[Image]) -> None:
+        if not self.enabled:
+            return
+        indices = {id(image): index for index, image in enumerate(frames)}
+        records = [
+            {
+                "name": artifact.name,
+                "frames": [indices[id(image)] for image in artifact.images],
+                "best": indices[id(artifact.best_image)] if artifact.best_image is not None else None,
+                "frame_count": artifact.frame_count,
+            }
+            for artifact in artifacts
+        ]
+        with open(self.run_dir / "artifacts.json", "w") as f:
+            json.dump(records, f)
+
+    def load_artifacts(self, frames: List[Image]) -> List[Artifact]:
+        with open(self.run_dir / "artifacts.json") as f:
+            records = json.load(f)
+        return [
+            Artifact(
+                images=[frames[index] for index in record["frames"]],
+                name=record["name"],
+                best_image=frames[record["best"]] if record["best"] is not None else None,
+                frame_count=record["frame_count"],
+            )
+            for record in records
+        ]
+
+    # Caption
+
+    def load_captions(self) -> Dict[int, str]:
+        return {record["index"]: record["caption"] for record in self._read("captions.jsonl")}
+
+    def record_caption(self, index: int, caption: Optional[str]) -> None:
+        if self.enabled:
+            self._append("captions.jsonl", {"index": index, "caption": caption})
+
+    # Save
+
+    def load_saved(self) -> Set[int]:
+        return {record["index"] for record in self._read("saved.jsonl")}
+
+    def record_saved(self, index: int) -> None:
+        if self.enabled:
+            self._append("saved.jsonl", {"index": index})
@@ -0,0 +1,170 @@
+"""
+    FrameDeduplicator removes near-duplicate consecutive frames before detection, so that runs of almost identical
+    video frames cost a single workflow call.
+"""
+
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import json
+import logging
+
+import cv2
+import numpy as np
+
+from errors import ProcessingError
+from image import Image
+
+MODES = ("drop", "collapse")
+# Most duplicates held per representative in collapse mode
+MAX_RUN = 32
+
+
+def dhash(image: np.ndarray, hash_size: int = 8) -> int:
+    """
+    Difference hash: the signs of the horizontal gradients of a
+    (hash_size + 1) x hash_size grayscale thumbnail, packed in an integer.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    thumbnail = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def thumbnail(image: np.ndarray, size: int = 16) -> np.ndarray:
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def thumbnail_distance(a: np.ndarray, b: np.ndarray) -> float:
+    # Mean absolute difference of the thumbnails, in gray levels
+    return float(np.abs(a - b).mean())
+
+
+# Signature, distance and default threshold of each metric
+METRICS = {
+    "dhash": (dhash, hamming_distance, 4),
+    "thumbnail": (thumbnail, thumbnail_distance, 3.0),
+}
+
+
+@dataclass
+class DedupStats:
+    frames: int = 0
+    kept: int = 0
+
+    @property
+    def skipped(self) -> int:
+        return self.frames - self.kept
+
+    def __str__(self) -> str:
+        ratio = self.skipped / self.frames if self.frames else 0.0
+        return (
+            f"{self.skipped} of {self.frames} frames were near-duplicates, "
+            f"{self.skipped} inference calls saved ({ratio:.0%})"
+        )
+
+
+class FrameDeduplicator:
+    """
+    Compares every frame with the representative of the current run of
+    near-duplicates, i.e. the last frame that was kept, and starts a new run
+    when their distance exceeds the threshold. Only representatives are sent
+    to detection.
+
+    In "drop" mode duplicates are discarded. In "collapse" mode they are held
+    until their representative is detected, then re-inserted after it with its
+    detections, so that they still belong to its artifact. Held duplicates
+    keep their pixels, so a run is closed after `max_run` duplicates and the
+    next frame becomes a representative: a long static shot then costs one
+    inference call every `max_run` frames, and memory stays bounded. In both
+    modes `mapping` attributes every duplicate to its representative.
+
+    Args:
+        metric (str): One of METRICS.
+        threshold (Optional[float]): Largest distance of a duplicate, the metric default if None.
+        mode (str): One of MODES.
+        max_run (int): Most duplicates held per representative, in collapse mode.
+    """
+
+    def __init__(
+        self, metric: str = "dhash", threshold: Optional[float] = None, mode: str = "drop", max_run: int = MAX_RUN
+    ):
+        if metric not in METRICS:
+            raise ProcessingError(f"Unknown deduplication metric: {metric}")
+        if mode not in MODES:
+            raise ProcessingError(f"Unknown deduplication mode: {mode}")
+        self.signature, self.distance, default_threshold = METRICS[metric]
+        self.metric = metric
+        self.threshold = default_threshold if threshold is None else threshold
+        self.mode = mode
+        self.max_run = max_run
+        self.stats = DedupStats()
+        self.mapping: Dict[str, str] = {}
+        # Duplicates of every representative not yet expanded, in collapse mode
+        self._runs = deque()
+
+    def filter(self, images: Iterable[Image]) -> Iterator[Image]:
+        representative, reference = None, None
+        for image in images:
+            self.stats.frames += 1
+            signature = self.signature(image.image)
+
+            full = self.mode == "collapse" and self._runs and len(self._runs[-1]) >= self.max_run
+            if reference is not None and not full and self.distance(signature, reference) <= self.threshold:
+                self.mapping[str(image.path)] = str(representative.path)
+                if self.mode == "collapse":
+                    self._runs[-1].append(image)
+                continue
+
+            representative, reference = image, signature
+            self.stats.kept += 1
+            if self.mode == "collapse":
+                self._runs.append([])
+            yield image
+
+    def expand(self, detected: Iterable[Image]) -> Iterator[Image]:
+        """
+        Re-inserts the duplicates held in collapse mode after their detected
+        representative. `detected` must yield one image per representative, in
+        order. Every representative is held until the next one is detected,
+        when its run of duplicates is complete.
+        """
+        if self.mode != "collapse":
+            yield from detected
+            return
+
+        previous = None
+        for image in detected:
+            if previous is not None:
+                yield from self._with_duplicates(previous)
+            previous = image
+        if previous is not None:
+            yield from self._with_duplicates(previous)
+
+    def _with_duplicates(self, representative: Image) -> List[Image]:
+        duplicates = self._runs.popleft()
+        for duplicate in duplicates:
+            duplicate.object_detection = representative.object_detection
+            duplicate.object_segmentation = representative.object_segmentation
+            duplicate.masks = representative.masks
+        return [representative] + duplicates
+
+    def save_mapping(self, path: Path) -> None:
+        report: Dict[str, Any] = {
+            "metric": self.metric,
+            "threshold": self.threshold,
+            "mode": self.mode,
+            "frames": self.stats.frames,
+            "kept": self.stats.kept,
+            "duplicates": self.mapping,
+        }
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Deduplication: {self.stats}")
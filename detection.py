@@ -0,0 +1,412 @@
+"""
+    Detection backends: the Roboflow workflow over HTTP, or a YOLO detector and segmenter exported to ONNX and run
+    in-process on the CPU. Both return results in the format of the workflow outputs, which Image.apply_workflow_result parses.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import ast
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from errors import InputError, RoboflowError
+
+try:
+    import onnxruntime
+except ImportError:  # OpenCV's DNN module runs the model instead
+    onnxruntime = None
+
+BACKENDS = ("roboflow", "onnx")
+
+# Grey of the letterbox padding, as in the YOLO exports
+LETTERBOX_COLOR = 114
+
+
+def is_retryable(error: Exception) -> bool:
+    # Client errors other than timeouts and rate limits will not succeed on a retry
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int) and 400 <= status < 500:
+        return status in (408, 429)
+    return True
+
+
+def run_workflow_with_retries(
+    client, frames: List[Any], prompt: str, retries: int = 3, backoff: float = 0.5
+) -> List[Dict[str, Any]]:
+    # Runs the Roboflow workflow on a batch of frames, retrying with exponential backoff.
+    attempt = 0
+    while True:
+        try:
+            results = client.run_workflow(
+                workspace_name=os.getenv("ROBOFLOW_WORKSPACE_NAME", ""),
+                workflow_id=os.getenv("ROBOFLOW_DETECTION_WORKFLOW_ID", ""),
+                images={"input_image": frames[0] if len(frames) == 1 else frames},
+                parameters={"detection_prompt": prompt},
+            )
+            if len(results) != len(frames):
+                raise RoboflowError(
+                    f"Workflow returned {len(results)} results for {len(frames)} images"
+                )
+            return results
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e):
+                raise RoboflowError(
+                    f"Workflow failed after {attempt + 1} attempts: {str(e)}"
+                ) from e
+            delay = backoff * 2**attempt * (1 + random.random() / 2)
+            logging.warning(f"Workflow call failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+class DetectionBackend(ABC):
+    """
+    Detects and segments the objects of a batch of frames. Results have the
+    format of the workflow outputs: boxes and labels in
+    `model.parsed_output`, polygons in `model_1.predictions`, in the
+    coordinates of each input frame.
+    """
+
+    # Remote backends are sent encoded uploads (see encoding.PayloadEncoder),
+    # local ones the frames themselves
+    remote: bool = True
+
+    @abstractmethod
+    def infer(self, frames: List[Any], prompt: str) -> List[Dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    def signature(self) -> Tuple[str, ...]:
+        # Identifies the model in the cache keys of the results
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class RoboflowBackend(DetectionBackend):
+    """
+    Runs the Roboflow detection workflow of ROBOFLOW_WORKSPACE_NAME and
+    ROBOFLOW_DETECTION_WORKFLOW_ID.
+
+    Args:
+        client: InferenceHTTPClient, or any client with its `run_workflow` method.
+        retries (int): Retries of a failed request.
+        backoff (float): Initial retry delay in seconds, doubled at every attempt.
+    """
+
+    remote = True
+
+    def __init__(self, client, retries: int = 3, backoff: float = 0.5):
+        self.client = client
+        self.retries = retries
+        self.backoff = backoff
+
+    def infer(self, frames: List[Any], prompt: str) -> List[Dict[str, Any]]:
+        return run_workflow_with_retries(self.client, frames, prompt, self.retries, self.backoff)
+
+    def signature(self) -> Tuple[str, ...]:
+        return (
+            os.getenv("ROBOFLOW_WORKSPACE_NAME", ""),
+            os.getenv("ROBOFLOW_DETECTION_WORKFLOW_ID", ""),
+        )
+
+    def close(self) -> None:
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+
+def as_backend(client) -> DetectionBackend:
+    # Backends may be wrapped (e.g. by Profiler.instrument), so they are recognized by their
+    # `infer` method. Workflow clients passed directly are run through the Roboflow backend.
+    return client if hasattr(client, "infer") else RoboflowBackend(client)
+
+
+def _varint(data: bytes, position: int) -> Tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        value |= (byte & 0x7F) << shift
+        position += 1
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def _protobuf_fields(data: bytes) -> List[Tuple[int, Any]]:
+    # (field number, value) of the top-level fields of a protobuf message
+    fields, position = [], 0
+    while position < len(data):
+        key, position = _varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = _varint(data, position)
+        elif wire_type == 2:
+            length, position = _varint(data, position)
+            value, position = data[position : position + length], position + length
+        elif wire_type in (1, 5):
+            size = 8 if wire_type == 1 else 4
+            value, position = data[position : position + size], position + size
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        fields.append((number, value))
+    return fields
+
+
+def read_onnx_metadata(model: bytes) -> Dict[str, str]:
+    """
+    Returns the metadata_props of a serialized ONNX model (ModelProto field
+    14), without depending on the onnx package.
+    """
+    metadata = {}
+    for number, value in _protobuf_fields(model):
+        if number == 14:
+            entry = dict(_protobuf_fields(value))
+            metadata[entry.get(1, b"").decode()] = entry.get(2, b"").decode()
+    return metadata
+
+
+def letterbox(frame: np.ndarray, size: int) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """
+    Resizes `frame` to fit a `size` x `size` square, keeping its aspect ratio,
+    and pads it with grey. Returns the padded frame, the resize ratio and the
+    (x, y) padding.
+    """
+    h, w = frame.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = round(w * ratio), round(h * ratio)
+    interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(frame, (new_w, new_h), interpolation=interpolation)
+    pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+    padded = cv2.copyMakeBorder(
+        resized,
+        pad_y,
+        size - new_h - pad_y,
+        pad_x,
+        size - new_w - pad_x,
+        cv2.BORDER_CONSTANT,
+        value=(LETTERBOX_COLOR,) * 3,
+    )
+    return padded, ratio, (pad_x, pad_y)
+
+
+def decode_yolo(
+    predictions: np.ndarray,
+    protos: Optional[np.ndarray],
+    ratio: float,
+    padding: Tuple[int, int],
+    frame_size: Tuple[int, int],
+    input_size: int,
+    class_names: Sequence[str],
+    confidence: float = 0.25,
+    iou: float = 0.45,
+    max_detections: int = 100,
+) -> Dict[str, Any]:
+    """
+    Decodes the output of a YOLOv8-style model for one frame into workflow
+    results: `predictions` is (4 + classes + mask coefficients, anchors), with
+    boxes as center, width and height in the letterboxed input, and `protos`
+    the (coefficients, height, width) mask prototypes of a segmentation
+    model, or None. Boxes go through a per-class non-maximum suppression, and
+    mask polygons are traced at the resolution of the prototypes.
+    """
+    classes = len(class_names)
+    predictions = predictions.T
+    scores = predictions[:, 4 : 4 + classes]
+    class_ids = scores.argmax(axis=1)
+    best = scores[np.arange(len(scores)), class_ids]
+    keep = best >= confidence
+    boxes, best, class_ids = predictions[keep, :4], best[keep], class_ids[keep]
+    coefficients = predictions[keep, 4 + classes :]
+
+    # Center, size to corners, in the letterboxed input
+    corners = np.empty_like(boxes)
+    corners[:, :2] = boxes[:, :2] - boxes[:, 2:] / 2
+    corners[:, 2:] = boxes[:, :2] + boxes[:, 2:] / 2
+    indices = [] if len(corners) == 0 else cv2.dnn.NMSBoxesBatched(
+        [[float(x1), float(y1), float(x2 - x1), float(y2 - y1)] for x1, y1, x2, y2 in corners],
+        best.astype(float).tolist(),
+        class_ids.astype(int).tolist(),
+        confidence,
+        iou,
+    )
+    indices = np.asarray(indices, dtype=int).reshape(-1)[:max_detections]
+
+    width, height = frame_size
+    offset = np.array([padding[0], padding[1]] * 2, dtype=float)
+    bboxes, labels, detections = [], [], []
+    for i in indices:
+        box = (corners[i] - offset) / ratio
+        box = np.clip(box, 0, [width, height, width, height])
+        label = class_names[class_ids[i]]
+        polygon = None
+        if protos is not None and coefficients.shape[1] == protos.shape[0]:
+            polygon = _trace_mask(coefficients[i], protos, corners[i], input_size)
+        if polygon is None:
+            polygon = corners[i][[0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 2)
+        polygon = np.clip((polygon - offset[:2]) / ratio, 0, [width, height])
+        bboxes.append(box.tolist())
+        labels.append(label)
+        detections.append((box, label, float(best[i]), polygon))
+
+    return {
+        "model": {"parsed_output": {"bboxes": bboxes, "labels": labels}},
+        "model_1": {
+            "predictions": [
+                {
+                    "x": float(box[0] + box[2]) / 2,
+                    "y": float(box[1] + box[3]) / 2,
+                    "width": float(box[2] - box[0]),
+                    "height": float(box[3] - box[1]),
+                    "class": label,
+                    "confidence": score,
+                    "points": [{"x": float(x), "y": float(y)} for x, y in polygon],
+                }
+                for box, label, score, polygon in detections
+            ]
+        },
+    }
+
+
+def _trace_mask(
+    coefficients: np.ndarray, protos: np.ndarray, box: np.ndarray, input_size: int
+) -> Optional[np.ndarray]:
+    # Mask of one detection, inside its box, at the prototype resolution
+    _, mask_h, mask_w = protos.shape
+    scale = mask_w / input_size
+    x1, y1 = np.floor(box[:2] * scale).astype(int).clip(0, [mask_w, mask_h])
+    x2, y2 = np.ceil(box[2:] * scale).astype(int).clip(0, [mask_w, mask_h])
+    if x2 <= x1 or y2 <= y1:
+        return None
+    region = protos[:, y1:y2, x1:x2]
+    logits = np.tensordot(coefficients, region, axes=1)
+    mask = (logits > 0).astype(np.uint8)  # sigmoid(logits) > 0.5
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    contour = max(contours, key=cv2.contourArea).reshape(-1, 2).astype(float)
+    # Pixel centers, back to the letterboxed input
+    return (contour + [x1 + 0.5, y1 + 0.5]) / scale
+
+
+class OnnxBackend(DetectionBackend):
+    """
+    Runs a YOLOv8-style detection or segmentation model exported to ONNX,
+    in-process, on batches of frames. The model runs on onnxruntime when it
+    is installed, and on OpenCV's DNN module otherwise. Class names are read
+    from the metadata of the export, unless given. The prompt is ignored:
+    the model detects its own classes.
+
+    Args:
+        model_path (Path): ONNX model file.
+        input_size (int): Side of the square input of the model.
+        confidence (float): Minimum class score of a detection.
+        iou (float): Overlap above which the weaker of two boxes of a class is suppressed.
+        class_names (Optional[Sequence[str]]): Names of the classes, in model order.
+        threads (Optional[int]): Threads of an onnxruntime session, all the cores by default.
+    """
+
+    remote = False
+
+    def __init__(
+        self,
+        model_path,
+        input_size: int = 640,
+        confidence: float = 0.25,
+        iou: float = 0.45,
+        class_names: Optional[Sequence[str]] = None,
+        threads: Optional[int] = None,
+    ):
+        self.model_path = str(model_path)
+        self.input_size = input_size
+        self.confidence = confidence
+        self.iou = iou
+        try:
+            with open(self.model_path, "rb") as f:
+                model = f.read()
+            metadata = read_onnx_metadata(model)
+        except (OSError, ValueError, IndexError) as e:
+            raise InputError(f"Cannot read detection model {self.model_path}: {str(e)}")
+        self._digest = hashlib.blake2b(model, digest_size=16).hexdigest()
+        self.class_names = list(class_names) if class_names else self._read_class_names(metadata)
+
+        try:
+            if onnxruntime is not None:
+                options = onnxruntime.SessionOptions()
+                if threads:
+                    options.intra_op_num_threads = threads
+                self._session = onnxruntime.InferenceSession(
+                    model, options, providers=["CPUExecutionProvider"]
+                )
+                self._input = self._session.get_inputs()[0]
+                # Exports with a fixed batch dimension run one frame at a time
+                self._max_batch = self._input.shape[0] if isinstance(self._input.shape[0], int) else None
+            else:
+                self._net = cv2.dnn.readNetFromONNX(self.model_path)
+                self._net_lock = threading.Lock()
+                self._max_batch = None
+        except Exception as e:
+            raise InputError(f"Cannot load detection model {self.model_path}: {str(e)}")
+        logging.info(
+            f"Loaded detection model {self.model_path} ({len(self.class_names)} classes) "
+            f"on {'onnxruntime' if onnxruntime is not None else 'OpenCV DNN'}"
+        )
+
+    @staticmethod
+    def _read_class_names(metadata: Dict[str, str]) -> List[str]:
+        # Ultralytics exports store {index: name} as a Python literal
+        try:
+            names = ast.literal_eval(metadata["names"])
+            return [names[i] for i in sorted(names)]
+        except (KeyError, ValueError, SyntaxError, TypeError):
+            raise InputError("The detection model has no class names, set them with --onnx-classes")
+
+    def signature(self) -> Tuple[str, ...]:
+        return ("onnx", self._digest, str(self.input_size), str(self.confidence), str(self.iou))
+
+    def _run(self, batch: np.ndarray) -> List[np.ndarray]:
+        if onnxruntime is not None:
+            if self._max_batch is not None and len(batch) > self._max_batch:
+                runs = [
+                    self._session.run(None, {self._input.name: batch[i : i + self._max_batch]})
+                    for i in range(0, len(batch), self._max_batch)
+                ]
+                return [np.concatenate(outputs) for outputs in zip(*runs)]
+            return self._session.run(None, {self._input.name: batch})
+        # A cv2.dnn network holds its input and outputs, so it is not reentrant
+        with self._net_lock:
+            self._net.setInput(batch)
+            return list(self._net.forward(self._net.getUnconnectedOutLayersNames()))
+
+    def infer(self, frames: List[Any], prompt: str) -> List[Dict[str, Any]]:
+        letterboxed = [letterbox(frame, self.input_size) for frame in frames]
+        batch = cv2.dnn.blobFromImages(
+            [padded for padded, _, _ in letterboxed], scalefactor=1 / 255.0, swapRB=True
+        )
+        outputs = self._run(batch)
+        # Boxes are (batch, channels, anchors), mask prototypes (batch, coefficients, height, width)
+        predictions = next(output for output in outputs if output.ndim == 3)
+        protos = next((output for output in outputs if output.ndim == 4), None)
+
+        return [
+            decode_yolo(
+                predictions[i],
+                protos[i] if protos is not None else None,
+                ratio,
+                padding,
+                (frame.shape[1], frame.shape[0]),
+                self.input_size,
+                self.class_names,
+                self.confidence,
+                self.iou,
+            )
+            for i, (frame, (_, ratio, padding)) in enumerate(zip(frames, letterboxed))
+        ]
@@ -0,0 +1,182 @@
+"""
+    PayloadEncoder prepares the images sent to remote inference and captioning services: resizing, ROI cropping,
+    JPEG/WebP compression under an optional byte budget, and accounting of the bytes sent.
+"""
+
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Optional, Sequence, Tuple
+import base64
+import time
+
+import cv2
+import numpy as np
+
+from errors import ProcessingError
+from masks import Mask
+
+FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+# Gray level of the background outside the masks, which compresses to almost nothing
+MASK_FILL = 128
+
+# Lowest quality tried before downscaling further to fit a byte budget
+MIN_BUDGET_QUALITY = 40
+
+
+@dataclass
+class EncodedPayload:
+    data: bytes
+    mime_type: str
+    # Size of the encoded image relative to the source, and origin of the crop in source pixels
+    scale: float
+    offset: Tuple[int, int]
+    encode_seconds: float
+
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("utf-8")
+
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self.base64()}"
+
+
+@dataclass
+class PayloadStats:
+    requests: int = 0
+    bytes: int = 0
+    encode_seconds: float = 0.0
+    _lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    def record(self, payload: EncodedPayload) -> None:
+        with self._lock:
+            self.requests += 1
+            self.bytes += len(payload.data)
+            self.encode_seconds += payload.encode_seconds
+
+    def __str__(self) -> str:
+        if not self.requests:
+            return "no requests"
+        return (
+            f"{self.requests} requests, {self.bytes / 2**20:.1f} MiB sent, "
+            f"{self.bytes / self.requests / 1024:.1f} KiB/request, "
+            f"{self.encode_seconds / self.requests * 1000:.1f} ms encode/request"
+        )
+
+
+def crop_to_roi(
+    image: np.ndarray, bbox: Sequence[float], margin: float
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Crops an image to a bounding box (x1, y1, x2, y2) enlarged by `margin`
+    times its size on every side, clipped to the image.
+    """
+    h, w = image.shape[:2]
+    x1, y1, x2, y2 = bbox
+    dx, dy = (x2 - x1) * margin, (y2 - y1) * margin
+    left, top = max(0, int(x1 - dx)), max(0, int(y1 - dy))
+    right, bottom = min(w, int(np.ceil(x2 + dx))), min(h, int(np.ceil(y2 + dy)))
+    if right <= left or bottom <= top:
+        return image, (0, 0)
+    return image[top:bottom, left:right], (left, top)
+
+
+class PayloadEncoder:
+    """
+    Encodes frames for remote calls.
+
+    Args:
+        max_dimension (Optional[int]): Longest side of the encoded image, None to keep the size.
+        format (str): One of FORMATS.
+        quality (int): Encoder quality, 0-100.
+        roi_margin (Optional[float]): If set, images are cropped to the given ROI enlarged by this fraction.
+        byte_budget (Optional[int]): Maximum size of a payload; quality, then size, are lowered to fit it.
+        mask_background (bool): Fill the pixels outside the mask given to `encode` with MASK_FILL.
+    """
+
+    def __init__(
+        self,
+        max_dimension: Optional[int] = None,
+        format: str = "jpeg",
+        quality: int = 95,
+        roi_margin: Optional[float] = None,
+        byte_budget: Optional[int] = None,
+        mask_background: bool = False,
+    ):
+        if format not in FORMATS:
+            raise ProcessingError(f"Unsupported payload format: {format}")
+        self.max_dimension = max_dimension
+        self.format = format
+        self.quality = quality
+        self.roi_margin = roi_margin
+        self.byte_budget = byte_budget
+        self.mask_background = mask_background
+        self.stats = PayloadStats()
+
+    def signature(self) -> str:
+        # Identifies the settings that change the payload, for cache keys
+        signature = f"{self.format}:{self.quality}:{self.max_dimension}:{self.roi_margin}:{self.byte_budget}"
+        return signature + ":masked" if self.mask_background else signature
+
+    def _encode(self, image: np.ndarray, quality: int) -> bytes:
+        extension, _, flag = FORMATS[self.format]
+        ok, buffer = cv2.imencode(extension, image, [flag, quality])
+        if not ok:
+            raise ProcessingError(f"Cannot encode image as {self.format}")
+        return buffer.tobytes()
+
+    @staticmethod
+    def _resize(image: np.ndarray, scale: float) -> np.ndarray:
+        h, w = image.shape[:2]
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def encode(
+        self,
+        image: np.ndarray,
+        roi: Optional[Sequence[float]] = None,
+        mask: Optional[Mask] = None,
+        mask_scale: float = 1.0,
+    ) -> EncodedPayload:
+        # `mask` is in full-resolution coordinates, `mask_scale` times the size of `image`
+        start = time.perf_counter()
+
+        offset = (0, 0)
+        if self.roi_margin is not None and roi is not None:
+            image, offset = crop_to_roi(image, roi, self.roi_margin)
+
+        if self.mask_background and mask is not None:
+            h, w = image.shape[:2]
+            region = (offset[0], offset[1], offset[0] + w, offset[1] + h)
+            inside = mask.rasterize(region, (w, h), mask_scale)
+            if inside.any():
+                image = np.where(inside[..., None] if image.ndim == 3 else inside, image, np.uint8(MASK_FILL))
+
+        scale = 1.0
+        if self.max_dimension and max(image.shape[:2]) > self.max_dimension:
+            scale = self.max_dimension / max(image.shape[:2])
+            image = self._resize(image, scale)
+
+        quality = self.quality
+        data = self._encode(image, quality)
+        while self.byte_budget and len(data) > self.byte_budget:
+            if quality > MIN_BUDGET_QUALITY:
+                quality = max(MIN_BUDGET_QUALITY, quality - 10)
+            elif min(image.shape[:2]) > 32:
+                image = self._resize(image, 0.75)
+                scale *= 0.75
+            else:
+                break
+            data = self._encode(image, quality)
+
+        payload = EncodedPayload(
+            data=data,
+            mime_type=FORMATS[self.format][1],
+            scale=scale,
+            offset=offset,
+            encode_seconds=time.perf_counter() - start,
+        )
+        self.stats.record(payload)
+        return payload
@@ -20,3 +20,9 @@ class RoboflowError(PipelineError):
     """Exception raised during Roboflow API calls."""
 
     pass
+
+
+class CaptioningError(PipelineError):
+    """Exception raised during LMM captioning calls."""
+
+    pass
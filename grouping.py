@@ -0,0 +1,179 @@
+"""
+    ArtifactGrouper groups detected frames into artifacts in a single pass, by label or by tracking detections
+    across frames, so that an artifact that leaves the view and comes back stays one artifact.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional
+import logging
+
+import numpy as np
+
+from artifact import Artifact
+from errors import ProcessingError
+from image import Image
+from processing import get_largest_bbox_label
+from quality import QualityScorer, RunningBest
+
+# "consecutive" is the groupby of processing.frame_selection_stream
+GROUPINGS = ("consecutive", "label", "track")
+
+
+def iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Intersection over union of every pair of (x1, y1, x2, y2) boxes of `a`
+    and `b`, as an array of shape (len(a), len(b)).
+    """
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+@dataclass(eq=False)
+class Group:
+    name: str
+    label: str
+    running: RunningBest
+    last_seen: int
+    bbox: Optional[np.ndarray] = None
+    frames: List[int] = field(default_factory=list)
+
+
+class ArtifactGrouper:
+    """
+    Groups frames into artifacts, in the order their first frame was seen.
+
+    In "label" mode every frame goes to the artifact of the label of its
+    largest detection, wherever it appears in the stream. In "track" mode
+    every detection is linked to the track of the same label whose last box
+    overlaps it most (IoU above `iou_threshold`), so that two objects of the
+    same class stay distinct; a frame goes to the artifact of every track it
+    contains.
+
+    A group is finalized, and its artifact yielded, when it has not been seen
+    for more than `max_gap` frames, or at the end of the stream if `max_gap`
+    is None. Only the running best frame of each open group is held, unless
+    `keep_images` is set.
+
+    Args:
+        mode (str): "label" or "track".
+        iou_threshold (float): Minimum IoU of a detection and the last box of its track.
+        max_gap (Optional[int]): Number of frames after which a group that was not seen is finalized.
+        scorer (Optional[QualityScorer]): Scorer of the best image.
+        keep_images (bool): Keep every frame of the artifacts.
+    """
+
+    def __init__(
+        self,
+        mode: str = "label",
+        iou_threshold: float = 0.3,
+        max_gap: Optional[int] = None,
+        scorer: Optional[QualityScorer] = None,
+        keep_images: bool = True,
+    ):
+        if mode not in ("label", "track"):
+            raise ProcessingError(f"Unknown grouping mode: {mode}")
+        self.mode = mode
+        self.iou_threshold = iou_threshold
+        self.max_gap = max_gap
+        self.scorer = scorer
+        self.keep_images = keep_images
+
+    def _new_group(self, counts: Dict[str, int], label: str, index: int) -> Group:
+        # Further objects of the same label are numbered
+        counts[label] = counts.get(label, 0) + 1
+        return Group(
+            name=label if counts[label] == 1 else f"{label}_{counts[label]}",
+            label=label,
+            running=RunningBest(self.scorer, keep_images=self.keep_images),
+            last_seen=index,
+        )
+
+    def _assign_label(self, groups: Dict, image: Image, new) -> List[Group]:
+        label = get_largest_bbox_label(image.object_detection) if image.object_detection else None
+        if label is None:
+            return []
+        return [groups[label] if label in groups else new(label)]
+
+    def _assign_tracks(self, groups: Dict, image: Image, new) -> List[Group]:
+        detection = image.object_detection or {}
+        bboxes, labels = detection.get("bboxes") or [], detection.get("labels") or []
+        if not len(bboxes):
+            return []
+        bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+
+        matched: List[Group] = []
+        for label in dict.fromkeys(labels):
+            rows = [i for i, other in enumerate(labels) if other == label]
+            tracks = [group for group in groups.values() if group.label == label]
+            if tracks:
+                iou = iou_matrix(bboxes[rows], np.stack([track.bbox for track in tracks]))
+            else:
+                iou = np.zeros((len(rows), 0))
+
+            # Greedy matching, highest overlap first
+            unmatched = set(range(len(rows)))
+            for flat in np.argsort(-iou, axis=None):
+                row, column = np.unravel_index(flat, iou.shape)
+                if iou[row, column] < self.iou_threshold:
+                    break
+                track = tracks[column]
+                if row not in unmatched or any(track is other for other in matched):
+                    continue
+                unmatched.discard(row)
+                track.bbox = bboxes[rows[row]]
+                matched.append(track)
+
+            for row in sorted(unmatched):
+                track = new(label)
+                track.bbox = bboxes[rows[row]]
+                matched.append(track)
+
+        return matched
+
+    def stream(self, images: Iterable[Image]) -> Iterator[Artifact]:
+        groups: Dict = {}
+        counts: Dict[str, int] = {}
+        assign = self._assign_label if self.mode == "label" else self._assign_tracks
+        index = 0
+
+        def new(label: str) -> Group:
+            group = self._new_group(counts, label, index)
+            groups[label if self.mode == "label" else id(group)] = group
+            return group
+
+        for index, image in enumerate(images):
+            for group in assign(groups, image, new):
+                group.running.push(image)
+                group.last_seen = index
+                group.frames.append(index)
+
+            if self.max_gap is not None:
+                for key, group in list(groups.items()):
+                    if index - group.last_seen > self.max_gap:
+                        del groups[key]
+                        yield self._finalize(group)
+
+        for group in groups.values():
+            yield self._finalize(group)
+
+    def _finalize(self, group: Group) -> Artifact:
+        running = group.running
+        running.flush()
+        logging.debug(f"Artifact {group.name}: frames {group.frames[0]}-{group.frames[-1]}")
+        images = running.images if self.keep_images else [running.best]
+        return Artifact(
+            images=images,
+            name=group.name,
+            best_image=running.best,
+            frame_count=running.count,
+        )
+
+    def group(self, images: Iterable[Image]) -> List[Artifact]:
+        return list(self.stream(images))
@@ -2,48 +2,279 @@
     Image wraps the image, its path, its object detection, its object segmentation and other useful stuff.
 """
 
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Iterable, Iterator, Optional, List
 import numpy as np
 import cv2
 import logging
 
+from errors import ProcessingError
+from masks import Mask, decode_masks, largest_mask, strip_polygons
+from quality import QualityScorer, LUMA_WEIGHTS, luma_thumbnails, thumbnail_size
+
+LAZY_ORIGINALS = ("reload", "thumbnail")
+
 
-@dataclass
 class Image:
-    image: np.ndarray
-    original: Optional[np.ndarray]
-    path: Optional[Path] = field(default_factory=Path)
-    object_segmentation: Optional[Dict[str, str]] = field(default_factory=dict)
-    object_detection: Optional[Dict[str, str]] = field(default_factory=dict)
+    """
+    A frame: the processed `image`, the unprocessed `original` it is scored
+    against, and the detection results. The polygons of the segmentation are
+    decoded to compact `masks` (see masks.py) and dropped from
+    `object_segmentation`.
+
+    Slotted to keep the per-frame overhead low. The original can be released
+    with `release_original`: in "reload" mode it is read again from `path`
+    whenever it is accessed, in "thumbnail" mode only a downscaled luma
+    thumbnail is kept for quality scoring and `original` is None.
+    """
+
+    __slots__ = (
+        "image",
+        "_original",
+        "original_thumbnail",
+        "lazy_original",
+        "path",
+        "object_segmentation",
+        "object_detection",
+        "masks",
+        "scale",
+        "full_resolution",
+        "video_frame",
+        "correction_parameters",
+        "artifact_label",
+    )
+
+    def __init__(
+        self,
+        image: np.ndarray,
+        original: Optional[np.ndarray],
+        path: Optional[Path] = None,
+        object_segmentation: Optional[Dict[str, str]] = None,
+        object_detection: Optional[Dict[str, str]] = None,
+        # Ratio between the size of `image` and the full-resolution frame (1.0 unless it is a proxy)
+        scale: float = 1.0,
+        # Unprocessed full-resolution frame, kept for proxies that cannot be reloaded from `path`
+        full_resolution: Optional[np.ndarray] = None,
+        masks: Optional[List[Mask]] = None,
+        # Frame of a video file that can be decoded again, with a read() method (see video.VideoFrame)
+        video_frame: Optional[Any] = None,
+        # White balance of the temporal correction of the frame (see preprocessing2.CorrectionParameters)
+        correction_parameters: Optional[Any] = None,
+    ):
+        self.image = image
+        self._original = original
+        self.original_thumbnail: Optional[np.ndarray] = None
+        self.lazy_original: Optional[str] = None
+        self.path = path if path is not None else Path()
+        self.object_segmentation = object_segmentation if object_segmentation is not None else {}
+        self.object_detection = object_detection if object_detection is not None else {}
+        self.masks = masks if masks is not None else []
+        self.scale = scale
+        self.full_resolution = full_resolution
+        self.video_frame = video_frame
+        self.correction_parameters = correction_parameters
+        self.artifact_label: Optional[str] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # Also restores the pickles of the former dataclass, whose state has "original"
+        self.__init__(image=None, original=None)
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __repr__(self) -> str:
+        shape = self.image.shape if self.image is not None else None
+        return f"Image(path={self.path}, shape={shape}, scale={self.scale})"
+
+    @property
+    def original(self) -> Optional[np.ndarray]:
+        if self._original is None and self.lazy_original == "reload":
+            return self._reload_original()
+        return self._original
+
+    @original.setter
+    def original(self, value: Optional[np.ndarray]) -> None:
+        self._original = value
+        self.original_thumbnail = None
+        self.lazy_original = None
+
+    def _reload_original(self) -> np.ndarray:
+        original = cv2.imread(str(self.path))
+        if original is None:
+            raise ProcessingError(f"Cannot reload the original frame {self.path}")
+        # Proxies are compared with an original of the same size
+        if self.image is not None and original.shape[:2] != self.image.shape[:2]:
+            h, w = self.image.shape[:2]
+            original = cv2.resize(original, (w, h), interpolation=cv2.INTER_AREA)
+        return original
+
+    def release_original(self, mode: str, max_dimension: int = 256) -> "Image":
+        """
+        Drops the original array. Frames that cannot be reloaded from a file
+        keep a thumbnail in "reload" mode.
+        """
+        if mode not in LAZY_ORIGINALS:
+            raise ProcessingError(f"Unknown lazy original mode: {mode}")
+        if self._original is None:
+            return self
+
+        if mode == "reload" and self.path.is_file():
+            self._original = None
+            self.lazy_original = "reload"
+            return self
+
+        size = thumbnail_size(self.image.shape, max_dimension)
+        self.original_thumbnail = luma_thumbnails([self._original], size)[0].astype(np.uint8)
+        self._original = None
+        self.lazy_original = "thumbnail"
+        return self
+
+    def nbytes(self) -> Dict[str, int]:
+        # Bytes held by the arrays of the frame, by attribute
+        sizes = {}
+        for name in ("image", "_original", "original_thumbnail", "full_resolution"):
+            array = getattr(self, name)
+            shared = name == "_original" and array is self.image
+            sizes[name.lstrip("_")] = array.nbytes if array is not None and not shared else 0
+        sizes["masks"] = sum(mask.nbytes for mask in self.masks)
+        return sizes
 
     @staticmethod
     def from_workflow_result(
-        result: Dict[str, Any], image: np.ndarray, original: np.ndarray
+        result: Dict[str, Any],
+        image: np.ndarray,
+        original: np.ndarray,
+        path: Optional[Path] = None,
+        scale: float = 1.0,
+        full_resolution: Optional[np.ndarray] = None,
+        payload_scale: float = 1.0,
     ):
+        return Image(
+            image=image,
+            original=original,
+            path=path,
+            scale=scale,
+            full_resolution=full_resolution,
+        ).apply_workflow_result(result, payload_scale)
+
+    def apply_workflow_result(self, result: Dict[str, Any], payload_scale: float = 1.0) -> "Image":
+        # Detections computed on a proxy, or on a downscaled upload (`payload_scale`
+        # relative to `image`), are stored in full-resolution coordinates
+        result_scale = self.scale * payload_scale
+
         def parse_detection_results(result: Dict[str, Any]) -> Dict[str, Any]:
-            return result.get("model", {}).get("parsed_output", {})
+            detection = result.get("model", {}).get("parsed_output", {})
+            if result_scale != 1.0 and "bboxes" in detection:
+                detection = dict(detection)
+                detection["bboxes"] = (
+                    np.asarray(detection["bboxes"], dtype=float) / result_scale
+                ).tolist()
+            return detection
 
         def parse_segmentation_results(result: Dict[str, Any]) -> Dict[str, Any]:
-            return result.get("model_1", {})
+            return rescale_geometry(result.get("model_1", {}), 1.0 / result_scale)
 
-        return Image(
-            image=image,
-            original=original,
-            object_detection=parse_detection_results(result),
-            object_segmentation=parse_segmentation_results(result),
+        segmentation = parse_segmentation_results(result)
+        self.object_detection = parse_detection_results(result)
+        self.masks = decode_masks(segmentation)
+        self.object_segmentation = strip_polygons(segmentation)
+        return self
+
+    def largest_bbox(self) -> Optional[List[float]]:
+        # Largest detected box (x1, y1, x2, y2) in the coordinates of `image`
+        bboxes = (self.object_detection or {}).get("bboxes")
+        if not bboxes:
+            return None
+        bboxes = np.asarray(bboxes, dtype=float) * self.scale
+        areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+        return bboxes[np.argmax(areas)].tolist()
+
+    def largest_mask(self) -> Optional[Mask]:
+        return largest_mask(self.masks)
+
+    def roi(self) -> Optional[List[float]]:
+        # Region of the object (x1, y1, x2, y2) in the coordinates of `image`:
+        # the box of the largest mask, or else the largest detected box
+        mask = self.largest_mask()
+        if mask is not None:
+            return mask.scaled_box(self.scale)
+        return self.largest_bbox()
+
+
+@dataclass
+class FrameMemory:
+    """
+    Accounts the memory held by the frames of a run.
+    """
+
+    frames: int = 0
+    image: int = 0
+    original: int = 0
+    original_thumbnail: int = 0
+    full_resolution: int = 0
+    masks: int = 0
+
+    def add(self, image: Image) -> None:
+        self.frames += 1
+        for name, size in image.nbytes().items():
+            setattr(self, name, getattr(self, name) + size)
+
+    def __str__(self) -> str:
+        total = self.image + self.original + self.original_thumbnail + self.full_resolution
+        per_frame = total / self.frames if self.frames else 0
+        return (
+            f"{self.frames} frames, {total / 2**20:.1f} MiB ({per_frame / 2**20:.2f} MiB/frame): "
+            f"image {self.image / 2**20:.1f} MiB, original {self.original / 2**20:.1f} MiB, "
+            f"thumbnails {self.original_thumbnail / 2**20:.1f} MiB, "
+            f"full resolution {self.full_resolution / 2**20:.1f} MiB"
         )
 
 
+def release_originals(
+    images: Iterable[Image], mode: Optional[str], memory: Optional[FrameMemory] = None
+) -> Iterator[Image]:
+    for image in images:
+        if mode is not None:
+            image.release_original(mode)
+        if memory is not None:
+            memory.add(image)
+        yield image
+
+
+def rescale_geometry(payload: Any, factor: float) -> Any:
+    """
+    Returns a copy of a workflow payload with every x, y, width and height value
+    multiplied by `factor`. Used to map segmentation results between a proxy and
+    the full-resolution frame.
+    """
+    if factor == 1.0:
+        return payload
+    if isinstance(payload, dict):
+        return {
+            key: value * factor
+            if key in ("x", "y", "width", "height") and isinstance(value, (int, float))
+            else rescale_geometry(value, factor)
+            for key, value in payload.items()
+        }
+    if isinstance(payload, list):
+        return [rescale_geometry(value, factor) for value in payload]
+    return payload
+
+
 def check_image_integrity(img: Path) -> bool:
+    # A 1/8 resolution decode still reads the whole file
     try:
-        return cv2.imread(img) is not None
+        return cv2.imread(str(img), cv2.IMREAD_REDUCED_GRAYSCALE_8) is not None
     except:
         return False
 
 
-def select_best_image(images: List[Image], return_path=False) -> Optional[Image]:
+def select_best_image(
+    images: List[Image], return_path=False, scorer: Optional[QualityScorer] = None
+) -> Optional[Image]:
 
     logger = logging.getLogger("image")
 
@@ -51,7 +282,8 @@ def select_best_image(images: List[Image], return_path=False) -> Optional[Image]
         logger.info("No images to select from.")
         return None
 
-    idx = np.argmax([compute_psnr(image.original, image.image) for image in images])
+    # Scores all the frames in one batch, on downscaled luma (PSNR only by default)
+    idx = int(np.argmax((scorer or QualityScorer()).score(images)))
 
     if return_path:
         return images[idx], images[idx].path
@@ -60,13 +292,9 @@ def select_best_image(images: List[Image], return_path=False) -> Optional[Image]
 
 
 def compute_psnr(image1: np.ndarray, image2: np.ndarray) -> float:
-    # Convert images from RGB to YCbCr
-    image1_ycbcr = cv2.cvtColor(image1, cv2.COLOR_RGB2YCrCb)
-    image2_ycbcr = cv2.cvtColor(image2, cv2.COLOR_RGB2YCrCb)
-
-    # Use only the Y (luminance) channel for PSNR computation
-    y1 = image1_ycbcr[:, :, 0]
-    y2 = image2_ycbcr[:, :, 0]
+    # Use only the Y (luminance) channel of the BGR frames, in float so that differences do not wrap around
+    y1 = image1 @ LUMA_WEIGHTS
+    y2 = image2 @ LUMA_WEIGHTS
 
     # Compute Mean Squared Error (MSE) on the Y channel
     mse = ((y1 - y2) ** 2).mean()
@@ -0,0 +1,254 @@
+"""
+    FrameLoader reads the frames of an image folder: files are validated from their headers, decoded once on a
+    thread pool, optionally at reduced resolution, and yielded in sorted order.
+"""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Iterator, List, Optional, Tuple, Union
+import logging
+import os
+import struct
+
+import cv2
+
+from errors import InputError
+from image import Image, check_image_integrity
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tiff"}
+VALIDATIONS = ("header", "decode", "none")
+REDUCTIONS = (1, 2, 4, 8)
+
+JPEG_SOI = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"IEND\xaeB`\x82"
+OTHER_SIGNATURES = (b"BM", b"II*\x00", b"MM\x00*")
+
+# Bytes at the end of a file searched for its end marker, which may be followed by padding
+TRAILER_BYTES = 1024
+
+# JPEG decodes directly at 1/2, 1/4 and 1/8 of the resolution; other formats are resized after decoding
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def check_header(path: Path) -> bool:
+    """
+    Checks the signature of an image file and, for JPEG and PNG, that it ends
+    with an end marker, which catches truncated files without decoding them.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(len(PNG_SIGNATURE))
+            if head.startswith(JPEG_SOI):
+                marker = JPEG_EOI
+            elif head.startswith(PNG_SIGNATURE):
+                marker = PNG_IEND
+            else:
+                return head.startswith(OTHER_SIGNATURES)
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - TRAILER_BYTES))
+            return marker in f.read()
+    except OSError:
+        return False
+
+
+def _jpeg_size(f) -> Optional[Tuple[int, int]]:
+    # Walks the marker segments up to the first start of frame
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if byte != b"\xff":
+            return None
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        if marker in (0xD9, 0xDA):
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack(">xHH", data)
+            return width, height
+        f.seek(struct.unpack(">H", length)[0] - 2, os.SEEK_CUR)
+
+
+def read_image_size(path: Path) -> Optional[Tuple[int, int]]:
+    """
+    Reads the (width, height) of a JPEG or PNG file from its header, None for
+    other formats or malformed headers. The EXIF orientation is not applied.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(24)
+            if head.startswith(PNG_SIGNATURE) and head[12:16] == b"IHDR":
+                return struct.unpack(">II", head[16:24])
+            if head.startswith(JPEG_SOI):
+                return _jpeg_size(f)
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def validate_image(path: Path, validation: str = "header") -> bool:
+    if validation == "header":
+        return check_header(path)
+    if validation == "decode":
+        return check_image_integrity(path)
+    return True
+
+
+def list_image_paths(
+    input_folder: Path, validation: str = "header", workers: Optional[int] = None
+) -> List[Path]:
+    """
+    Lists the image files of a folder in sorted order, without the files that
+    fail validation.
+    """
+    if validation not in VALIDATIONS:
+        raise InputError(f"Unknown image validation: {validation}")
+
+    candidates = sorted(
+        p for p in Path(input_folder).iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS
+    )
+    if validation == "header":
+        valid = [check_header(path) for path in candidates]
+    else:
+        # Reduced decodes release the GIL
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            valid = list(executor.map(lambda path: validate_image(path, validation), candidates))
+
+    image_paths = [path for path, ok in zip(candidates, valid) if ok]
+    if len(image_paths) < len(candidates):
+        logging.warning(
+            f"Skipped {len(candidates) - len(image_paths)} invalid image files in {input_folder}"
+        )
+    if not image_paths:
+        raise InputError(f"No images found in {input_folder}")
+    return image_paths
+
+
+class FrameLoader:
+    """
+    Iterable over the frames of an image folder, in sorted order.
+
+    Every file is decoded once, on a pool of threads (OpenCV releases the GIL
+    while decoding), at most `prefetch` frames ahead of the consumer. The
+    decoded frame is both the `image` and the `original` of its Image.
+
+    With a `reduction` above 1, frames are decoded at that fraction of their
+    resolution, JPEG directly by the decoder, and their `scale` is set as for
+    proxies. With `reduction="auto"`, every frame is decoded at the largest
+    reduction that keeps its longest side at least `max_dimension`.
+
+    Args:
+        input_folder (Path): Folder of the frames.
+        workers (Optional[int]): Number of decoding threads, defaults to the number of CPUs.
+        validation (str): One of VALIDATIONS: signature and end marker, decode at 1/8 resolution, or none.
+        reduction (Union[int, str]): One of REDUCTIONS, or "auto".
+        max_dimension (Optional[int]): Smallest longest side of the decoded frames, with reduction "auto".
+        prefetch (Optional[int]): Maximum number of frames decoded ahead, twice the workers by default.
+    """
+
+    def __init__(
+        self,
+        input_folder: Path,
+        workers: Optional[int] = None,
+        validation: str = "header",
+        reduction: Union[int, str] = 1,
+        max_dimension: Optional[int] = None,
+        prefetch: Optional[int] = None,
+    ):
+        if reduction == "auto":
+            if max_dimension is None:
+                raise InputError("Automatic decode reduction requires a maximum dimension")
+        elif reduction not in REDUCTIONS:
+            raise InputError(f"Unsupported decode reduction: {reduction}")
+        if validation not in VALIDATIONS:
+            raise InputError(f"Unknown image validation: {validation}")
+
+        self.input_folder = Path(input_folder)
+        self.workers = workers or os.cpu_count() or 1
+        self.validation = validation
+        self.reduction = reduction
+        self.max_dimension = max_dimension
+        self.prefetch = prefetch or 2 * self.workers
+        # Last frame before the first one loaded, see resume_after
+        self.start_after: Optional[Path] = None
+
+    def resume_after(self, path: Path) -> None:
+        # Starts the next iterations after the frame of `path`, without decoding the frames before it
+        self.start_after = Path(path)
+
+    def _reduction(self, size: Optional[Tuple[int, int]]) -> int:
+        if self.reduction != "auto":
+            return self.reduction
+        if size is None:
+            return 1
+        return max(r for r in REDUCTIONS if max(size) / r >= self.max_dimension or r == 1)
+
+    def load(self, path: Path) -> Optional[Image]:
+        try:
+            size = read_image_size(path) if self.reduction != 1 else None
+            reduction = self._reduction(size)
+            frame = cv2.imread(str(path), REDUCED_FLAGS[reduction])
+            if frame is None:
+                logging.error(f"Error loading image {path}: cannot decode")
+                return None
+
+            scale = 1.0
+            if reduction > 1:
+                # The orientation may swap the sides, not the longest one
+                scale = max(frame.shape[:2]) / max(size) if size else 1.0 / reduction
+            return Image(image=frame, original=frame, path=path, scale=scale)
+        except Exception as e:
+            logging.error(f"Error loading image {path}: {str(e)}")
+            return None
+
+    def __iter__(self) -> Iterator[Image]:
+        paths = list_image_paths(self.input_folder, self.validation, self.workers)
+        if self.start_after is not None:
+            names = [path.name for path in paths]
+            if self.start_after.name not in names:
+                raise InputError(f"Cannot resume after {self.start_after}: not a frame of {self.input_folder}")
+            paths = paths[names.index(self.start_after.name) + 1 :]
+        paths = iter(paths)
+        pending: Deque[Future] = deque()
+        loaded = 0
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for path in paths:
+                pending.append(executor.submit(self.load, path))
+                if len(pending) >= self.prefetch:
+                    break
+            while pending:
+                image = pending.popleft().result()
+                path = next(paths, None)
+                if path is not None:
+                    pending.append(executor.submit(self.load, path))
+                if image is not None:
+                    loaded += 1
+                    yield image
+        finally:
+            # A consumer that stops early does not wait for the frames decoded ahead
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        if not loaded:
+            raise InputError(f"No valid images found in {self.input_folder}")
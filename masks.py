@@ -0,0 +1,188 @@
+"""
+    Compact segmentation masks: the polygons of the segmentation results are rasterized on a small grid over their
+    bounding box and bit-packed, so that every frame can keep its masks and the downstream steps can restrict their
+    work to the region of the object.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence
+import base64
+
+import cv2
+import numpy as np
+
+# Longest side of the grid a mask is rasterized on
+MAX_MASK_SIDE = 128
+
+
+class Mask:
+    """
+    A segmentation mask: its bounding `box` (x1, y1, x2, y2) in full-resolution
+    coordinates and the bits of a grid of `shape` (height, width) covering the
+    box, packed 8 per byte. A 128 x 128 grid takes 2 KiB, whatever the
+    number of points of the polygon it was drawn from.
+
+    Args:
+        box (Sequence[float]): Bounding box of the mask, in full-resolution coordinates.
+        shape (Sequence[int]): Height and width of the grid.
+        bits (np.ndarray): Packed bits of the grid, row by row.
+        label (Optional[str]): Class of the segmented object.
+        confidence (Optional[float]): Confidence of the segmentation.
+    """
+
+    __slots__ = ("box", "shape", "bits", "label", "confidence")
+
+    def __init__(
+        self,
+        box: Sequence[float],
+        shape: Sequence[int],
+        bits: np.ndarray,
+        label: Optional[str] = None,
+        confidence: Optional[float] = None,
+    ):
+        self.box = [float(value) for value in box]
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.bits = bits
+        self.label = label
+        self.confidence = confidence
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __repr__(self) -> str:
+        return f"Mask(label={self.label}, box={[round(value, 1) for value in self.box]}, shape={self.shape})"
+
+    @staticmethod
+    def from_polygon(
+        points: np.ndarray,
+        label: Optional[str] = None,
+        confidence: Optional[float] = None,
+        max_side: int = MAX_MASK_SIDE,
+    ) -> Optional["Mask"]:
+        """
+        Rasterizes a polygon, an array of (x, y) points in full-resolution
+        coordinates. Returns None for polygons of less than 3 points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) < 3:
+            return None
+        x1, y1 = points.min(axis=0)
+        x2, y2 = points.max(axis=0)
+        # Every cell covers factor x factor pixels
+        factor = max(1.0, max(x2 - x1, y2 - y1) / max_side)
+        shape = (
+            max(1, int(np.ceil((y2 - y1) / factor))),
+            max(1, int(np.ceil((x2 - x1) / factor))),
+        )
+        grid = np.zeros(shape, dtype=np.uint8)
+        # Polygon in cell coordinates, where cell centers are integers, with 4 bits of subpixel precision
+        cells = ((points - (x1, y1)) / factor - 0.5) * 16
+        cv2.fillPoly(grid, [np.round(cells).astype(np.int32)], 1, shift=4)
+        box = (x1, y1, x1 + shape[1] * factor, y1 + shape[0] * factor)
+        return Mask(box, shape, np.packbits(grid), label, confidence)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    @property
+    def area(self) -> float:
+        # Area of the mask, in full-resolution pixels
+        x1, y1, x2, y2 = self.box
+        return (x2 - x1) * (y2 - y1) * self.to_array().mean()
+
+    def to_array(self) -> np.ndarray:
+        # Boolean grid of `shape`
+        h, w = self.shape
+        return np.unpackbits(self.bits, count=h * w).reshape(h, w).astype(bool)
+
+    def scaled_box(self, scale: float = 1.0) -> List[float]:
+        # Bounding box in the coordinates of a frame `scale` times the full resolution
+        return [value * scale for value in self.box]
+
+    def rasterize(self, region: Sequence[float], size: Sequence[int], scale: float = 1.0) -> np.ndarray:
+        """
+        Draws the mask over a `region` (x1, y1, x2, y2) of a frame `scale` times
+        the full resolution, resampled to `size` (width, height). Returns a
+        boolean array of shape (height, width), False outside the mask.
+        """
+        width, height = int(size[0]), int(size[1])
+        rx1, ry1, rx2, ry2 = region
+        sx, sy = width / max(rx2 - rx1, 1e-6), height / max(ry2 - ry1, 1e-6)
+        x1, y1, x2, y2 = self.scaled_box(scale)
+        h, w = self.shape
+        # Grid cells to output pixels, both with their centers at integer coordinates
+        ax, ay = (x2 - x1) / w * sx, (y2 - y1) / h * sy
+        transform = np.array(
+            [
+                [ax, 0.0, (x1 - rx1) * sx + (ax - 1) / 2],
+                [0.0, ay, (y1 - ry1) * sy + (ay - 1) / 2],
+            ]
+        )
+        # Bilinear resampling and a threshold at half smooth the edges of upscaled grids
+        grid = self.to_array().astype(np.uint8) * 255
+        inside = cv2.warpAffine(grid, transform, (width, height), flags=cv2.INTER_LINEAR, borderValue=0)
+        return inside >= 128
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "box": self.box,
+            "shape": list(self.shape),
+            "bits": base64.b64encode(self.bits.tobytes()).decode("ascii"),
+            "label": self.label,
+            "confidence": self.confidence,
+        }
+
+    @staticmethod
+    def from_dict(record: Dict[str, Any]) -> "Mask":
+        return Mask(
+            box=record["box"],
+            shape=record["shape"],
+            bits=np.frombuffer(base64.b64decode(record["bits"]), dtype=np.uint8),
+            label=record.get("label"),
+            confidence=record.get("confidence"),
+        )
+
+
+def decode_masks(segmentation: Dict[str, Any], max_side: int = MAX_MASK_SIDE) -> List[Mask]:
+    """
+    Rasterizes the polygons of the `predictions` of a segmentation result, in
+    full-resolution coordinates. Predictions without points are skipped.
+    """
+    masks = []
+    for prediction in (segmentation or {}).get("predictions", []) or []:
+        points = prediction.get("points") if isinstance(prediction, dict) else None
+        if not points:
+            continue
+        mask = Mask.from_polygon(
+            [(point["x"], point["y"]) for point in points],
+            label=prediction.get("class"),
+            confidence=prediction.get("confidence"),
+            max_side=max_side,
+        )
+        if mask is not None:
+            masks.append(mask)
+    return masks
+
+
+def strip_polygons(segmentation: Dict[str, Any]) -> Dict[str, Any]:
+    # Copy of a segmentation result without the points of its predictions, once they are decoded to masks
+    predictions = (segmentation or {}).get("predictions")
+    if not isinstance(predictions, list):
+        return segmentation
+    return dict(
+        segmentation,
+        predictions=[
+            {key: value for key, value in prediction.items() if key != "points"}
+            if isinstance(prediction, dict)
+            else prediction
+            for prediction in predictions
+        ],
+    )
+
+
+def largest_mask(masks: Sequence[Mask]) -> Optional[Mask]:
+    return max(masks, key=lambda mask: mask.area, default=None)
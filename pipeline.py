@@ -10,29 +10,51 @@ import os
 import sys
 import click
 import logging
-from typing import List
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Iterable, Iterator, Optional
 from pathlib import Path
 from dotenv import load_dotenv
 import cv2
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import tqdm
 from inference_sdk import InferenceHTTPClient
 
-from image import Image
+from image import Image, FrameMemory, release_originals, LAZY_ORIGINALS
 from artifact import Artifact
 from errors import *
 from utility import (
     load_prompts,
-    save_results,
-    load_frames,
-    extract_frames_from_video,
+    save_artifact,
+)
+from video import VideoSource, DUMP_FORMATS, MOTION_METRICS
+from loader import FrameLoader, VALIDATIONS, REDUCTIONS
+from preprocessing import (
+    preprocess_images_stream,
+    BACKENDS,
+    CORRECTIONS,
+    TemporalCorrector,
 )
-from preprocessing import preprocess_images_parallel
 from processing import (
-    detect_and_segmentation_workflow,
+    detect_and_segmentation_stream,
     frame_selection,
-    generate_frame_description,
+    frame_selection_stream,
 )
-from reconstruction import reconstruct_image
+from captioning import CaptioningEngine, RateLimiter, create_captioning_client, DEFAULT_MODEL
+from proxy import make_proxies, promote_artifact, promote_artifacts
+from reconstruction import ViewSelector, prepare_reconstruction
+from workflow_client import PooledWorkflowClient
+from detection import BACKENDS as DETECTION_BACKENDS, DetectionBackend, OnnxBackend, RoboflowBackend
+from cache import ResultCache
+from quality import QualityScorer, parse_weights, METRICS as QUALITY_METRICS, ROI_MODES
+from grouping import ArtifactGrouper, GROUPINGS
+from dedup import FrameDeduplicator, MAX_RUN as DEDUP_MAX_RUN, METRICS as DEDUP_METRICS, MODES as DEDUP_MODES
+from encoding import PayloadEncoder, FORMATS
+from checkpoint import RunCheckpoint
+from archive import OUTPUT_FORMATS, PIXEL_FORMATS
+from profiling import Profiler
+from scheduler import Scheduler, Stage, run_chain
 
 
 # Configure logging
@@ -41,6 +63,314 @@ logging.basicConfig(
 )
 logger = logging.getLogger("multimodal_pipeline")
 
+# Options that change the outputs: a checkpointed run can only be resumed with the same values
+CHECKPOINT_OPTIONS = (
+    "input_path",
+    "prompt_dir",
+    "is_video",
+    "sample_rate",
+    "keyframe_budget",
+    "keyframe_motion",
+    "correction",
+    "temporal_interval",
+    "temporal_smoothing",
+    "proxy_size",
+    "decode_reduction",
+    "detection_backend",
+    "onnx_model",
+    "onnx_input_size",
+    "onnx_classes",
+    "detection_confidence",
+    "dedup",
+    "dedup_metric",
+    "dedup_threshold",
+    "dedup_max_run",
+    "quality_metrics",
+    "quality_roi",
+    "keep_frames",
+    "grouping",
+    "track_iou",
+    "group_gap",
+    "caption_model",
+    "upload_format",
+    "upload_quality",
+    "upload_budget_kb",
+    "detection_upload_size",
+    "caption_upload_size",
+    "caption_crop_margin",
+    "caption_mask_background",
+    "output_format",
+    "archive_pixels",
+    "save_crop_margin",
+)
+
+
+def run_streaming(
+    detector,
+    frames: Iterable[Image],
+    prompts: dict,
+    output_dir: Path,
+    chunk_size: int,
+    backend: str = "thread",
+    workers: Optional[int] = None,
+    correction: str = "fused",
+    corrector: Optional[TemporalCorrector] = None,
+    detection_options: Optional[dict] = None,
+    captioning_engine: Optional[CaptioningEngine] = None,
+    deduplicator: Optional[FrameDeduplicator] = None,
+    quality_scorer: Optional[QualityScorer] = None,
+    keep_frames: bool = True,
+    grouper: Optional[ArtifactGrouper] = None,
+    save_options: Optional[dict] = None,
+    reconstruction_options: Optional[dict] = None,
+    lazy_originals: Optional[str] = None,
+    profiler: Optional[Profiler] = None,
+    pipelined: bool = False,
+    queue_size: int = 8,
+) -> int:
+    """
+    Runs the pipeline stages as a chain of generators: frames are preprocessed
+    and sent to the workflow in chunks of `chunk_size`, and every artifact is
+    captioned and saved as soon as its group of frames is complete. With
+    `reconstruction_options`, the reconstruction dataset of every artifact is
+    written as well (see reconstruction.prepare_reconstruction). With a
+    `profiler`, every stage is timed as the items it yields.
+
+    With `pipelined`, the stages run concurrently on their own threads,
+    connected by queues of `queue_size` items (see scheduler.Scheduler), so
+    that preprocessing overlaps with the detection and captioning requests.
+
+    Returns the number of saved artifacts.
+    """
+    if captioning_engine is None:
+        captioning_engine = CaptioningEngine(
+            create_captioning_client(), prompts.get("CAPTIONING_PROMPT", "")
+        )
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    memory = FrameMemory()
+
+    def preprocess(frames: Iterable[Image]) -> Iterable[Image]:
+        frames = preprocess_images_stream(
+            frames,
+            chunk_size=chunk_size,
+            backend=backend,
+            workers=workers,
+            correction=correction,
+            corrector=corrector,
+        )
+        return release_originals(frames, lazy_originals, memory)
+
+    def detect(frames: Iterable[Image]) -> Iterable[Image]:
+        return detect_and_segmentation_stream(
+            detector, frames, prompts.get("DETECTION_PROMPT", ""), **(detection_options or {})
+        )
+
+    def select(frames: Iterable[Image]) -> Iterable[Artifact]:
+        if deduplicator is not None:
+            frames = deduplicator.expand(frames)
+        if grouper is not None:
+            return grouper.stream(frames)
+        return frame_selection_stream(frames, quality_scorer, keep_frames)
+
+    def caption(artifacts: Iterable[Artifact]) -> Iterable[tuple]:
+        # Numbers the artifacts in order, before they are saved concurrently
+        return enumerate(captioning_engine.caption_stream(artifacts))
+
+    def save(item: tuple) -> Artifact:
+        index, artifact = item
+        save_artifact(artifact, output_dir, index, **(save_options or {}))
+        return artifact
+
+    def reconstruct(artifact: Artifact) -> Artifact:
+        prepare_reconstruction(artifact, output_dir / "reconstruction", **reconstruction_options)
+        return artifact
+
+    stages = [Stage("preprocess", transform=preprocess)]
+    if deduplicator is not None:
+        stages.append(Stage("dedup", transform=deduplicator.filter))
+    stages += [
+        Stage("detect", transform=detect),
+        Stage("select", transform=select),
+        Stage("promote", function=lambda artifact: promote_artifact(artifact, correction)),
+        Stage("caption", transform=caption),
+    ]
+
+    if pipelined:
+        # Promotion and saving are independent per artifact, and get a pool of their own
+        pool_size = workers or os.cpu_count() or 1
+        stages[-2].workers = pool_size
+        stages.append(Stage("save", function=save, workers=pool_size))
+        if reconstruction_options is not None:
+            stages.append(Stage("reconstruct", function=reconstruct, workers=pool_size))
+        scheduler = Scheduler(queue_size, profiler)
+        artifacts = scheduler.run(frames, stages)
+    else:
+        stages.append(Stage("save", function=save))
+        if reconstruction_options is not None:
+            stages.append(Stage("reconstruct", function=reconstruct))
+        scheduler = None
+        artifacts = run_chain(frames, stages, profiler)
+
+    saved = 0
+    for artifact in artifacts:
+        saved += 1
+        logger.info(f"Artifact finalized: {repr(artifact)}")
+
+    if scheduler is not None:
+        scheduler.log_summary(logger)
+    logger.info(f"Frame memory after preprocessing: {memory}")
+    return saved
+
+
+# Options of the clients, encoders, caches and profiler, which all the runs of a batch share (see batch.py)
+SERVICE_OPTIONS = (
+    "detection_backend",
+    "detection_retries",
+    "onnx_model",
+    "onnx_input_size",
+    "onnx_classes",
+    "onnx_threads",
+    "detection_confidence",
+    "detection_concurrency",
+    "cache_dir",
+    "cache_size_mb",
+    "caption_rpm",
+    "upload_format",
+    "upload_quality",
+    "upload_budget_kb",
+    "detection_upload_size",
+    "caption_upload_size",
+    "caption_crop_margin",
+    "caption_mask_background",
+    "profile",
+)
+
+
+@dataclass
+class RunStats:
+    frames: int = 0
+    artifacts: int = 0
+    seconds: float = 0.0
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.seconds if self.seconds else 0.0
+
+    def count(self, frames: Iterable[Image]) -> Iterator[Image]:
+        for frame in frames:
+            self.frames += 1
+            yield frame
+
+
+@dataclass
+class Services:
+    """
+    The detection backend, captioning client, upload encoders, result caches
+    and profiler of a process. Runs that share them reuse their connection pools, caches and
+    captioning rate limit, and the prompts of their prompt folders.
+    """
+
+    detector: DetectionBackend
+    captioning_client: Any
+    detection_encoder: PayloadEncoder
+    caption_encoder: PayloadEncoder
+    rate_limiter: RateLimiter
+    profiler: Profiler
+    detection_cache: Optional[ResultCache] = None
+    caption_cache: Optional[ResultCache] = None
+    prompts: Dict[Path, dict] = field(default_factory=dict)
+
+    def load_prompts(self, prompt_dir: Path) -> dict:
+        prompt_dir = Path(prompt_dir).resolve()
+        if prompt_dir not in self.prompts:
+            self.prompts[prompt_dir] = load_prompts(prompt_dir)
+        return self.prompts[prompt_dir]
+
+    def close(self) -> None:
+        logger.info(f"Detection uploads: {self.detection_encoder.stats}")
+        logger.info(f"Captioning uploads: {self.caption_encoder.stats}")
+        for cache in (self.detection_cache, self.caption_cache):
+            if cache is not None:
+                cache.close()
+        self.detector.close()
+
+    def save_profile(self, output_dir: Path) -> None:
+        if self.profiler.enabled:
+            self.profiler.log_summary(logger)
+            self.profiler.save_report(output_dir / "profile.json")
+            self.profiler.save_trace(output_dir / "profile.trace.json")
+
+
+def create_services(options: dict) -> Services:
+    """
+    Creates the services from the SERVICE_OPTIONS in `options`, the parameters
+    of the command line.
+    """
+    profiler = Profiler(enabled=options["profile"])
+    if options["detection_backend"] == "onnx":
+        if not options["onnx_model"]:
+            raise InputError("--detection-backend onnx requires --onnx-model")
+        detector = OnnxBackend(
+            options["onnx_model"],
+            input_size=options["onnx_input_size"],
+            confidence=options["detection_confidence"],
+            class_names=options["onnx_classes"].split(",") if options["onnx_classes"] else None,
+            threads=options["onnx_threads"],
+        )
+        detector = profiler.instrument(detector, "infer", "onnx")
+    else:
+        if options["detection_concurrency"] > 1:
+            # Concurrent requests share the connections of a pooled session
+            client = PooledWorkflowClient(
+                api_url=os.getenv("ROBOFLOW_API_URL", "http://localhost:9001"),
+                api_key=os.getenv("ROBOFLOW_API_KEY", ""),
+                pool_size=options["detection_concurrency"],
+            )
+        else:
+            client = InferenceHTTPClient(
+                api_url=os.getenv("ROBOFLOW_API_URL", "http://localhost:9001"),
+                api_key=os.getenv("ROBOFLOW_API_KEY", ""),
+            )
+        client = profiler.instrument(client, "run_workflow", "roboflow")
+        detector = RoboflowBackend(client, retries=options["detection_retries"])
+        logger.debug("Inference client created")
+    upload_budget = options["upload_budget_kb"] * 1024 if options["upload_budget_kb"] else None
+    services = Services(
+        detector=detector,
+        captioning_client=profiler.instrument(create_captioning_client(), "responses.create", "openai"),
+        detection_encoder=PayloadEncoder(
+            max_dimension=options["detection_upload_size"],
+            format=options["upload_format"],
+            quality=options["upload_quality"],
+            byte_budget=upload_budget,
+        ),
+        caption_encoder=PayloadEncoder(
+            max_dimension=options["caption_upload_size"],
+            format=options["upload_format"],
+            quality=options["upload_quality"],
+            roi_margin=options["caption_crop_margin"],
+            byte_budget=upload_budget,
+            mask_background=options["caption_mask_background"],
+        ),
+        rate_limiter=RateLimiter(options["caption_rpm"]),
+        profiler=profiler,
+    )
+    if options["cache_dir"]:
+        cache_dir = Path(options["cache_dir"])
+        services.detection_cache = ResultCache(
+            cache_dir / "detections.sqlite",
+            max_bytes=options["cache_size_mb"] * 2**20,
+            namespace="detections",
+        )
+        services.caption_cache = ResultCache(
+            cache_dir / "captions.sqlite",
+            max_bytes=options["cache_size_mb"] * 2**20,
+            namespace="captions",
+        )
+    return services
+
 
 @click.command()
 @click.option(
@@ -75,81 +405,732 @@ logger = logging.getLogger("multimodal_pipeline")
     type=int,
     help="If input is video, extract every nth frame",
 )
-def main(
+@click.option(
+    "--dump-frames",
+    default=None,
+    type=click.Choice(DUMP_FORMATS),
+    help="If input is video, also write the sampled frames to <output>/frames in this format",
+)
+@click.option(
+    "--decode-thread/--no-decode-thread",
+    default=False,
+    help="If input is video, decode frames on a background thread",
+)
+@click.option(
+    "--seek-threshold",
+    default=None,
+    type=click.IntRange(min=1),
+    help="If input is video, seek instead of grabbing when at least this many frames are skipped",
+)
+@click.option(
+    "--keyframe-budget",
+    default=None,
+    type=click.IntRange(min=1),
+    help="If input is video, keep about this many keyframes, chosen on motion, sharpness and exposure among every nth frame",
+)
+@click.option(
+    "--keyframe-motion",
+    default="diff",
+    type=click.Choice(MOTION_METRICS),
+    help="Motion signal of the keyframe selection: thumbnail difference, or optical flow magnitude",
+)
+@click.option(
+    "--load-workers",
+    default=None,
+    type=click.IntRange(min=1),
+    help="If input is a folder, number of threads decoding the frames, defaults to the number of CPUs",
+)
+@click.option(
+    "--image-validation",
+    default="header",
+    type=click.Choice(VALIDATIONS),
+    help="If input is a folder, skip files with a bad signature or end marker, that fail a 1/8 resolution decode, or none",
+)
+@click.option(
+    "--decode-reduction",
+    default="1",
+    type=click.Choice([str(r) for r in REDUCTIONS] + ["auto"]),
+    help="If input is a folder, decode frames at 1/n resolution; auto picks the largest reduction above --proxy-size",
+)
+@click.option(
+    "--streaming/--no-streaming",
+    default=False,
+    help="Stream frames through the stages in bounded chunks instead of loading the whole input",
+)
+@click.option(
+    "--pipelined/--no-pipelined",
+    default=False,
+    help="Run the streaming stages concurrently, connected by bounded queues (implies --streaming)",
+)
+@click.option(
+    "--queue-size",
+    default=8,
+    type=click.IntRange(min=1),
+    help="With --pipelined, number of items buffered between two stages",
+)
+@click.option(
+    "--chunk-size",
+    default=16,
+    type=click.IntRange(min=1),
+    help="Number of frames processed together (streaming chunks, process-pool batches)",
+)
+@click.option(
+    "--preprocessing-backend",
+    default="thread",
+    type=click.Choice(BACKENDS),
+    help="Run the preprocessing on a thread pool or on a process pool with shared memory frames",
+)
+@click.option(
+    "--workers",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Number of preprocessing workers, defaults to the number of CPUs",
+)
+@click.option(
+    "--correction",
+    default="fused",
+    type=click.Choice(list(CORRECTIONS)),
+    help="Underwater correction: the fused single-pass kernel, the reference implementation, or the fused kernel with white balance parameters estimated over time",
+)
+@click.option(
+    "--temporal-interval",
+    default=15,
+    type=click.IntRange(min=1),
+    help="With --correction temporal, frames between two estimations of the white balance, which scene changes also trigger",
+)
+@click.option(
+    "--temporal-smoothing",
+    default=0.3,
+    type=click.FloatRange(min=0, max=1, min_open=True),
+    help="With --correction temporal, weight of a new white balance estimation against the previous ones (1 disables smoothing)",
+)
+@click.option(
+    "--proxy-size",
+    default=None,
+    type=click.IntRange(min=64),
+    help="Run detection, grouping and scoring on proxies with this longest side; only best images are corrected at full resolution",
+)
+@click.option(
+    "--detection-concurrency",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Maximum number of Roboflow workflow requests in flight",
+)
+@click.option(
+    "--detection-batch-size",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of images sent in a single workflow request",
+)
+@click.option(
+    "--detection-retries",
+    default=3,
+    type=click.IntRange(min=0),
+    help="Retries of a failed workflow request, with exponential backoff",
+)
+@click.option(
+    "--detection-backend",
+    default="roboflow",
+    type=click.Choice(DETECTION_BACKENDS),
+    help="Detect with the Roboflow workflow, or in-process with an ONNX model (--onnx-model)",
+)
+@click.option(
+    "--onnx-model",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="With --detection-backend onnx, YOLOv8-style detection or segmentation model",
+)
+@click.option(
+    "--onnx-input-size",
+    default=640,
+    type=click.IntRange(min=32),
+    help="With --detection-backend onnx, side of the square input of the model",
+)
+@click.option(
+    "--onnx-classes",
+    default=None,
+    help="With --detection-backend onnx, comma-separated class names, if the model does not store them",
+)
+@click.option(
+    "--onnx-threads",
+    default=None,
+    type=click.IntRange(min=1),
+    help="With --detection-backend onnx, inference threads (default: all cores)",
+)
+@click.option(
+    "--detection-confidence",
+    default=0.25,
+    type=click.FloatRange(min=0, max=1),
+    help="With --detection-backend onnx, minimum score of a detection",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory of the persistent cache of detection results, disabled if not given",
+)
+@click.option(
+    "--cache-size-mb",
+    default=512,
+    type=click.IntRange(min=1),
+    help="Maximum size of each cache, least recently used entries are evicted first",
+)
+@click.option(
+    "--caption-model",
+    default=DEFAULT_MODEL,
+    help="LMM used to caption the artifacts",
+)
+@click.option(
+    "--caption-concurrency",
+    default=4,
+    type=click.IntRange(min=1),
+    help="Maximum number of captioning requests in flight",
+)
+@click.option(
+    "--caption-rpm",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of captioning requests per minute",
+)
+@click.option(
+    "--upload-format",
+    default="jpeg",
+    type=click.Choice(list(FORMATS)),
+    help="Format of the images sent to the workflow and to the captioning model",
+)
+@click.option(
+    "--upload-quality",
+    default=95,
+    type=click.IntRange(min=1, max=100),
+    help="Encoder quality of the uploaded images",
+)
+@click.option(
+    "--upload-budget-kb",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Maximum size of an uploaded image, quality and then size are lowered to fit it",
+)
+@click.option(
+    "--detection-upload-size",
+    default=None,
+    type=click.IntRange(min=32),
+    help="Longest side of the images sent to the workflow, detections are mapped back to the frame",
+)
+@click.option(
+    "--caption-upload-size",
+    default=None,
+    type=click.IntRange(min=32),
+    help="Longest side of the images sent to the captioning model",
+)
+@click.option(
+    "--caption-crop-margin",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Crop captioned images around their object (largest mask, or else largest detection), enlarged by this fraction of its size",
+)
+@click.option(
+    "--caption-mask-background/--no-caption-mask-background",
+    default=False,
+    help="Blank the background outside the mask of the object in captioned images",
+)
+@click.option(
+    "--dedup",
+    default=None,
+    type=click.Choice(DEDUP_MODES),
+    help="Skip the inference of near-duplicate consecutive frames: drop them, or collapse them into the artifact of the previous distinct frame",
+)
+@click.option(
+    "--dedup-metric",
+    default="dhash",
+    type=click.Choice(list(DEDUP_METRICS)),
+    help="Near-duplicate metric: Hamming distance of difference hashes, or mean difference of thumbnails",
+)
+@click.option(
+    "--dedup-threshold",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Largest distance of a near-duplicate (default 4 bits for dhash, 3 gray levels for thumbnail)",
+)
+@click.option(
+    "--dedup-max-run",
+    default=DEDUP_MAX_RUN,
+    type=click.IntRange(min=1),
+    help="With --dedup collapse, most frames collapsed into one distinct frame before the next one is detected again, which bounds the frames held in memory",
+)
+@click.option(
+    "--quality-metrics",
+    default="psnr",
+    help=f"Weighted metrics of the best image selection, e.g. psnr=1,sharpness=0.5 (available: {', '.join(QUALITY_METRICS)})",
+)
+@click.option(
+    "--quality-roi",
+    default=None,
+    type=click.Choice(ROI_MODES),
+    help="Score frames on the region of their object only: its box, or its mask",
+)
+@click.option(
+    "--keep-frames/--best-frame-only",
+    default=True,
+    help="Keep every frame of an artifact, or only its best frame to bound memory",
+)
+@click.option(
+    "--grouping",
+    default="consecutive",
+    type=click.Choice(GROUPINGS),
+    help="Group frames into artifacts by runs of consecutive labels, by label over the whole input, or by tracking detections across frames",
+)
+@click.option(
+    "--track-iou",
+    default=0.3,
+    type=click.FloatRange(min=0, max=1),
+    help="With --grouping track, minimum box overlap of a detection and its track",
+)
+@click.option(
+    "--group-gap",
+    default=None,
+    type=click.IntRange(min=1),
+    help="With --grouping label or track, finalize an artifact after this many frames without it (default: at the end of the input)",
+)
+@click.option(
+    "--checkpoint",
+    "checkpointing",
+    is_flag=True,
+    help="Persist the output of every stage to the run directory, so that a failed run can be resumed",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Resume the run in the run directory, skipping completed stages and items (implies --checkpoint)",
+)
+@click.option(
+    "--run-dir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Run directory of --checkpoint and --resume (default: <output>/run)",
+)
+@click.option(
+    "--output-format",
+    default="pickle",
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Save artifacts as pickles, or as archives with JSON metadata and one file per frame, loaded lazily",
+)
+@click.option(
+    "--archive-pixels",
+    default="png",
+    type=click.Choice(PIXEL_FORMATS),
+    help="Format of the frames of an archive: encoded images, or memory-mappable .npy arrays",
+)
+@click.option(
+    "--save-crop-margin",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Save the best image of every artifact cropped around its object, enlarged by this fraction of its size",
+)
+@click.option(
+    "--reconstruction/--no-reconstruction",
+    default=False,
+    help="Write a reconstruction dataset of selected views for every artifact to <output>/reconstruction",
+)
+@click.option(
+    "--reconstruction-views",
+    default=40,
+    type=click.IntRange(min=3),
+    help="Most views selected per artifact for the reconstruction, fewer if the frames are redundant",
+)
+@click.option(
+    "--reconstruction-size",
+    default=1600,
+    type=click.IntRange(min=64),
+    help="Longest side of the views written for the reconstruction",
+)
+@click.option(
+    "--reconstruction-crop-margin",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Crop the reconstruction views around their object, enlarged by this fraction of its size",
+)
+@click.option(
+    "--lazy-originals",
+    default=None,
+    type=click.Choice(LAZY_ORIGINALS),
+    help="Release the unprocessed frames after preprocessing: reload them from disk when scored, or keep a luma thumbnail",
+)
+@click.option(
+    "--profile/--no-profile",
+    default=False,
+    help="Profile the stages and remote calls, and write <output>/profile.json and <output>/profile.trace.json",
+)
+def main(**options) -> None:
+    load_dotenv()
+    services: Optional[Services] = None
+    try:
+        services = create_services(options)
+        run_pipeline(services, **options)
+    except PipelineError as e:
+        logger.error(f"Pipeline error: {str(e)}")
+        sys.exit(1)
+    except:
+        logger.error(f"Unexpected error: {traceback.format_exc()}")
+        sys.exit(1)
+    finally:
+        if services is not None:
+            services.close()
+            # Also written for failed runs, which are the ones worth profiling
+            services.save_profile(Path(options["output_dir"]))
+
+
+
+def run_pipeline(
+    services: Services,
     input_path: str,
     prompt_dir: str,
     output_dir: str,
     is_video: bool,
     sample_rate: int,
-) -> None:
-    load_dotenv()
-    try:
-        client = InferenceHTTPClient(
-            api_url=os.getenv("ROBOFLOW_API_URL", "http://localhost:9001"),
-            api_key=os.getenv("ROBOFLOW_API_KEY", ""),
+    dump_frames: Optional[str],
+    decode_thread: bool,
+    seek_threshold: Optional[int],
+    keyframe_budget: Optional[int],
+    keyframe_motion: str,
+    load_workers: Optional[int],
+    image_validation: str,
+    decode_reduction: str,
+    streaming: bool,
+    pipelined: bool,
+    queue_size: int,
+    chunk_size: int,
+    preprocessing_backend: str,
+    workers: Optional[int],
+    correction: str,
+    temporal_interval: int,
+    temporal_smoothing: float,
+    proxy_size: Optional[int],
+    detection_concurrency: int,
+    detection_batch_size: int,
+    detection_retries: int,
+    detection_backend: str,
+    onnx_model: Optional[str],
+    onnx_input_size: int,
+    onnx_classes: Optional[str],
+    onnx_threads: Optional[int],
+    detection_confidence: float,
+    cache_dir: Optional[str],
+    cache_size_mb: int,
+    caption_model: str,
+    caption_concurrency: int,
+    caption_rpm: Optional[float],
+    upload_format: str,
+    upload_quality: int,
+    upload_budget_kb: Optional[int],
+    detection_upload_size: Optional[int],
+    caption_upload_size: Optional[int],
+    caption_crop_margin: Optional[float],
+    caption_mask_background: bool,
+    dedup: Optional[str],
+    dedup_metric: str,
+    dedup_threshold: Optional[float],
+    dedup_max_run: int,
+    quality_metrics: str,
+    quality_roi: Optional[str],
+    keep_frames: bool,
+    grouping: str,
+    track_iou: float,
+    group_gap: Optional[int],
+    checkpointing: bool,
+    resume: bool,
+    run_dir: Optional[str],
+    output_format: str,
+    archive_pixels: str,
+    save_crop_margin: Optional[float],
+    reconstruction: bool,
+    reconstruction_views: int,
+    reconstruction_size: int,
+    reconstruction_crop_margin: Optional[float],
+    lazy_originals: Optional[str],
+    profile: bool,
+) -> RunStats:
+    """
+    Runs the pipeline on one input with the given options, which are those of
+    the command line, and the clients, encoders and caches of `services`. The
+    service options are only recorded in the checkpoint: `services` must have
+    been created with the same values.
+
+    Returns the counts and duration of the run.
+    """
+    options = dict(locals())
+    start = time.perf_counter()
+    stats = RunStats()
+    detector = services.detector
+    profiler = services.profiler
+    detection_options = {
+        "max_in_flight": detection_concurrency,
+        "batch_size": detection_batch_size,
+        "encoder": services.detection_encoder,
+    }
+    if services.detection_cache is not None:
+        detection_options["cache"] = services.detection_cache
+    input_path = Path(input_path)
+    prompt_dir = Path(prompt_dir)
+    output_dir = Path(output_dir)
+
+    logger.info("Starting image processing pipeline")
+
+    # 1. Load prompts
+    prompts: dict = services.load_prompts(prompt_dir)
+    logger.info(f"Loaded {len(prompts)} prompts")
+
+    captioning_engine = CaptioningEngine(
+        services.captioning_client,
+        prompts.get("CAPTIONING_PROMPT", ""),
+        model=caption_model,
+        max_concurrency=caption_concurrency,
+        cache=services.caption_cache,
+        encoder=services.caption_encoder,
+        rate_limiter=services.rate_limiter,
+    )
+
+    # 2. Get the frame source: videos are decoded in memory, sampled frames go straight to the pipeline
+    if is_video:
+        frame_source = VideoSource(
+            input_path,
+            sample_rate=sample_rate,
+            dump_dir=output_dir / "frames" if dump_frames else None,
+            dump_format=dump_frames or "png",
+            threaded=decode_thread,
+            seek_threshold=seek_threshold,
+            keyframe_budget=keyframe_budget,
+            motion_metric=keyframe_motion,
         )
-        logger.debug("Inference client created")
-        input_path = Path(input_path)
-        prompt_dir = Path(prompt_dir)
-        output_dir = Path(output_dir)
-
-        logger.info("Starting image processing pipeline")
-
-        # 1. Load prompts
-        prompts: dict = load_prompts(prompt_dir)
-        logger.info(f"Loaded {len(prompts)} prompts")
-
-        # 2. Get image paths
-        if is_video:
-            logger.info("Starting frame extraction...")
-            extract_frames_from_video(input_path, output_dir, sample_rate)
-            logger.info("Frame extraction performed successfully.")
-
-        # 2 Load and Pre-Process images locally
-        logger.info("Starting frame loading...")
-        frames: List[Image] = load_frames(input_path)
-        logger.info("Frame loading performed successfully.")
-        logger.info("Starting frame preprocessing...")
-        frames: List[Image] = preprocess_images_parallel(frames)
+    else:
+        if decode_reduction == "auto" and not proxy_size:
+            raise InputError("--decode-reduction auto requires --proxy-size")
+        # Frames are decoded lazily, a few at a time, on `load_workers` threads
+        frame_source = FrameLoader(
+            input_path,
+            workers=load_workers,
+            validation=image_validation,
+            reduction=decode_reduction if decode_reduction == "auto" else int(decode_reduction),
+            max_dimension=proxy_size,
+        )
+
+    source: Iterable[Image] = profiler.iterate(stats.count(frame_source), "load")
+    if proxy_size:
+        source = profiler.iterate(make_proxies(source, proxy_size), "proxy")
+
+    save_options = {"output_format": output_format, "pixel_format": archive_pixels, "crop_margin": save_crop_margin}
+    quality_scorer = QualityScorer(parse_weights(quality_metrics), roi=quality_roi)
+    grouper = (
+        ArtifactGrouper(grouping, track_iou, group_gap, quality_scorer, keep_frames)
+        if grouping != "consecutive"
+        else None
+    )
+    deduplicator = (
+        FrameDeduplicator(dedup_metric, dedup_threshold, dedup, dedup_max_run) if dedup else None
+    )
+    # Estimates the parameters of the temporal correction across the frames of this run
+    corrector = TemporalCorrector(temporal_interval, temporal_smoothing) if correction == "temporal" else None
+    reconstruction_options = None
+    if reconstruction:
+        if not keep_frames:
+            raise InputError("--reconstruction needs all the frames of the artifacts, not --best-frame-only")
+        reconstruction_options = {
+            "selector": ViewSelector(quality_scorer, max_views=reconstruction_views),
+            "correction": correction,
+            "max_dimension": reconstruction_size,
+            "crop_margin": reconstruction_crop_margin,
+            "workers": workers,
+            # Keeps the datasets of artifacts with the same sanitized name apart
+            "names": set(),
+        }
+
+    if streaming or pipelined:
+        if checkpointing or resume:
+            raise InputError("--checkpoint and --resume require --no-streaming")
+        logger.info(f"Starting {'pipelined' if pipelined else 'streaming'} pipeline...")
+        stats.artifacts = run_streaming(
+            detector,
+            source,
+            prompts,
+            output_dir,
+            chunk_size,
+            backend=preprocessing_backend,
+            workers=workers,
+            correction=correction,
+            corrector=corrector,
+            detection_options=detection_options,
+            captioning_engine=captioning_engine,
+            deduplicator=deduplicator,
+            quality_scorer=quality_scorer,
+            keep_frames=keep_frames,
+            grouper=grouper,
+            save_options=save_options,
+            reconstruction_options=reconstruction_options,
+            lazy_originals=lazy_originals,
+            profiler=profiler,
+            pipelined=pipelined,
+            queue_size=queue_size,
+        )
+        if deduplicator is not None:
+            deduplicator.save_mapping(output_dir / "duplicates.json")
+        logger.info(f"Streaming pipeline completed, {stats.artifacts} artifacts saved.")
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+    checkpoint = RunCheckpoint(
+        (Path(run_dir) if run_dir else output_dir / "run") if checkpointing or resume else None,
+        config={
+            name: str(value) if isinstance(value, Path) else value
+            for name, value in options.items()
+            if name in CHECKPOINT_OPTIONS
+        },
+        resume=resume,
+    )
+
+    # 2 Load and Pre-Process images locally. Originals are released frame by frame,
+    # before the next ones are loaded.
+    memory = FrameMemory()
+    frames: List[Image] = list(
+        release_originals(checkpoint.load_frames(), lazy_originals, memory)
+    )
+    if checkpoint.is_complete("preprocess"):
+        logger.info(f"Loaded {len(frames)} preprocessed frames from the checkpoint.")
+    else:
+        if frames:
+            # A resumed run starts the source after the frames that were already preprocessed,
+            # and the temporal correction from its state after them
+            frame_source.resume_after(frames[-1].path)
+            stats.frames += len(frames)
+            if corrector is not None and not checkpoint.restore_corrector(corrector):
+                logger.warning("The checkpoint has no temporal correction state, the estimation starts over")
+        logger.info("Starting frame loading and preprocessing...")
+        frames += list(
+            release_originals(
+                checkpoint.record_frames(
+                    profiler.iterate(
+                        preprocess_images_stream(
+                            source,
+                            chunk_size=chunk_size,
+                            backend=preprocessing_backend,
+                            workers=workers,
+                            correction=correction,
+                            corrector=corrector,
+                        ),
+                        "preprocess",
+                    ),
+                    start=len(frames),
+                    corrector=corrector,
+                ),
+                lazy_originals,
+                memory,
+            )
+        )
+        if not frames:
+            raise InputError(f"No frames found in {input_path}")
+        checkpoint.complete("preprocess")
         logger.info("Frame preprocessing performed successfully.")
+    logger.info(f"Frame memory after preprocessing: {memory}")
 
-        # 3 Process images with Roboflow workflow
-        logger.info("Starting detect_and_segmentation_workflow...")
-        workflow_results: List[Image] = detect_and_segmentation_workflow(
-            client, frames, prompts.get("DETECTION_PROMPT", "")
+    if deduplicator is not None:
+        frames = list(profiler.iterate(deduplicator.filter(frames), "dedup"))
+
+    # 3 Process images with Roboflow workflow
+    logger.info("Starting detect_and_segmentation_workflow...")
+    detections = checkpoint.load_detections()
+    pending = [index for index in range(len(frames)) if index not in detections]
+    workflow_results: List[Image] = [
+        checkpoint.apply_detection(image, detections[index]) if index in detections else None
+        for index, image in enumerate(frames)
+    ]
+    if pending:
+        detected = detect_and_segmentation_stream(
+            detector,
+            (frames[index] for index in pending),
+            prompts.get("DETECTION_PROMPT", ""),
+            **detection_options,
         )
-        logger.info("detect_and_segmentation_workflow executed successfully.")
+        detected = profiler.iterate(detected, "detect")
+        for index, image in tqdm.tqdm(
+            checkpoint.record_detections(zip(pending, detected)), total=len(pending)
+        ):
+            workflow_results[index] = image
+    checkpoint.complete("detect")
+    logger.info(
+        f"detect_and_segmentation_workflow executed successfully, {len(frames) - len(pending)} frames restored."
+    )
+
+    if deduplicator is not None:
+        workflow_results = list(deduplicator.expand(workflow_results))
+        deduplicator.save_mapping(output_dir / "duplicates.json")
 
-        # 4. Select frames
+    # 4. Select frames
+    if checkpoint.is_complete("select"):
+        artifacts: List[Artifact] = checkpoint.load_artifacts(workflow_results)
+    else:
         logger.info("Starting frame_selection...")
-        artifacts: List[Artifact] = frame_selection(workflow_results)
-        logger.info(
-            f"Artifacts identified: {type(artifacts)}, {len(artifacts)}"
-        )
-        logger.info("frame_selection executed successfully.")
+        with profiler.stage("select", items=len(workflow_results)):
+            if grouper is not None:
+                artifacts: List[Artifact] = grouper.group(workflow_results)
+            else:
+                artifacts: List[Artifact] = frame_selection(
+                    workflow_results, quality_scorer, keep_frames
+                )
+        checkpoint.save_artifacts(artifacts, workflow_results)
+        checkpoint.complete("select")
+    logger.info(
+        f"Artifacts identified: {type(artifacts)}, {len(artifacts)}"
+    )
+    logger.info("frame_selection executed successfully.")
 
-        # 5. Generate frame descriptions
-        logger.info("Starting generate_frame_description...")
-        artifacts: List[Artifact] = generate_frame_description(client, artifacts, prompt=prompts.get("CAPTIONING_PROMPT", ""))
-        logger.info("generate_frame_description executed successfully.")
+    # Proxies and reduced decodes alike: best images at full resolution are left as they are
+    with profiler.stage("promote", items=len(artifacts)):
+        artifacts = promote_artifacts(artifacts, correction)
 
-        # 6. Save results
-        logger.info("Starting save_results...")
-        logger.info([repr(artifact) for artifact in artifacts])
-        save_results(artifacts, output_dir, prompt=prompts.get("CLASSIFICATION_PROMPT", ""))
-        logger.info("save_results executed successfully.")
+    # 5. Generate frame descriptions, only for the artifacts without a checkpointed caption
+    logger.info("Starting generate_frame_description...")
+    captions = checkpoint.load_captions()
+    for index, caption in captions.items():
+        artifacts[index].caption = caption
+    pending = [index for index in range(len(artifacts)) if index not in captions]
+    captioned = profiler.iterate(
+        captioning_engine.caption_stream(artifacts[index] for index in pending), "caption"
+    )
+    for index, artifact in zip(pending, tqdm.tqdm(captioned, total=len(pending))):
+        artifacts[index] = artifact
+        checkpoint.record_caption(index, artifact.caption)
+    checkpoint.complete("caption")
+    logger.info("generate_frame_description executed successfully.")
 
-        # 7. Reconstruction with WaterSplatting technique
-        # TODO: define input arguments for "reconstruct_image" (this will be implemented in new versions, for now it's performed manually).
+    # 6. Save results
+    logger.info("Starting save_results...")
+    logger.info([repr(artifact) for artifact in artifacts])
+    saved = checkpoint.load_saved()
+    # Artifacts are written in parallel, and recorded as they complete
+    with profiler.stage("save", items=len(artifacts) - len(saved)), ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        futures = {
+            executor.submit(save_artifact, artifacts[index], output_dir, index, **save_options): index
+            for index in range(len(artifacts))
+            if index not in saved
+        }
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+            checkpoint.record_saved(futures[future])
+    checkpoint.complete("save")
+    logger.info("save_results executed successfully.")
 
-        logger.info("Pipeline completed.")
+    # 7. Reconstruction datasets for WaterSplatting
+    if reconstruction_options is not None:
+        logger.info("Starting prepare_reconstruction...")
+        with profiler.stage("reconstruct", items=len(artifacts)):
+            for artifact in tqdm.tqdm(artifacts):
+                prepare_reconstruction(artifact, output_dir / "reconstruction", **reconstruction_options)
+        logger.info("prepare_reconstruction executed successfully.")
 
-    except PipelineError as e:
-        logger.error(f"Pipeline error: {str(e)}")
-        sys.exit(1)
-    except:
-        logger.error(f"Unexpected error: {traceback.format_exc()}")
-        sys.exit(1)
+    logger.info("Pipeline completed.")
+    stats.artifacts = len(artifacts)
+    stats.seconds = time.perf_counter() - start
+    return stats
 
 
 if __name__ == "__main__":
@@ -1,21 +1,71 @@
-from concurrent.futures import ThreadPoolExecutor
-from typing import List, Callable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Callable, Iterable, Iterator, Dict, Optional, Tuple
+import logging
+import os
+import time
+
+import numpy as np
+
+from errors import InputError, ProcessingError, PipelineError
 from image import Image
-from preprocessing2 import simple_underwater_correction
+from preprocessing2 import (
+    simple_underwater_correction,
+    fused_underwater_correction,
+    apply_temporal_correction,
+    TemporalCorrector,
+)
+from utility import chunked
+
+BACKENDS = ("thread", "process")
+
+# Bump when the output of the corrections changes, to invalidate cached detections
+PREPROCESSING_VERSION = "1"
+
+CORRECTIONS = {
+    "fused": fused_underwater_correction,
+    "reference": simple_underwater_correction,
+    # Sequences of frames are corrected with parameters estimated over time (see TemporalCorrector),
+    # and a frame without estimated parameters with its own
+    "temporal": fused_underwater_correction,
+}
+
 
+def frame_corrections(
+    images: List[Image], correction: str, corrector: Optional[TemporalCorrector] = None
+) -> List[Callable]:
+    # The correction of every frame of a chunk. Temporal parameters are estimated in frame order.
+    if correction == "temporal" and corrector is not None:
+        for image in images:
+            image.correction_parameters = corrector.estimate(image.image)
+        return [image_correction(image, correction) for image in images]
+    return [CORRECTIONS[correction]] * len(images)
 
-def preprocess_image(image: Image) -> Image:
+
+def image_correction(image: Image, correction: str) -> Callable:
+    # The correction of a frame corrected again, such as a promoted proxy, with the parameters it was first corrected with
+    if correction == "temporal" and image.correction_parameters is not None:
+        return partial(apply_temporal_correction, parameters=image.correction_parameters)
+    return CORRECTIONS[correction]
+
+
+def preprocess_image(
+    image: Image, correction: Callable = fused_underwater_correction
+) -> Image:
     """
     Applies simple underwater correction to the input image.
 
     Args:
         image (Image): Input image to be processed.
+        correction (Callable): Correction function, one of CORRECTIONS.
 
     Returns:
         Image: Processed image with simple underwater correction applied.
     """
     try:
-        image.image = simple_underwater_correction(
+        image.image = correction(
             image.image
         )  # Update the image attribute with the processed image
         return image
@@ -23,20 +73,250 @@ def preprocess_image(image: Image) -> Image:
         raise RuntimeError(f"An error occurred during image preprocessing: {e}")
 
 
+@dataclass
+class WorkerThroughput:
+    """
+    Frames processed by a single worker process and the time spent on them.
+    """
+
+    frames: int = 0
+    seconds: float = 0.0
+    megapixels: float = 0.0
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def megapixels_per_second(self) -> float:
+        return self.megapixels / self.seconds if self.seconds > 0 else 0.0
+
+
+def _correct_shared_frame(
+    name: str, offset: int, shape: Tuple[int, ...], correction: Callable
+) -> Tuple[int, float]:
+    # Runs in the worker process: the frame is read from and written back to the shared block.
+    block = SharedMemory(name=name)
+    try:
+        frame = np.ndarray(shape, dtype=np.uint8, buffer=block.buf, offset=offset)
+        start = time.perf_counter()
+        corrected = correction(frame)
+        if corrected.shape != frame.shape or corrected.dtype != np.uint8:
+            raise ProcessingError(
+                f"Correction changed the frame layout: {frame.shape} -> {corrected.shape}"
+            )
+        frame[...] = corrected
+        elapsed = time.perf_counter() - start
+        del frame
+        return os.getpid(), elapsed
+    finally:
+        block.close()
+
+
+class SharedMemoryPreprocessor:
+    """
+    Process-pool preprocessing backend.
+
+    The frames of each chunk are copied into one shared memory block; workers
+    attach to the block, correct their frame in place and return only their
+    pid and timing, so no pixel data is pickled in either direction.
+
+    Args:
+        workers (Optional[int]): Number of worker processes, defaults to the CPU count.
+        chunk_size (int): Number of frames placed in a shared block at a time.
+        correction (Callable): Picklable function mapping a BGR uint8 frame to its correction.
+        corrector (Optional[TemporalCorrector]): If set, frames get the temporal correction with its parameters instead.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        chunk_size: int = 8,
+        correction: Callable = fused_underwater_correction,
+        corrector: Optional[TemporalCorrector] = None,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.correction = correction
+        self.corrector = corrector
+        self.throughput: Dict[int, WorkerThroughput] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> "SharedMemoryPreprocessor":
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _process_chunk(self, chunk: List[Image]) -> List[Image]:
+        for image in chunk:
+            if image.image is None or image.image.dtype != np.uint8:
+                raise InputError(f"Expected an 8-bit frame for {image.path}")
+
+        offsets = np.cumsum([0] + [image.image.nbytes for image in chunk])
+        block = SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+        try:
+            for image, offset in zip(chunk, offsets):
+                view = np.ndarray(
+                    image.image.shape, dtype=np.uint8, buffer=block.buf, offset=offset
+                )
+                view[...] = image.image
+                del view
+
+            # Only the parameters of temporal corrections are sent, not their lookup tables
+            corrections = (
+                frame_corrections(chunk, "temporal", self.corrector)
+                if self.corrector is not None
+                else [self.correction] * len(chunk)
+            )
+            futures = [
+                self._executor.submit(
+                    _correct_shared_frame,
+                    block.name,
+                    int(offset),
+                    image.image.shape,
+                    correction,
+                )
+                for image, offset, correction in zip(chunk, offsets, corrections)
+            ]
+
+            for image, offset, future in zip(chunk, offsets, futures):
+                pid, elapsed = future.result()
+                view = np.ndarray(
+                    image.image.shape, dtype=np.uint8, buffer=block.buf, offset=offset
+                )
+                stats = self.throughput.setdefault(pid, WorkerThroughput())
+                stats.frames += 1
+                stats.seconds += elapsed
+                stats.megapixels += view.shape[0] * view.shape[1] / 1e6
+                image.image = view.copy()
+                del view
+        finally:
+            block.close()
+            block.unlink()
+
+        return chunk
+
+    def map(self, images: Iterable[Image]) -> Iterator[Image]:
+        if self._executor is None:
+            raise ProcessingError("SharedMemoryPreprocessor used outside of its context")
+
+        for chunk in chunked(images, self.chunk_size):
+            try:
+                yield from self._process_chunk(chunk)
+            except PipelineError:
+                raise
+            except Exception as e:
+                raise ProcessingError(
+                    f"An error occurred during image preprocessing: {e}"
+                )
+
+    def report(self) -> str:
+        return "\n".join(
+            f"worker {pid}: {stats.frames} frames, {stats.fps:.2f} frames/s, "
+            f"{stats.megapixels_per_second:.1f} MP/s"
+            for pid, stats in sorted(self.throughput.items())
+        )
+
+
 def preprocess_images_parallel(
-    images: List[Image], preprocessing: Callable = preprocess_image
+    images: List[Image],
+    preprocessing: Optional[Callable] = None,
+    backend: str = "thread",
+    workers: Optional[int] = None,
+    chunk_size: int = 8,
+    correction: str = "fused",
+    corrector: Optional[TemporalCorrector] = None,
 ) -> List[Image]:
     """
-    Runs the preprocess_image function in parallel using multithreading.
+    Runs the preprocess_image function in parallel, on a thread pool or on a
+    process pool with shared memory frame buffers.
 
     Args:
         images (List[Any]): List of input images to be processed.
+        preprocessing (Optional[Callable]): Function applied to every image by the thread backend, defaults to preprocess_image.
+        backend (str): Either "thread" or "process".
+        workers (Optional[int]): Number of workers, defaults to the executor default.
+        chunk_size (int): Number of frames sent to the process pool at a time.
+        correction (str): Name of the correction in CORRECTIONS.
+        corrector (Optional[TemporalCorrector]): Parameter estimation of the "temporal" correction, with the default settings if None.
 
     Returns:
         List[Any]: List of processed images.
     """
+    return list(
+        preprocess_images_stream(
+            images,
+            chunk_size=chunk_size,
+            preprocessing=preprocessing,
+            backend=backend,
+            workers=workers,
+            correction=correction,
+            corrector=corrector,
+        )
+    )
+
+
+def preprocess_images_stream(
+    images: Iterable[Image],
+    chunk_size: int = 16,
+    preprocessing: Optional[Callable] = None,
+    backend: str = "thread",
+    workers: Optional[int] = None,
+    correction: str = "fused",
+    corrector: Optional[TemporalCorrector] = None,
+) -> Iterator[Image]:
+    """
+    Streaming counterpart of preprocess_images_parallel: the input is consumed
+    in chunks of `chunk_size` images, each chunk is processed in parallel and
+    its images are yielded in input order before the next chunk is read.
+
+    Args:
+        images (Iterable[Image]): Input images, possibly a lazy iterator.
+        chunk_size (int): Maximum number of images held by the stage.
+        preprocessing (Optional[Callable]): Function applied to every image by the thread backend, defaults to preprocess_image.
+        backend (str): Either "thread" or "process".
+        workers (Optional[int]): Number of workers, defaults to the executor default.
+        correction (str): Name of the correction in CORRECTIONS.
+        corrector (Optional[TemporalCorrector]): Parameter estimation of the "temporal" correction, with the default settings if None.
+
+    Returns:
+        Iterator[Image]: Processed images.
+    """
+    if backend not in BACKENDS:
+        raise InputError(f"Unknown preprocessing backend: {backend}")
+    if correction not in CORRECTIONS:
+        raise InputError(f"Unknown correction: {correction}")
+
+    if correction == "temporal" and corrector is None:
+        corrector = TemporalCorrector()
+    elif correction != "temporal":
+        corrector = None
 
-    with ThreadPoolExecutor() as executor:
-        results = executor.map(preprocessing, images)
+    if backend == "process":
+        with SharedMemoryPreprocessor(
+            workers=workers, chunk_size=chunk_size, correction=CORRECTIONS[correction], corrector=corrector
+        ) as engine:
+            yield from engine.map(images)
+        logging.info(f"Preprocessing throughput per worker:\n{engine.report()}")
+        if corrector is not None:
+            logging.info(f"Temporal correction: {corrector.report()}")
+        return
 
-    return list(results)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunked(images, chunk_size):
+            if preprocessing is not None:
+                yield from executor.map(preprocessing, chunk)
+            else:
+                # The parameters are estimated in frame order, the frames are corrected in parallel
+                yield from executor.map(
+                    preprocess_image, chunk, frame_corrections(chunk, correction, corrector)
+                )
+    if corrector is not None and preprocessing is None:
+        logging.info(f"Temporal correction: {corrector.report()}")
@@ -1,4 +1,8 @@
 import os
+import threading
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
 import cv2
 import numpy as np
 from pathlib import Path
@@ -84,3 +88,279 @@ def process_images(input_dir, output_dir):
 
 
 
+
+
+# Documented tolerance of fused_underwater_correction against simple_underwater_correction
+FUSED_MAX_ABS_ERROR = 12
+FUSED_MEAN_ABS_ERROR = 1.0
+# Longest side of the pixel grid fused_underwater_correction checks for out-of-gamut colors
+GAMUT_SAMPLES = 96
+# Fraction of out-of-gamut pixels of the grid above which the LAB -> BGR -> LAB round trip is made
+GAMUT_FRACTION = 0.01
+
+
+class CorrectionWorkspace:
+    """
+    Buffers and CLAHE object reused across calls of fused_underwater_correction.
+    One workspace is kept per thread (and so per worker process).
+    """
+
+    def __init__(self):
+        self.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        self.shape = None
+
+    def ensure(self, shape):
+        if shape == self.shape:
+            return
+        h, w = shape[:2]
+        self.lab = np.empty((h, w, 3), np.uint8)
+        self.bgr = np.empty((h, w, 3), np.uint8)
+        self.l = np.empty((h, w), np.uint8)
+        self.a = np.empty((h, w), np.uint8)
+        self.b = np.empty((h, w), np.uint8)
+        self.index = np.empty((h, w), np.uint16)
+        self.shape = shape
+
+
+_workspaces = threading.local()
+
+# Saturation gain of improve_contrast as a lookup table, built with the same cv2.multiply call.
+SATURATION_LUT = cv2.multiply(np.arange(256, dtype=np.uint8), 1.3).reshape(256)
+
+
+def _workspace():
+    workspace = getattr(_workspaces, "workspace", None)
+    if workspace is None:
+        workspace = _workspaces.workspace = CorrectionWorkspace()
+    return workspace
+
+
+def _white_balance_lut(channel_mean, offset=0):
+    # Output of white_balance for every (L, channel) pair, cast to uint8 as white_balance does.
+    # With an offset, the channel is first shifted by it as cv2.add does.
+    channel = np.minimum(np.arange(256) + offset, 255)
+    shift = (channel_mean - 128) * (np.arange(256) / 255.0) * 1.1
+    shifted = channel[np.newaxis, :] - shift[:, np.newaxis]
+    return shifted.astype(np.uint8).reshape(-1)
+
+
+def _gamut_step(image):
+    # Stride of a grid of at most GAMUT_SAMPLES pixels on the longest side
+    return max(1, -(-max(image.shape[:2]) // GAMUT_SAMPLES))
+
+
+def _out_of_gamut(ws, step):
+    # Fraction of the grid whose LAB color the BGR round trip clips; in-gamut colors move by 1 level at most
+    sample = cv2.merge((ws.l[::step, ::step], ws.a[::step, ::step], ws.b[::step, ::step]))
+    round_trip = cv2.cvtColor(cv2.cvtColor(sample, cv2.COLOR_LAB2BGR), cv2.COLOR_BGR2LAB)
+    moved = cv2.absdiff(sample, round_trip).max(axis=2) > 2
+    return moved.mean()
+
+
+def _round_trip(ws):
+    # LAB -> BGR -> LAB of the workspace channels, clipping them to the BGR gamut as the reference does
+    cv2.merge((ws.l, ws.a, ws.b), dst=ws.lab)
+    cv2.cvtColor(ws.lab, cv2.COLOR_LAB2BGR, dst=ws.bgr)
+    cv2.cvtColor(ws.bgr, cv2.COLOR_BGR2LAB, dst=ws.lab)
+    cv2.extractChannel(ws.lab, 0, dst=ws.l)
+    cv2.extractChannel(ws.lab, 1, dst=ws.a)
+    cv2.extractChannel(ws.lab, 2, dst=ws.b)
+
+
+def _lab_channels(image, ws):
+    # Splits the frame into the LAB channels of the workspace, with CLAHE applied to L
+    cv2.cvtColor(image, cv2.COLOR_BGR2LAB, dst=ws.lab)
+    cv2.extractChannel(ws.lab, 0, dst=ws.l)
+    cv2.extractChannel(ws.lab, 1, dst=ws.a)
+    cv2.extractChannel(ws.lab, 2, dst=ws.b)
+    ws.clahe.apply(ws.l, dst=ws.l)
+
+
+def _balance_and_contrast(ws, luts):
+    # White balance of the a/b channels through their (L, channel) lookup tables, then improve_contrast
+    np.left_shift(ws.l, 8, out=ws.index, dtype=np.uint16)
+    for channel, index, lut in ((ws.a, 1, luts[0]), (ws.b, 2, luts[1])):
+        np.bitwise_or(ws.index, channel, out=ws.index)
+        np.take(lut, ws.index, out=channel)
+        np.bitwise_and(ws.index, 0xFF00, out=ws.index)
+        cv2.insertChannel(channel, ws.lab, index)
+    cv2.insertChannel(ws.l, ws.lab, 0)
+
+    cv2.cvtColor(ws.lab, cv2.COLOR_LAB2BGR, dst=ws.bgr)
+
+    # improve_contrast, reusing the LAB buffer for HSV
+    hsv = cv2.cvtColor(ws.bgr, cv2.COLOR_BGR2HSV, dst=ws.lab)
+    cv2.extractChannel(hsv, 1, dst=ws.a)
+    cv2.LUT(ws.a, SATURATION_LUT, dst=ws.a)
+    cv2.insertChannel(ws.a, hsv, 1)
+    cv2.extractChannel(hsv, 2, dst=ws.b)
+    ws.clahe.apply(ws.b, dst=ws.b)
+    cv2.insertChannel(ws.b, hsv, 2)
+
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+
+def fused_underwater_correction(image):
+    """
+    Single-pass equivalent of simple_underwater_correction.
+
+    The white balance is applied directly to the CLAHE-corrected LAB channels,
+    skipping the LAB -> BGR -> LAB round trip, so only four colorspace
+    conversions are performed instead of six. The a/b shift and the saturation
+    gain go through lookup tables, and the intermediate buffers and the CLAHE
+    object are reused across calls of the same thread.
+
+    The round trip only matters where it clips out-of-gamut colors, so it
+    is still made on frames with more than GAMUT_FRACTION of such colors on
+    a sparse grid, which makes them exact. Elsewhere the result differs from
+    simple_underwater_correction by the 1-level rounding of the round trip,
+    which the contrast CLAHE can amplify: on frames of at least 480 pixels
+    the difference stays within FUSED_MAX_ABS_ERROR levels per channel and
+    FUSED_MEAN_ABS_ERROR levels on average.
+    """
+    ws = _workspace()
+    ws.ensure(image.shape)
+
+    _lab_channels(image, ws)
+    cv2.add(ws.a, 10, dst=ws.a)
+    cv2.add(ws.b, 10, dst=ws.b)
+    if _out_of_gamut(ws, _gamut_step(image)) > GAMUT_FRACTION:
+        _round_trip(ws)
+
+    # White balance straight on the corrected LAB channels
+    luts = (_white_balance_lut(cv2.mean(ws.a)[0]), _white_balance_lut(cv2.mean(ws.b)[0]))
+    return _balance_and_contrast(ws, luts)
+
+
+# Longest side of the pixel grid TemporalCorrector samples the frames on
+TEMPORAL_SAMPLES = 96
+# Mean absolute LAB difference between consecutive samples that marks a scene change
+SCENE_CHANGE_THRESHOLD = 20.0
+# Resolution of the smoothed a/b means, so that the lookup tables are only rebuilt on real changes
+TEMPORAL_MEAN_STEP = 0.25
+
+
+@dataclass(frozen=True)
+class CorrectionParameters:
+    """
+    Means of the a and b channels after the +10 shift, which set the white
+    balance of fused_underwater_correction.
+    """
+
+    a_mean: float
+    b_mean: float
+
+
+@lru_cache(maxsize=16)
+def _temporal_luts(a_mean, b_mean):
+    # The +10 shift of the a/b channels is folded into the tables
+    return _white_balance_lut(a_mean, offset=10), _white_balance_lut(b_mean, offset=10)
+
+
+def apply_temporal_correction(image, parameters):
+    """
+    fused_underwater_correction with given white balance parameters instead of
+    the means of the frame: the a/b shift and white balance are one table
+    lookup per channel, and the tables are shared by all the frames with the
+    same parameters. CLAHE still runs on every frame, since its tiles follow
+    the local content.
+    """
+    ws = _workspace()
+    ws.ensure(image.shape)
+
+    _lab_channels(image, ws)
+    return _balance_and_contrast(ws, _temporal_luts(parameters.a_mean, parameters.b_mean))
+
+
+class TemporalCorrector:
+    """
+    Estimates the white balance parameters of a sequence of frames for
+    apply_temporal_correction. Consecutive video frames have almost the same
+    color statistics, so they are measured on a thumbnail every `interval`
+    frames only, and smoothed with an exponential moving average of weight
+    `smoothing`, which also removes the frame-to-frame flicker of per-frame
+    estimates. Frames are measured on a sparse grid of pixels, which costs
+    far less than a pass over the frame, and a scene change between two
+    consecutive grids resets the average.
+
+    `estimate` must be called on the frames in order; the corrections can then
+    run in any order, on any thread or process. While `history` is a deque,
+    the state after every estimate is appended to it, so that a checkpoint
+    can record the state of each frame (see RunCheckpoint.record_frames) and
+    a resumed run `restore` it.
+
+    Args:
+        interval (int): Frames between two estimations.
+        smoothing (float): Weight of a new estimation in the average, 1 to disable smoothing.
+        scene_threshold (float): Mean absolute LAB difference of consecutive samples that resets the average.
+    """
+
+    def __init__(self, interval=15, smoothing=0.3, scene_threshold=SCENE_CHANGE_THRESHOLD):
+        self.interval = interval
+        self.smoothing = smoothing
+        self.scene_threshold = scene_threshold
+        self.means = None
+        self.previous = None
+        self.since_estimation = 0
+        self.frames = 0
+        self.estimations = 0
+        self.scene_changes = 0
+        self.history = None
+
+    @staticmethod
+    def _sample(image):
+        step = max(1, -(-max(image.shape[:2]) // TEMPORAL_SAMPLES))
+        return cv2.cvtColor(np.ascontiguousarray(image[::step, ::step]), cv2.COLOR_BGR2LAB)
+
+    def estimate(self, image):
+        sample = self._sample(image)
+        scene_change = self.previous is None or (
+            sample.shape != self.previous.shape
+            or cv2.norm(sample, self.previous, cv2.NORM_L1) / sample.size > self.scene_threshold
+        )
+        self.previous = sample
+        self.frames += 1
+
+        if scene_change or self.since_estimation + 1 >= self.interval:
+            shifted = np.minimum(sample[..., 1:].astype(np.float32) + 10, 255)
+            means = shifted.reshape(-1, 2).mean(axis=0)
+            if scene_change:
+                self.scene_changes += self.means is not None
+                self.means = means
+            else:
+                self.means = self.smoothing * means + (1 - self.smoothing) * self.means
+            self.since_estimation = 0
+            self.estimations += 1
+        else:
+            self.since_estimation += 1
+
+        if self.history is not None:
+            self.history.append(self.state())
+        a_mean, b_mean = np.round(self.means / TEMPORAL_MEAN_STEP) * TEMPORAL_MEAN_STEP
+        return CorrectionParameters(float(a_mean), float(b_mean))
+
+    def state(self):
+        # JSON-serializable state of the estimation, and the sample of the last frame
+        state = {
+            "means": [float(mean) for mean in self.means],
+            "since_estimation": self.since_estimation,
+            "frames": self.frames,
+            "estimations": self.estimations,
+            "scene_changes": self.scene_changes,
+        }
+        return state, self.previous
+
+    def restore(self, state, previous):
+        # Continues the sequence of the frames that led to `state`, as returned by state()
+        self.means = np.asarray(state["means"], dtype=np.float32)
+        self.previous = previous
+        self.since_estimation = state["since_estimation"]
+        self.frames = state["frames"]
+        self.estimations = state["estimations"]
+        self.scene_changes = state["scene_changes"]
+
+    def report(self):
+        return (
+            f"{self.frames} frames, {self.estimations} estimations, "
+            f"{self.scene_changes} scene changes"
+        )
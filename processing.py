@@ -1,14 +1,19 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Iterator
 from image import Image
 from artifact import Artifact
-import os
+from detection import DetectionBackend, as_backend
+from utility import chunked
+from cache import ResultCache, hash_key
+from encoding import PayloadEncoder
+from quality import QualityScorer
+from preprocessing import PREPROCESSING_VERSION
+from captioning import CaptioningEngine, create_captioning_client
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import logging
 from itertools import groupby
 import tqdm
-import base64
 import numpy as np
-from openai import OpenAI
-from openai.types.responses.response import Response
-import cv2
 
 
 def get_largest_bbox_label(predictions: Dict[str, Any]) -> Optional[str]:
@@ -26,86 +31,161 @@ def get_largest_bbox_label(predictions: Dict[str, Any]) -> Optional[str]:
         return None
 
 
-def detect_and_segmentation_workflow(
-    client, images: List[Image], prompt: str
+def detection_cache_key(
+    image: Image,
+    prompt: str,
+    backend: DetectionBackend,
+    encoder: Optional[PayloadEncoder] = None,
+) -> str:
+    return hash_key(
+        image.image,
+        prompt,
+        *backend.signature(),
+        PREPROCESSING_VERSION,
+        encoder.signature() if encoder is not None else "",
+    )
+
+
+def detect_and_segment_batch(
+    backend,
+    images: List[Image],
+    prompt: str,
+    cache: Optional[ResultCache] = None,
+    encoder: Optional[PayloadEncoder] = None,
 ) -> List[Image]:
+    # `backend` is a DetectionBackend, or a workflow client run through the Roboflow backend.
+    # Only the images missing from the cache are sent to the backend.
+    backend = as_backend(backend)
+    if not backend.remote:
+        # Local models are given the frames themselves
+        encoder = None
+    keys = [detection_cache_key(image, prompt, backend, encoder) for image in images] if cache else []
+    results = [cache.get(key) for key in keys] if cache else [None] * len(images)
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    if missing:
+        frames, scales = [], []
+        for i in missing:
+            if encoder is None:
+                frames.append(images[i].image)
+                scales.append(1.0)
+            else:
+                payload = encoder.encode(images[i].image)
+                frames.append(payload.base64())
+                scales.append(payload.scale)
+
+        fetched = backend.infer(frames, prompt)
+        for i, result, scale in zip(missing, fetched, scales):
+            # Only the parsed outputs used by Image.from_workflow_result are kept,
+            # with the scale of the payload the coordinates refer to
+            results[i] = {
+                "model": {"parsed_output": result.get("model", {}).get("parsed_output", {})},
+                "model_1": result.get("model_1", {}),
+                "payload_scale": scale,
+            }
+            if cache:
+                cache.put(keys[i], results[i])
+
+    # The results are attached to the frames themselves, which keeps their lazy original
+    return [
+        image.apply_workflow_result(result, payload_scale=result.get("payload_scale", 1.0))
+        for result, image in zip(results, images)
+    ]
+
+
+def detect_and_segment(backend, image: Image, prompt: str, **options) -> Image:
+    # Runs the detection backend on a single image.
+    return detect_and_segment_batch(backend, [image], prompt, **options)[0]
+
+
+def detect_and_segmentation_stream(
+    backend,
+    images: Iterable[Image],
+    prompt: str,
+    max_in_flight: int = 1,
+    batch_size: int = 1,
+    cache: Optional[ResultCache] = None,
+    encoder: Optional[PayloadEncoder] = None,
+) -> Iterator[Image]:
+    # Sends batches of `batch_size` images with up to `max_in_flight` batches pending,
+    # and yields the results in input order.
+    backend = as_backend(backend)
+    batches = chunked(images, batch_size)
+    options = dict(cache=cache, encoder=encoder)
+
+    if max_in_flight <= 1:
+        for batch in batches:
+            yield from detect_and_segment_batch(backend, batch, prompt, **options)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = deque()
+        try:
+            for batch in batches:
+                pending.append(
+                    executor.submit(
+                        detect_and_segment_batch, backend, batch, prompt, **options
+                    )
+                )
+                # Backpressure: no more than max_in_flight batches are read ahead
+                if len(pending) >= max_in_flight:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
 
-    results = []
-    for image in tqdm.tqdm(images):
-        results += client.run_workflow(
-            workspace_name=os.getenv("ROBOFLOW_WORKSPACE_NAME", ""),
-            workflow_id=os.getenv("ROBOFLOW_DETECTION_WORKFLOW_ID", ""),
-            images={"input_image": image.image},
-            parameters={"detection_prompt": prompt},
-        )
 
+def detect_and_segmentation_workflow(
+    backend, images: List[Image], prompt: str, **options
+) -> List[Image]:
+    # Options are those of detect_and_segmentation_stream.
     return list(
-        map(
-            lambda res, img: Image.from_workflow_result(res, img.image, img.original),
-            results,
-            images,
+        tqdm.tqdm(
+            detect_and_segmentation_stream(backend, images, prompt, **options),
+            total=len(images),
         )
     )
 
 
-def frame_selection(images: List[Image]) -> List[Artifact]:
+def frame_selection_stream(
+    images: Iterable[Image],
+    scorer: Optional[QualityScorer] = None,
+    keep_images: bool = True,
+) -> Iterator[Artifact]:
     # Step 1: Select the bounding box with maximum area and return its predicted label
-    for image in images:
-        if not hasattr(image, "object_detection") or not image.object_detection:
-            continue
-        image.artifact_label = get_largest_bbox_label(image.object_detection)
+    def assign_label(image: Image) -> Image:
+        if hasattr(image, "object_detection") and image.object_detection:
+            image.artifact_label = get_largest_bbox_label(image.object_detection)
+        return image
 
-    # Step 2: Group the images by the labels selected in the previous step
+    # Step 2: Group the consecutive images by the labels selected in the previous step.
+    # groupby is lazy, so only the images of the current group are held in memory.
     grouped_images = groupby(
-        images, key=lambda img: getattr(img, "artifact_label", None)
+        map(assign_label, images), key=lambda img: getattr(img, "artifact_label", None)
     )
 
-    # Step 3: Group together the images with the same label and return a list of artifacts
-    return [
-        Artifact(name=label, images=list(group))
-        for label, group in grouped_images
-        if label is not None
-    ]
+    # Step 3: Yield an artifact as soon as its group of images is complete, scoring
+    # the images as they arrive. Without keep_images only the best one is kept.
+    for label, group in grouped_images:
+        if label is not None:
+            yield Artifact.from_frames(label, group, scorer=scorer, keep_images=keep_images)
 
 
-def generate_frame_description(
-    client, artifacts: List[Artifact], prompt: str
+def frame_selection(
+    images: List[Image],
+    scorer: Optional[QualityScorer] = None,
+    keep_images: bool = True,
 ) -> List[Artifact]:
-    # This function adds the caption to the Artifact object.
-    def parse_caption(result: Response) -> str:
-        print(result)
-        return response.output[0].content[0].text
-
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-    result = []
-    for artifact in tqdm.tqdm(artifacts):
-        print(
-            type(artifact.best_image.image)
-        )  # TODO: Implement a logic for the selection of the best image among the pictures of the artifact.
-
-        image = artifact.best_image.image
-
-        _, buffer = cv2.imencode(".jpg", image)
-
-        base64_image = base64.b64encode(buffer).decode("utf-8")
-
-        response = client.responses.create(
-            model="gpt-4.1-nano",
-            input=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": prompt},
-                        {
-                            "type": "input_image",
-                            "image_url": f"data:image/jpg;base64,{base64_image}",
-                        },
-                    ],
-                }
-            ],
-        )
+    return list(frame_selection_stream(images, scorer, keep_images))
+
 
-        result.append(parse_caption(response))
+def generate_frame_description(
+    client, artifacts: List[Artifact], prompt: str, engine: Optional[CaptioningEngine] = None
+) -> List[Artifact]:
+    # This function adds the caption to the Artifact objects.
+    if engine is None:
+        engine = CaptioningEngine(create_captioning_client(), prompt)
 
-    return result
+    return list(tqdm.tqdm(engine.caption_stream(artifacts), total=len(artifacts)))
@@ -0,0 +1,360 @@
+"""
+    Profiler instruments a pipeline run: wall time, CPU time, peak RSS growth, item counts and throughput of every
+    stage, and latency histograms of the remote calls, exported as a JSON report and a Chrome trace.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    # High-water mark of the resident set size of the process
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class LatencyHistogram:
+    """
+    Latencies in logarithmic buckets, from 0.1 ms to about 2.5 minutes with
+    sqrt(2) steps, so that recording a call is a bisection and percentiles are
+    accurate to about 20%.
+    """
+
+    BOUNDS = [0.0001 * 2 ** (i / 2) for i in range(42)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                # Linear interpolation inside the bucket, clamped to the observed range
+                low = self.BOUNDS[i - 1] if i > 0 else 0.0
+                high = self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+                value = low + (high - low) * (rank - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "min_s": self.min if self.count else 0.0,
+            "p50_s": self.percentile(50),
+            "p90_s": self.percentile(90),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+            "buckets": [
+                {"le_s": self.BOUNDS[i] if i < len(self.BOUNDS) else None, "count": count}
+                for i, count in enumerate(self.counts)
+                if count
+            ],
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.count} calls ({self.errors} failed), p50 {self.percentile(50) * 1000:.0f} ms, "
+            f"p90 {self.percentile(90) * 1000:.0f} ms, p99 {self.percentile(99) * 1000:.0f} ms, "
+            f"max {self.max * 1000:.0f} ms"
+        )
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    items: int = 0
+    wall: float = 0.0
+    self_wall: float = 0.0
+    cpu: float = 0.0
+    self_cpu: float = 0.0
+    peak_rss_growth_mb: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        # Items per second spent in the stage itself
+        return self.items / self.self_wall if self.self_wall > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "items": self.items,
+            "wall_s": self.wall,
+            "self_wall_s": self.self_wall,
+            "cpu_s": self.cpu,
+            "self_cpu_s": self.self_cpu,
+            "throughput": self.throughput,
+            "peak_rss_growth_mb": self.peak_rss_growth_mb,
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.items} items, {self.self_wall:.2f}s ({self.wall:.2f}s with nested stages), "
+            f"{self.self_cpu:.2f}s CPU, {self.throughput:.1f} items/s, "
+            f"peak RSS +{self.peak_rss_growth_mb:.0f} MB"
+        )
+
+
+@dataclass
+class _Section:
+    name: str
+    start: float
+    start_cpu: float
+    start_rss: Optional[float]
+    child_wall: float = 0.0
+    child_cpu: float = 0.0
+    child_rss: float = 0.0
+    items: int = 0
+
+
+class Instrumented:
+    """
+    Proxy of `target` whose `attribute` is replaced by `replacement`; every
+    other attribute is the one of the target.
+    """
+
+    def __init__(self, target: Any, attribute: str, replacement: Any):
+        self._target = target
+        self._attribute = attribute
+        self._replacement = replacement
+
+    def __getattr__(self, name: str) -> Any:
+        if name == self._attribute:
+            return self._replacement
+        return getattr(self._target, name)
+
+
+class Profiler:
+    """
+    Collects the telemetry of a run.
+
+    Stages are timed either as blocks (`stage`) or as the `next()` calls of
+    the generator feeding the next stage (`iterate`), since streamed stages
+    pull their input lazily. Sections nest per thread: a stage pulling frames
+    from the previous one reports its own time as `self_wall`/`self_cpu` and
+    the time including the nested stages as `wall`/`cpu`. CPU time is the
+    process CPU time, so the work of pool threads is attributed to the stage
+    waiting for them, and stages running concurrently share it.
+
+    Remote calls are timed by `instrument`, on the threads that make them.
+
+    A disabled profiler returns its inputs unchanged and records nothing.
+
+    Args:
+        enabled (bool): Collect telemetry.
+        max_events (int): Maximum number of trace events kept; stage totals and histograms are always complete.
+    """
+
+    def __init__(self, enabled: bool = True, max_events: int = 200_000):
+        self.enabled = enabled
+        self.max_events = max_events
+        self.stages: Dict[str, StageStats] = {}
+        self.requests: Dict[str, LatencyHistogram] = {}
+        self.events: List[Dict[str, Any]] = []
+        self.dropped_events = 0
+        self._threads: Dict[int, str] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    def _stack(self) -> List[_Section]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _event(self, name: str, category: str, start: float, duration: float, args: Dict[str, Any]) -> None:
+        # Called with the lock held
+        if len(self.events) >= self.max_events:
+            self.dropped_events += 1
+            return
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self._start) * 1e6,
+                "dur": duration * 1e6,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+    def _enter(self, name: str) -> _Section:
+        section = _Section(name, time.perf_counter(), time.process_time(), peak_rss_mb())
+        self._stack().append(section)
+        return section
+
+    def _exit(self, section: _Section) -> None:
+        end, end_cpu, end_rss = time.perf_counter(), time.process_time(), peak_rss_mb()
+        stack = self._stack()
+        stack.pop()
+        wall, cpu = end - section.start, end_cpu - section.start_cpu
+        growth = end_rss - section.start_rss if end_rss is not None else 0.0
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+            stack[-1].child_rss += growth
+
+        with self._lock:
+            stats = self.stages.setdefault(section.name, StageStats())
+            stats.calls += 1
+            stats.items += section.items
+            stats.wall += wall
+            stats.self_wall += wall - section.child_wall
+            stats.cpu += cpu
+            stats.self_cpu += cpu - section.child_cpu
+            stats.peak_rss_growth_mb += growth - section.child_rss
+            self._event(section.name, "stage", section.start, wall, {"items": section.items})
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0):
+        """
+        Times a block as one call of stage `name` processing `items` items.
+        """
+        if not self.enabled:
+            yield
+            return
+        section = self._enter(name)
+        section.items = items
+        try:
+            yield
+        finally:
+            self._exit(section)
+
+    def iterate(self, iterable: Iterable, name: str) -> Iterable:
+        """
+        Times every item produced by `iterable` as one item of stage `name`.
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(iter(iterable), name)
+
+    def _iterate(self, iterator: Iterator, name: str) -> Iterator:
+        try:
+            while True:
+                section = self._enter(name)
+                try:
+                    item = next(iterator)
+                    section.items = 1
+                except StopIteration:
+                    return
+                finally:
+                    self._exit(section)
+                yield item
+        finally:
+            # Stopping early releases the resources of the wrapped generator
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def instrument(self, target: Any, method: str, name: str) -> Any:
+        """
+        Returns a proxy of `target` recording the latency of every call of
+        `method` in the histogram `name`. `method` may be a dotted path, e.g.
+        "responses.create" for an OpenAI client.
+        """
+        if not self.enabled:
+            return target
+        head, _, rest = method.partition(".")
+        if rest:
+            return Instrumented(target, head, self.instrument(getattr(target, head), rest, name))
+        return Instrumented(target, method, self._timed(getattr(target, method), name))
+
+    def _timed(self, function: Callable, name: str) -> Callable:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                duration = time.perf_counter() - start
+                with self._lock:
+                    self.requests.setdefault(name, LatencyHistogram()).record(duration, error)
+                    self._event(name, "request", start, duration, {"error": error})
+
+        return timed
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "wall_s": time.perf_counter() - self._start,
+                "cpu_s": time.process_time() - self._start_cpu,
+                "peak_rss_mb": peak_rss_mb(),
+                "stages": {name: stats.to_dict() for name, stats in self.stages.items()},
+                "requests": {name: histogram.to_dict() for name, histogram in self.requests.items()},
+                "dropped_events": self.dropped_events,
+            }
+
+    def save_report(self, path: Path) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def save_trace(self, path: Path) -> None:
+        """
+        Writes the timeline in the Chrome trace event format, which
+        chrome://tracing and Perfetto open.
+        """
+        with self._lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in self._threads.items()
+            ]
+            events = metadata + list(self.events)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def log_summary(self, logger: logging.Logger) -> None:
+        report = self.report()
+        peak = report["peak_rss_mb"]
+        logger.info(
+            f"Profile: {report['wall_s']:.2f}s wall, {report['cpu_s']:.2f}s CPU"
+            + (f", peak RSS {peak:.0f} MB" if peak is not None else "")
+        )
+        for name, stats in self.stages.items():
+            logger.info(f"Profile: stage {name}: {stats}")
+        for name, histogram in self.requests.items():
+            logger.info(f"Profile: {name} requests: {histogram}")
@@ -0,0 +1,105 @@
+"""
+    Proxy-resolution processing: detection, grouping and quality scoring run on downscaled frames,
+    and only the frames that are kept for an artifact are corrected at full resolution.
+"""
+
+from typing import Callable, Iterable, Iterator, List
+import logging
+
+import cv2
+import numpy as np
+
+from artifact import Artifact
+from errors import ProcessingError
+from image import Image
+from preprocessing import image_correction
+
+
+def make_proxy(image: Image, max_dimension: int) -> Image:
+    """
+    Downscales an unprocessed frame so that its longest side is at most
+    `max_dimension` pixels. The full-resolution pixels are dropped when the
+    frame can be read again from its path or decoded again from its video,
+    and kept aside otherwise.
+
+    Args:
+        image (Image): Unprocessed frame.
+        max_dimension (int): Longest side of the proxy, in pixels.
+
+    Returns:
+        Image: The same Image, holding the proxy.
+    """
+    h, w = image.image.shape[:2]
+    if max(h, w) <= max_dimension:
+        return image
+
+    scale = max_dimension / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+
+    if image.video_frame is None and (image.path is None or not image.path.is_file()):
+        image.full_resolution = image.original if image.original is not None else image.image
+
+    shared = image.original is image.image
+    image.image = cv2.resize(image.image, size, interpolation=cv2.INTER_AREA)
+    if shared:
+        image.original = image.image
+    elif image.original is not None:
+        image.original = cv2.resize(image.original, size, interpolation=cv2.INTER_AREA)
+    image.scale = image.scale * scale
+
+    return image
+
+
+def make_proxies(images: Iterable[Image], max_dimension: int) -> Iterator[Image]:
+    for image in images:
+        yield make_proxy(image, max_dimension)
+
+
+def load_full_resolution(image: Image) -> np.ndarray:
+    # Unprocessed full-resolution pixels of a proxy frame
+    full = image.full_resolution
+    if full is None and image.video_frame is not None:
+        full = image.video_frame.read()
+    elif full is None:
+        full = cv2.imread(str(image.path))
+    if full is None:
+        raise ProcessingError(f"Cannot reload the full-resolution frame {image.path}")
+    return full
+
+
+def promote_to_full_resolution(image: Image, correction: Callable) -> Image:
+    """
+    Replaces the proxy of a frame with its corrected full-resolution version.
+
+    Args:
+        image (Image): Proxy frame, as produced by make_proxy.
+        correction (Callable): Correction applied to the full-resolution frame.
+
+    Returns:
+        Image: The same Image, at full resolution.
+    """
+    if image.scale == 1.0:
+        return image
+
+    full = load_full_resolution(image)
+    image.image = correction(full)
+    image.original = full
+    image.full_resolution = None
+    image.video_frame = None
+    image.scale = 1.0
+
+    return image
+
+
+def promote_artifact(artifact: Artifact, correction: str = "fused") -> Artifact:
+    if artifact.best_image is not None:
+        promote_to_full_resolution(artifact.best_image, image_correction(artifact.best_image, correction))
+    return artifact
+
+
+def promote_artifacts(artifacts: List[Artifact], correction: str = "fused") -> List[Artifact]:
+    reduced = sum(artifact.best_image is not None and artifact.best_image.scale != 1.0 for artifact in artifacts)
+    promoted = [promote_artifact(artifact, correction) for artifact in artifacts]
+    if reduced:
+        logging.info(f"Promoted {reduced} best images to full resolution")
+    return promoted
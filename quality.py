@@ -0,0 +1,316 @@
+"""
+    Frame quality scoring for best-image selection: pluggable metrics computed on downscaled luma, batched over
+    frames, and a running best that only keeps the frames it needs.
+"""
+
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Sequence
+import math
+
+import cv2
+import numpy as np
+
+from encoding import crop_to_roi
+from errors import ProcessingError
+
+if TYPE_CHECKING:
+    from image import Image
+
+# BGR weights of the luma (ITU-R BT.601)
+LUMA_WEIGHTS = np.array([0.114, 0.587, 0.299], dtype=np.float32)
+
+# PSNR at which the psnr metric saturates, in dB
+PSNR_CEILING = 60.0
+# Laplacian variance at which the sharpness metric reaches 0.5
+SHARPNESS_HALF = 100.0
+
+# Regions of the frames the metrics can be restricted to
+ROI_MODES = ("box", "mask")
+
+
+def luma_thumbnails(frames: Sequence[Optional[np.ndarray]], size: tuple) -> np.ndarray:
+    """
+    Stacks the luma of the frames, resized to `size` (width, height), into a
+    float32 array of shape (frames, height, width). Missing frames are zeros.
+    """
+    stack = np.zeros((len(frames), size[1], size[0]), dtype=np.float32)
+    for i, frame in enumerate(frames):
+        if frame is None:
+            continue
+        # Luma first, so that only one channel is resized
+        luma = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        h, w = luma.shape
+        fx, fy = w // size[0], h // size[1]
+        if fx >= 1 and fy >= 1 and (w // fx, h // fy) == size:
+            # Integer ratios take the fast path of INTER_AREA
+            luma = luma[: size[1] * fy, : size[0] * fx]
+        if luma.shape != (size[1], size[0]):
+            luma = cv2.resize(luma, size, interpolation=cv2.INTER_AREA)
+        stack[i] = luma
+    return stack
+
+
+def thumbnail_size(shape: tuple, max_dimension: int) -> tuple:
+    # Integer downscaling factor, so that INTER_AREA takes its fast path
+    h, w = shape[:2]
+    factor = max(1, math.ceil(max(h, w) / max_dimension))
+    return (max(1, w // factor), max(1, h // factor))
+
+
+class FrameBatch:
+    """
+    Frames scored together, with their luma thumbnails computed once and
+    shared by all metrics.
+
+    With a `roi` mode, the thumbnails only cover the region of the object of
+    every frame (see Image.roi), enlarged by `roi_margin` times its size, and
+    frames without detections are scored whole. In "mask" mode the metrics
+    are also weighted by the mask of the object, so the background inside
+    the region does not count.
+    """
+
+    def __init__(
+        self,
+        images: Sequence["Image"],
+        max_dimension: int,
+        roi: Optional[str] = None,
+        roi_margin: float = 0.1,
+    ):
+        self.images = images
+        self.roi = roi
+        # Region (x1, y1, x2, y2) of every frame, in the coordinates of its image
+        self.regions = [self._region(image, roi_margin) for image in images]
+        x1, y1, x2, y2 = self.regions[0]
+        self.size = thumbnail_size((y2 - y1, x2 - x1), max_dimension)
+        self._luma = None
+        self._original_luma = None
+        self._weights = None
+        self.missing_original = None
+
+    def _region(self, image: "Image", margin: float) -> tuple:
+        h, w = image.image.shape[:2]
+        box = image.roi() if self.roi is not None else None
+        if box is None:
+            return (0, 0, w, h)
+        crop, (left, top) = crop_to_roi(image.image, box, margin)
+        return (left, top, left + crop.shape[1], top + crop.shape[0])
+
+    def _crop(self, frame: Optional[np.ndarray], region: tuple, shape: tuple) -> Optional[np.ndarray]:
+        # Crops a frame of the image or thumbnail size to the region of the image
+        if frame is None or self.roi is None:
+            return frame
+        fy, fx = frame.shape[0] / shape[0], frame.shape[1] / shape[1]
+        x1, y1, x2, y2 = region
+        return frame[
+            int(y1 * fy) : max(int(y1 * fy) + 1, round(y2 * fy)),
+            int(x1 * fx) : max(int(x1 * fx) + 1, round(x2 * fx)),
+        ]
+
+    @property
+    def luma(self) -> np.ndarray:
+        if self._luma is None:
+            self._luma = luma_thumbnails(
+                [
+                    self._crop(image.image, region, image.image.shape)
+                    for image, region in zip(self.images, self.regions)
+                ],
+                self.size,
+            )
+        return self._luma
+
+    @property
+    def original_luma(self) -> np.ndarray:
+        if self._original_luma is None:
+            # Frames that released their original are scored on its thumbnail
+            originals = [
+                self._crop(
+                    image.original_thumbnail if image.original_thumbnail is not None else image.original,
+                    region,
+                    image.image.shape,
+                )
+                for image, region in zip(self.images, self.regions)
+            ]
+            self.missing_original = np.array([original is None for original in originals])
+            self._original_luma = luma_thumbnails(originals, self.size)
+        return self._original_luma
+
+    @property
+    def weights(self) -> Optional[np.ndarray]:
+        # Per-pixel weights of the thumbnails in "mask" mode, None when every pixel counts
+        if self.roi != "mask":
+            return None
+        if self._weights is None:
+            self._weights = np.ones((len(self.images), self.size[1], self.size[0]), dtype=np.float32)
+            for i, (image, region) in enumerate(zip(self.images, self.regions)):
+                mask = image.largest_mask()
+                if mask is not None:
+                    inside = mask.rasterize(region, self.size, image.scale)
+                    if inside.any():
+                        self._weights[i] = inside
+        return self._weights
+
+
+def weighted_mean(values: np.ndarray, weights: Optional[np.ndarray]) -> np.ndarray:
+    # Mean of every frame of a (frames, height, width) stack
+    if weights is None:
+        return values.mean(axis=(1, 2))
+    return (values * weights).sum(axis=(1, 2)) / np.maximum(weights.sum(axis=(1, 2)), 1e-6)
+
+
+# Every metric maps a batch to one score per frame in [0, 1], higher is better
+
+
+def psnr_metric(batch: FrameBatch) -> np.ndarray:
+    # PSNR between the original and the processed frame, in float so that differences do not wrap around
+    mse = weighted_mean((batch.original_luma - batch.luma) ** 2, batch.weights)
+    with np.errstate(divide="ignore"):
+        psnr = 20 * np.log10(255.0 / np.sqrt(mse))
+    scores = np.minimum(psnr, PSNR_CEILING) / PSNR_CEILING
+    scores[batch.missing_original] = 0.0
+    return scores
+
+
+def sharpness_metric(batch: FrameBatch) -> np.ndarray:
+    # Variance of the 4-neighbour Laplacian
+    luma = batch.luma
+    laplacian = (
+        luma[:, :-2, 1:-1]
+        + luma[:, 2:, 1:-1]
+        + luma[:, 1:-1, :-2]
+        + luma[:, 1:-1, 2:]
+        - 4 * luma[:, 1:-1, 1:-1]
+    )
+    if batch.weights is None:
+        variance = laplacian.var(axis=(1, 2))
+    else:
+        weights = batch.weights[:, 1:-1, 1:-1]
+        variance = weighted_mean(laplacian**2, weights) - weighted_mean(laplacian, weights) ** 2
+    return variance / (variance + SHARPNESS_HALF)
+
+
+def exposure_metric(batch: FrameBatch) -> np.ndarray:
+    luma = batch.luma
+    clipped = weighted_mean((luma < 8) | (luma > 247), batch.weights)
+    balance = 1.0 - np.abs(weighted_mean(luma, batch.weights) - 127.5) / 127.5
+    return (1.0 - clipped) * balance
+
+
+def detection_metric(batch: FrameBatch) -> np.ndarray:
+    # Size and centrality of the largest detection, in full-resolution coordinates
+    scores = np.zeros(len(batch.images))
+    for i, image in enumerate(batch.images):
+        bboxes = (image.object_detection or {}).get("bboxes")
+        if not bboxes:
+            continue
+        bboxes = np.asarray(bboxes, dtype=float)
+        areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+        x1, y1, x2, y2 = bboxes[np.argmax(areas)]
+
+        h, w = (np.array(image.image.shape[:2]) / image.scale).tolist()
+        area = max(0.0, areas.max()) / (w * h)
+        distance = math.hypot((x1 + x2) / 2 - w / 2, (y1 + y2) / 2 - h / 2)
+        centrality = 1.0 - distance / math.hypot(w / 2, h / 2)
+        scores[i] = math.sqrt(min(area, 1.0)) * max(centrality, 0.0)
+    return scores
+
+
+METRICS: Dict[str, Callable[[FrameBatch], np.ndarray]] = {
+    "psnr": psnr_metric,
+    "sharpness": sharpness_metric,
+    "exposure": exposure_metric,
+    "detection": detection_metric,
+}
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """
+    Parses metric weights written as "psnr=1,sharpness=0.5". A metric without
+    a weight has weight 1.
+    """
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, weight = item.partition("=")
+        try:
+            weights[name.strip()] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ProcessingError(f"Invalid weight for quality metric {name}: {weight}")
+    return weights
+
+
+class QualityScorer:
+    """
+    Scores frames with a weighted sum of quality metrics.
+
+    Args:
+        weights (Optional[Dict[str, float]]): Weight of each metric of METRICS, PSNR only by default.
+        max_dimension (int): Longest side of the luma thumbnails the metrics run on.
+        roi (Optional[str]): One of ROI_MODES to score only the region of the object, None for the whole frame.
+        roi_margin (float): Fraction of the size of the region added on every side.
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        max_dimension: int = 256,
+        roi: Optional[str] = None,
+        roi_margin: float = 0.1,
+    ):
+        self.weights = weights or {"psnr": 1.0}
+        unknown = set(self.weights) - set(METRICS)
+        if unknown:
+            raise ProcessingError(f"Unknown quality metrics: {', '.join(sorted(unknown))}")
+        if roi is not None and roi not in ROI_MODES:
+            raise ProcessingError(f"Unknown quality region: {roi}")
+        self.max_dimension = max_dimension
+        self.roi = roi
+        self.roi_margin = roi_margin
+
+    def score(self, images: Sequence["Image"]) -> np.ndarray:
+        if not images:
+            return np.zeros(0)
+        batch = FrameBatch(images, self.max_dimension, self.roi, self.roi_margin)
+        return sum(
+            weight * METRICS[name](batch) for name, weight in self.weights.items()
+        )
+
+
+class RunningBest:
+    """
+    Tracks the best frame of a stream, scoring frames in batches of
+    `batch_size`. Unless `keep_images` is set, frames are released as soon as
+    they are scored, so at most one batch and the best frame are in memory.
+    """
+
+    def __init__(
+        self, scorer: Optional[QualityScorer] = None, batch_size: int = 16, keep_images: bool = False
+    ):
+        self.scorer = scorer or QualityScorer()
+        self.batch_size = batch_size
+        self.keep_images = keep_images
+        self.images: List["Image"] = []
+        self.best: Optional["Image"] = None
+        self.best_score = -np.inf
+        self.count = 0
+        self._pending: List["Image"] = []
+
+    def push(self, image: "Image") -> None:
+        self._pending.append(image)
+        self.count += 1
+        if self.keep_images:
+            self.images.append(image)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def extend(self, images: Iterable["Image"]) -> "RunningBest":
+        for image in images:
+            self.push(image)
+        self.flush()
+        return self
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        scores = self.scorer.score(self._pending)
+        index = int(np.argmax(scores))
+        if scores[index] > self.best_score:
+            self.best, self.best_score = self._pending[index], float(scores[index])
+        self._pending = []
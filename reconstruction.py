@@ -1,7 +1,256 @@
+"""
+    Reconstruction input preparation: selects a small, well-distributed subset of the frames of each artifact and
+    writes them as a dataset for WaterSplatting / Gaussian-splatting tools, which estimate the camera poses with
+    COLMAP and train on the same images.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Set
+import json
+import logging
+import re
+
+import cv2
+import numpy as np
+
+from artifact import Artifact
+from encoding import crop_to_roi
 from image import Image
+from preprocessing import image_correction
+from proxy import load_full_resolution
+from quality import FrameBatch, QualityScorer
+
+# Fewest views a reconstruction can be run on
+MIN_VIEWS = 3
+# Longest side of the thumbnails of the object compared for view diversity
+DESCRIPTOR_SIZE = 16
+
+MANIFEST_FILE = "manifest.json"
+
+# Guards the dataset names shared by the reconstruct workers of a run
+_names_lock = Lock()
+
+
+def view_descriptors(images: Sequence[Image]) -> np.ndarray:
+    """
+    Describes the viewpoint of every frame by the appearance of its object,
+    a normalized luma thumbnail of its region, and the position and size of
+    the region in the frame. Without camera poses, frames far apart in this
+    space see the object from different sides or distances.
+    """
+    thumbnails = FrameBatch(images, DESCRIPTOR_SIZE, roi="box", roi_margin=0.0).luma
+    appearance = thumbnails.reshape(len(images), -1)
+    appearance = appearance - appearance.mean(axis=1, keepdims=True)
+    appearance /= np.maximum(np.linalg.norm(appearance, axis=1, keepdims=True), 1e-6)
+
+    geometry = np.zeros((len(images), 3), dtype=np.float32)
+    for i, image in enumerate(images):
+        roi = image.roi()
+        if roi is None:
+            continue
+        h, w = image.image.shape[:2]
+        x1, y1, x2, y2 = roi
+        size = np.sqrt(max(x2 - x1, 0) * max(y2 - y1, 0) / (w * h))
+        geometry[i] = ((x1 + x2) / (2 * w), (y1 + y2) / (2 * h), size)
+    # Unit-norm appearance vectors are at most 2 apart
+    return np.hstack([appearance / 2, geometry])
+
+
+class ViewSelector:
+    """
+    Selects the views of an artifact: the best frame first, then greedily
+    the frame with the best trade-off between its quality and its distance
+    to the views already selected (see view_descriptors), until `max_views`
+    are selected or every remaining frame is within `min_distance` of a
+    selected view.
+
+    Args:
+        scorer (Optional[QualityScorer]): Scorer of the frame quality, PSNR only by default.
+        max_views (int): Most views selected per artifact.
+        diversity (float): Weight of the diversity against the quality, in [0, 1].
+        min_distance (float): Distance under which a frame is redundant with a selected view.
+    """
+
+    def __init__(
+        self,
+        scorer: Optional[QualityScorer] = None,
+        max_views: int = 40,
+        diversity: float = 0.5,
+        min_distance: float = 0.05,
+    ):
+        self.scorer = scorer or QualityScorer()
+        self.max_views = max_views
+        self.diversity = diversity
+        self.min_distance = min_distance
+
+    def score(self, images: Sequence[Image], batch_size: int = 16) -> np.ndarray:
+        return np.concatenate(
+            [self.scorer.score(images[i : i + batch_size]) for i in range(0, len(images), batch_size)]
+        )
+
+    def select(self, images: Sequence[Image]) -> List[int]:
+        """
+        Returns the indices of the selected frames, in frame order.
+        """
+        if len(images) == 0:
+            return []
+        scores = self.score(images)
+        span = scores.max() - scores.min()
+        quality = (scores - scores.min()) / span if span > 0 else np.ones(len(images))
+        descriptors = view_descriptors(images)
+
+        selected = [int(np.argmax(scores))]
+        distances = np.linalg.norm(descriptors - descriptors[selected[0]], axis=1)
+        while len(selected) < min(self.max_views, len(images)):
+            if distances.max() < self.min_distance:
+                break
+            gain = (1 - self.diversity) * quality + self.diversity * distances / distances.max()
+            gain[selected] = -np.inf
+            index = int(np.argmax(gain))
+            selected.append(index)
+            distances = np.minimum(distances, np.linalg.norm(descriptors - descriptors[index], axis=1))
+        return sorted(selected)
 
 
-def reconstruct_image(img: Image) -> None:
-    raise NotImplementedError(
-        "reconstruct_model will be implemented in future versions."
+@dataclass
+class View:
+    file_path: str
+    mask_path: Optional[str]
+    source: str
+    frame: int
+    # Region of the frame the image was cropped to, in full-resolution coordinates
+    crop: List[int]
+    width: int
+    height: int
+
+
+def _dataset_name(name: str, names: Optional[Set[str]] = None) -> str:
+    # Artifacts whose names only differ by the replaced characters get numbered folders instead of sharing one
+    name = re.sub(r"[^\w.-]+", "_", name) or "artifact"
+    if names is None:
+        return name
+    with _names_lock:
+        unique, index = name, 1
+        while unique in names:
+            unique, index = f"{name}_{index}", index + 1
+        names.add(unique)
+    return unique
+
+
+def _write_view(
+    image: Image,
+    number: int,
+    frame: int,
+    directory: Path,
+    correction: str,
+    max_dimension: Optional[int],
+    crop_margin: Optional[float],
+) -> View:
+    # Proxies are corrected again at full resolution, without replacing the frame of the artifact
+    pixels = image.image if image.scale == 1.0 else image_correction(image, correction)(load_full_resolution(image))
+    h, w = pixels.shape[:2]
+    left, top, right, bottom = 0, 0, w, h
+    roi = image.roi()
+    if crop_margin is not None and roi is not None:
+        pixels, (left, top) = crop_to_roi(pixels, [value / image.scale for value in roi], crop_margin)
+        right, bottom = left + pixels.shape[1], top + pixels.shape[0]
+
+    h, w = pixels.shape[:2]
+    if max_dimension and max(h, w) > max_dimension:
+        scale = max_dimension / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        pixels = cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
+        h, w = pixels.shape[:2]
+
+    file_name = f"{number:04d}.jpg"
+    cv2.imwrite(str(directory / "images" / file_name), pixels, [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+    # COLMAP reads the mask of images/<name> from masks/<name>.png, and ignores the black pixels
+    mask_path = None
+    mask = image.largest_mask()
+    if mask is not None:
+        inside = mask.rasterize((left, top, right, bottom), (w, h))
+        mask_path = f"masks/{file_name}.png"
+        (directory / "masks").mkdir(exist_ok=True)
+        cv2.imwrite(str(directory / mask_path), inside.astype(np.uint8) * 255)
+
+    return View(
+        file_path=f"images/{file_name}",
+        mask_path=mask_path,
+        source=str(image.path),
+        frame=frame,
+        crop=[int(left), int(top), int(right), int(bottom)],
+        width=w,
+        height=h,
     )
+
+
+def prepare_reconstruction(
+    artifact: Artifact,
+    output_dir: Path,
+    selector: Optional[ViewSelector] = None,
+    correction: str = "fused",
+    max_dimension: Optional[int] = 1600,
+    crop_margin: Optional[float] = None,
+    workers: Optional[int] = None,
+    names: Optional[Set[str]] = None,
+) -> Optional[Path]:
+    """
+    Writes the reconstruction dataset of an artifact to
+    <output_dir>/<artifact name>: the selected views in images/, the masks of
+    the object in masks/, and manifest.json. The views are numbered in frame
+    order, which suits sequential matching.
+
+    Uncropped views keep the intrinsics of the camera, so COLMAP can share one
+    camera model between them; cropped views need one camera per image.
+
+    Args:
+        artifact (Artifact): Artifact with all its frames (not saved with --best-frame-only).
+        output_dir (Path): Folder of the datasets.
+        selector (Optional[ViewSelector]): View selection, with the default settings if None.
+        correction (str): Correction of the proxies promoted to full resolution, one of CORRECTIONS.
+        max_dimension (Optional[int]): Longest side of the written images, None to keep the size.
+        crop_margin (Optional[float]): If set, views are cropped around the object, enlarged by this fraction.
+        workers (Optional[int]): Threads writing the views.
+        names (Optional[Set[str]]): Dataset folders already written in `output_dir` by this run, updated with this one.
+
+    Returns:
+        Optional[Path]: Folder of the dataset, or None if the artifact has too few frames.
+    """
+    selector = selector or ViewSelector()
+    images = artifact.images
+    if len(images) < MIN_VIEWS:
+        logging.warning(
+            f"Artifact {artifact.name} has {len(images)} frames, at least {MIN_VIEWS} are needed for a reconstruction"
+        )
+        return None
+
+    indices = selector.select(images)
+    directory = output_dir / _dataset_name(artifact.name, names)
+    (directory / "images").mkdir(parents=True, exist_ok=True)
+
+    # Correcting, resizing and encoding release the GIL, so views are written on a thread pool
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        views = list(
+            executor.map(
+                lambda item: _write_view(
+                    images[item[1]], item[0], item[1], directory, correction, max_dimension, crop_margin
+                ),
+                enumerate(indices),
+            )
+        )
+
+    manifest: Dict[str, Any] = {
+        "artifact": artifact.name,
+        "caption": artifact.caption,
+        "frames": len(images),
+        "views": [asdict(view) for view in views],
+        "cropped": crop_margin is not None,
+    }
+    with open(directory / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+    logging.info(f"Reconstruction dataset of {artifact.name}: {len(views)} of {len(images)} frames in {directory}")
+    return directory
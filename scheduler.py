@@ -0,0 +1,296 @@
+"""
+    Stage scheduling for the streaming pipeline: the stages either run as one chain of generators pulled by the
+    consumer, or concurrently as producer/consumer threads connected by bounded queues.
+"""
+
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+import logging
+import threading
+import time
+
+from errors import ProcessingError
+from profiling import Profiler
+
+# Seconds between two checks of the cancellation of a blocked stage
+POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+class Cancelled(Exception):
+    pass
+
+
+@dataclass
+class Stage:
+    """
+    A stage of the pipeline, either a `transform` of the whole stream, run by
+    a single thread since it may hold state across items (grouping,
+    deduplication) or manage its own pool (detection, captioning), or a
+    `function` applied to every item by `workers` threads.
+
+    Args:
+        name (str): Name of the stage, in logs and profiles.
+        transform (Optional[Callable[[Iterator], Iterator]]): Generator transform of the stream.
+        function (Optional[Callable[[Any], Any]]): Function applied to every item.
+        workers (int): Threads applying `function`.
+        ordered (bool): Yield the results of `function` in input order.
+    """
+
+    name: str
+    transform: Optional[Callable[[Iterator], Iterator]] = None
+    function: Optional[Callable[[Any], Any]] = None
+    workers: int = 1
+    ordered: bool = True
+
+    def __post_init__(self):
+        if (self.transform is None) == (self.function is None):
+            raise ProcessingError(f"Stage {self.name} needs either a transform or a function")
+        if self.workers < 1:
+            raise ProcessingError(f"Stage {self.name} needs at least one worker")
+
+
+def run_chain(
+    source: Iterable, stages: List[Stage], profiler: Optional[Profiler] = None
+) -> Iterator:
+    """
+    Chains the stages as generators: every item goes through all the stages
+    before the next one is read, in the consumer thread.
+    """
+    profiler = profiler or Profiler(enabled=False)
+    stream = source
+    for stage in stages:
+        if stage.transform is not None:
+            stream = stage.transform(stream)
+        else:
+            stream = map(stage.function, stream)
+        stream = profiler.iterate(stream, stage.name)
+    return stream
+
+
+@dataclass
+class StageCounters:
+    items: int = 0
+    # Time spent waiting for an input item, and for room in the output queue
+    starved: float = 0.0
+    blocked: float = 0.0
+
+    def __str__(self) -> str:
+        return f"{self.items} items, {self.starved:.2f}s waiting for input, {self.blocked:.2f}s blocked on output"
+
+
+class Scheduler:
+    """
+    Runs the stages concurrently: the source and every stage run on their own
+    threads, and consecutive stages are connected by queues of at most
+    `queue_size` items, so that a slow stage applies backpressure to the
+    previous ones instead of letting items pile up. With enough workers on
+    the stages, the run takes about as long as its slowest stage rather than
+    the sum of the stages.
+
+    Items leave every stage in input order, except from the stages with
+    `ordered=False`, which yield results as soon as they are ready.
+
+    The first exception raised by a stage cancels all the others: blocked
+    threads notice within POLL_INTERVAL, stream transforms are closed, and the
+    exception is raised to the consumer. A consumer that stops iterating
+    cancels the run as well.
+
+    Args:
+        queue_size (int): Capacity of every queue between two stages.
+        profiler (Optional[Profiler]): Profiler of the stages, on the thread of each stage.
+    """
+
+    def __init__(self, queue_size: int = 8, profiler: Optional[Profiler] = None):
+        if queue_size < 1:
+            raise ProcessingError(f"Queue size must be positive, got {queue_size}")
+        self.queue_size = queue_size
+        self.profiler = profiler or Profiler(enabled=False)
+        self.counters: Dict[str, StageCounters] = {}
+        self._cancelled = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def _fail(self, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._cancelled.set()
+
+    def _get(self, queue: Queue, counters: StageCounters) -> Any:
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return queue.get(timeout=POLL_INTERVAL)
+                except Empty:
+                    if self._cancelled.is_set():
+                        raise Cancelled()
+        finally:
+            counters.starved += time.perf_counter() - start
+
+    def _put(self, queue: Queue, item: Any, counters: StageCounters) -> None:
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    queue.put(item, timeout=POLL_INTERVAL)
+                    return
+                except Full:
+                    if self._cancelled.is_set():
+                        raise Cancelled()
+        finally:
+            counters.blocked += time.perf_counter() - start
+
+    def _drain(self, queue: Queue, counters: StageCounters) -> Iterator:
+        while True:
+            item = self._get(queue, counters)
+            if item is _END:
+                return
+            yield item
+
+    def _run_source(self, source: Iterable, output: Queue) -> None:
+        counters = self.counters.setdefault("source", StageCounters())
+        try:
+            for item in source:
+                counters.items += 1
+                self._put(output, item, counters)
+            self._put(output, _END, counters)
+        except Cancelled:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            close = getattr(source, "close", None)
+            if close is not None and self._cancelled.is_set():
+                close()
+
+    def _run_transform(self, stage: Stage, input: Queue, output: Queue) -> None:
+        counters = self.counters.setdefault(stage.name, StageCounters())
+        # Waiting on the input queue is not part of the stage time
+        inputs = self.profiler.iterate(self._drain(input, counters), "queue")
+        stream = self.profiler.iterate(stage.transform(inputs), stage.name)
+        try:
+            for item in stream:
+                counters.items += 1
+                self._put(output, item, counters)
+            self._put(output, _END, counters)
+        except Cancelled:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            # Lets the transform release its pools
+            close = getattr(stream, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except BaseException as e:
+                    self._fail(e)
+
+    def _start_map(self, stage: Stage, input: Queue, output: Queue) -> List[threading.Thread]:
+        counters = self.counters.setdefault(stage.name, StageCounters())
+        state = {"taken": 0, "emitted": 0, "running": stage.workers, "done": False}
+        results: Dict[int, Any] = {}
+        take_lock, emit_lock = threading.Lock(), threading.Lock()
+        # Bounds the results waiting for a slower item that precedes them
+        slots = threading.Semaphore(stage.workers + self.queue_size)
+
+        def emit(sequence: int, result: Any) -> None:
+            with emit_lock:
+                if not stage.ordered:
+                    self._put(output, result, counters)
+                    slots.release()
+                    return
+                results[sequence] = result
+                while state["emitted"] in results:
+                    self._put(output, results.pop(state["emitted"]), counters)
+                    state["emitted"] += 1
+                    slots.release()
+
+        def work() -> None:
+            try:
+                while True:
+                    while not slots.acquire(timeout=POLL_INTERVAL):
+                        if self._cancelled.is_set():
+                            raise Cancelled()
+                    with take_lock:
+                        item = _END if state["done"] else self._get(input, counters)
+                        if item is _END:
+                            state["done"] = True
+                            slots.release()
+                            break
+                        sequence = state["taken"]
+                        state["taken"] += 1
+                    with self.profiler.stage(stage.name, items=1):
+                        result = stage.function(item)
+                    counters.items += 1
+                    emit(sequence, result)
+            except Cancelled:
+                return
+            except BaseException as e:
+                self._fail(e)
+                return
+
+            # The last worker to finish ends the stream
+            with take_lock:
+                state["running"] -= 1
+                last = state["running"] == 0
+            if last:
+                try:
+                    self._put(output, _END, counters)
+                except Cancelled:
+                    pass
+
+        return [
+            threading.Thread(target=work, name=f"{stage.name}-{i}", daemon=True)
+            for i in range(stage.workers)
+        ]
+
+    def run(self, source: Iterable, stages: List[Stage]) -> Iterator:
+        """
+        Starts the stages and yields the items leaving the last one, in the
+        consumer thread.
+        """
+        queues = [Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+        for name in ["source"] + [stage.name for stage in stages] + ["consumer"]:
+            self.counters.setdefault(name, StageCounters())
+        threads = [threading.Thread(target=self._run_source, args=(source, queues[0]), name="source", daemon=True)]
+        for stage, input, output in zip(stages, queues, queues[1:]):
+            if stage.transform is not None:
+                threads.append(
+                    threading.Thread(
+                        target=self._run_transform, args=(stage, input, output), name=stage.name, daemon=True
+                    )
+                )
+            else:
+                threads.extend(self._start_map(stage, input, output))
+
+        counters = self.counters["consumer"]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                try:
+                    item = self._get(queues[-1], counters)
+                except Cancelled:
+                    break
+                if item is _END:
+                    break
+                counters.items += 1
+                yield item
+        finally:
+            self._cancelled.set()
+            for thread in threads:
+                thread.join()
+            for name, stage_counters in self.counters.items():
+                logging.debug(f"Stage {name}: {stage_counters}")
+
+        if self._error is not None:
+            raise self._error
+
+    def log_summary(self, logger: logging.Logger) -> None:
+        for name, counters in self.counters.items():
+            logger.info(f"Pipelined stage {name}: {counters}")
@@ -13,10 +13,16 @@ setup(
         "tqdm",
         "supervision",
         "openai",
+        "requests",
     ],
+    extras_require={
+        "onnx": ["onnxruntime"],
+        "dev": ["pytest", "pre-commit"],
+    },
     entry_points={
         "console_scripts": [
             "pipeline = pipeline:main",
+            "pipeline-batch = batch:main",
         ]
     },
 )
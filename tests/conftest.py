@@ -0,0 +1,52 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# The synthetic footage and the fakes of the remote services are shared with the benchmarks
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from fakes import FakeOpenAI, FakeWorkflowClient  # noqa: E402
+from synthetic import write_sequence, write_video  # noqa: E402
+
+PROMPTS = ROOT / "prompts_main_1982"
+
+
+@pytest.fixture
+def fake_services(monkeypatch):
+    # Replaces the Roboflow and OpenAI clients of the pipeline with the local fakes
+    import pipeline
+
+    monkeypatch.setattr(pipeline, "InferenceHTTPClient", lambda **kwargs: FakeWorkflowClient())
+    monkeypatch.setattr(pipeline, "PooledWorkflowClient", lambda **kwargs: FakeWorkflowClient())
+    monkeypatch.setattr(pipeline, "create_captioning_client", lambda: FakeOpenAI())
+
+
+@pytest.fixture
+def run_pipeline(fake_services):
+    # Runs the pipeline with the options of the command line and the fakes, raising the errors of the run
+    import pipeline
+
+    def run(input_path: Path, output_dir: Path, *options: str) -> Path:
+        args = ["--input", str(input_path), "--prompt", str(PROMPTS), "--output", str(output_dir), *options]
+        params = pipeline.main.make_context("pipeline", args).params
+        services = pipeline.create_services(params)
+        try:
+            pipeline.run_pipeline(services, **params)
+        finally:
+            services.close()
+        return output_dir
+
+    return run
+
+
+@pytest.fixture(scope="session")
+def sequence(tmp_path_factory):
+    # A short folder of synthetic frames
+    return write_sequence(tmp_path_factory.mktemp("sequence"), 12, size=(640, 360))[0].parent
+
+
+@pytest.fixture(scope="session")
+def video(tmp_path_factory):
+    return write_video(tmp_path_factory.mktemp("video") / "dive.avi", 12, size=(640, 360))
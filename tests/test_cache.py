@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ResultCache
+
+
+def stored(path):
+    with sqlite3.connect(str(path)) as db:
+        keys = {key.split(":", 1)[1] for (key,) in db.execute("SELECT key FROM entries")}
+        size = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        usage = db.execute("SELECT size FROM usage").fetchone()[0]
+    return keys, size, usage
+
+
+def payload():
+    # Random hex compresses to about 650 bytes, so four entries fit in 3000
+    return os.urandom(600).hex()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(tmp_path / "cache.sqlite", max_bytes=3000)
+    for index in range(4):
+        cache.put(f"key{index}", payload())
+        time.sleep(0.01)
+    # Touching the oldest entry makes key1 the least recently used
+    assert cache.get("key0") is not None
+    time.sleep(0.01)
+    for index in range(4, 7):
+        cache.put(f"key{index}", payload())
+        time.sleep(0.01)
+    cache.close()
+
+    keys, size, usage = stored(tmp_path / "cache.sqlite")
+    assert size <= 3000
+    assert usage == size
+    assert keys == {"key0", "key4", "key5", "key6"}
+    assert cache.stats.evictions == 3
+
+
+def test_replacing_an_entry_keeps_the_size(tmp_path):
+    cache = ResultCache(tmp_path / "cache.sqlite", max_bytes=10**6)
+    for _ in range(5):
+        cache.put("key", payload())
+    cache.close()
+
+    keys, size, usage = stored(tmp_path / "cache.sqlite")
+    assert keys == {"key"}
+    assert usage == size
+
+
+def test_writers_sharing_a_file_stay_under_the_limit(tmp_path):
+    caches = [ResultCache(tmp_path / "cache.sqlite", max_bytes=8000) for _ in range(4)]
+
+    def write(cache):
+        for index in range(30):
+            cache.put(f"{id(cache)}-{index}", payload())
+
+    with ThreadPoolExecutor(len(caches)) as pool:
+        list(pool.map(write, caches))
+    for cache in caches:
+        cache.close()
+
+    keys, size, usage = stored(tmp_path / "cache.sqlite")
+    assert 0 < size <= 8000
+    assert usage == size
+    assert sum(cache.stats.errors for cache in caches) == 0
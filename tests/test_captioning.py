@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+import pytest
+
+from captioning import CaptioningEngine
+from errors import ProcessingError
+
+
+def response(output_text, output):
+    return SimpleNamespace(id="resp_1", status="completed", output=output, output_text=output_text)
+
+
+def test_caption_follows_reasoning_items():
+    reasoning = SimpleNamespace(type="reasoning", content=None)
+    message = SimpleNamespace(type="message", content=[SimpleNamespace(type="output_text", text="An amphora.")])
+
+    assert CaptioningEngine.parse_caption(response("An amphora.", [reasoning, message])) == "An amphora."
+
+
+def test_empty_caption_raises():
+    with pytest.raises(ProcessingError):
+        CaptioningEngine.parse_caption(response("", [SimpleNamespace(type="reasoning", content=None)]))
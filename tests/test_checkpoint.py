@@ -0,0 +1,82 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import checkpoint
+import processing
+from errors import InputError
+from synthetic import write_sequence
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.fixture(scope="module")
+def scenes(tmp_path_factory):
+    # Two scenes, so that the run has several artifacts
+    return write_sequence(tmp_path_factory.mktemp("scenes"), 30, size=(480, 270))[0].parent
+
+
+def saved(output_dir):
+    artifacts = []
+    for path in sorted(output_dir.glob("artifact*.pickle")):
+        with open(path, "rb") as f:
+            artifacts.append(pickle.load(f))
+    return artifacts
+
+
+def assert_same_artifacts(expected, actual):
+    assert [artifact.name for artifact in actual] == [artifact.name for artifact in expected]
+    for a, b in zip(expected, actual):
+        assert [image.path for image in b.images] == [image.path for image in a.images]
+        assert b.best_image.path == a.best_image.path
+        np.testing.assert_array_equal(b.best_image.image, a.best_image.image)
+        assert b.caption == a.caption
+
+
+def crash_on_frame(monkeypatch, index):
+    write_png = checkpoint.RunCheckpoint._write_png
+
+    def crashing(self, name, array):
+        if name == f"{index:06d}.png":
+            raise Crash()
+        return write_png(self, name, array)
+
+    monkeypatch.setattr(checkpoint.RunCheckpoint, "_write_png", crashing)
+
+
+def crash_on_caption(monkeypatch, calls):
+    stream = processing.CaptioningEngine.caption_stream
+
+    def crashing(self, artifacts):
+        for count, artifact in enumerate(stream(self, artifacts)):
+            if count == calls:
+                raise Crash()
+            yield artifact
+
+    monkeypatch.setattr(processing.CaptioningEngine, "caption_stream", crashing)
+
+
+OPTIONS = ["--correction", "temporal", "--temporal-interval", "4", "--chunk-size", "4"]
+
+
+@pytest.mark.parametrize("crash", [crash_on_frame, crash_on_caption], ids=["preprocess", "caption"])
+def test_resume_matches_uninterrupted_run(run_pipeline, scenes, tmp_path, monkeypatch, crash):
+    expected = saved(run_pipeline(scenes, tmp_path / "full", *OPTIONS))
+
+    with monkeypatch.context() as patch:
+        crash(patch, 1 if crash is crash_on_caption else 13)
+        with pytest.raises(Crash):
+            run_pipeline(scenes, tmp_path / "resumed", *OPTIONS, "--checkpoint")
+    resumed = saved(run_pipeline(scenes, tmp_path / "resumed", *OPTIONS, "--resume"))
+
+    assert len(expected) > 1
+    assert_same_artifacts(expected, resumed)
+
+
+def test_resume_rejects_changed_options(run_pipeline, scenes, tmp_path):
+    run_pipeline(scenes, tmp_path / "out", *OPTIONS, "--checkpoint")
+    with pytest.raises(InputError, match="options changed"):
+        run_pipeline(scenes, tmp_path / "out", "--correction", "fused", "--resume")
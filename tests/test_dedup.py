@@ -0,0 +1,30 @@
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from dedup import FrameDeduplicator
+from image import Image
+
+
+def static_shot(count):
+    frame = np.random.default_rng(0).integers(0, 256, (90, 160, 3), dtype=np.uint8)
+    return [Image(image=frame.copy(), original=None, path=Path(f"frame_{t:05d}.jpg")) for t in range(count)]
+
+
+def test_collapse_bounds_held_duplicates():
+    deduplicator = FrameDeduplicator(mode="collapse", max_run=5)
+    frames = static_shot(40)
+
+    detected = list(deduplicator.filter(frames))
+
+    # A new representative every 6 frames of the static shot, each holding at most 5 duplicates
+    assert len(detected) == 7
+    assert max(Counter(deduplicator.mapping.values()).values()) == 5
+    assert [image.path for image in deduplicator.expand(detected)] == [image.path for image in frames]
+
+
+def test_drop_keeps_one_frame_per_shot():
+    deduplicator = FrameDeduplicator(mode="drop", max_run=5)
+    assert len(list(deduplicator.filter(static_shot(40)))) == 1
+    assert deduplicator.stats.skipped == 39
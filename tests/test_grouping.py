@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from grouping import ArtifactGrouper
+from image import Image
+
+ANCHOR = [100, 100, 200, 180]
+OTHER_ANCHOR = [400, 60, 520, 160]
+
+
+def frame(index, *detections):
+    rng = np.random.default_rng(index)
+    original = rng.integers(0, 256, (90, 160, 3), dtype=np.uint8)
+    noise = rng.integers(-3, 4, original.shape)
+    image = Image(
+        image=np.clip(original + noise, 0, 255).astype(np.uint8),
+        original=original,
+        path=Path(f"frame_{index:05d}.jpg"),
+    )
+    image.object_detection = {
+        "bboxes": [bbox for _, bbox in detections],
+        "labels": [label for label, _ in detections],
+    }
+    return image
+
+
+def shifted(bbox, dx):
+    return [bbox[0] + dx, bbox[1], bbox[2] + dx, bbox[3]]
+
+
+def hidden_anchor_sequence():
+    # An anchor drifts across frames 0-2, leaves the view for frames 3-5, and comes back near its last box
+    return (
+        [frame(t, ("anchor", shifted(ANCHOR, 5 * t))) for t in range(3)]
+        + [frame(t) for t in range(3, 6)]
+        + [frame(t, ("anchor", shifted(ANCHOR, 5 * t))) for t in range(6, 9)]
+    )
+
+
+def paths(artifact):
+    return [image.path.name for image in artifact.images]
+
+
+def test_track_survives_gap():
+    artifacts = ArtifactGrouper("track", iou_threshold=0.3, max_gap=4).group(hidden_anchor_sequence())
+
+    assert [artifact.name for artifact in artifacts] == ["anchor"]
+    assert artifacts[0].frame_count == 6
+    assert paths(artifacts[0]) == [f"frame_{t:05d}.jpg" for t in (0, 1, 2, 6, 7, 8)]
+
+
+def test_track_split_by_longer_gap():
+    artifacts = ArtifactGrouper("track", iou_threshold=0.3, max_gap=2).group(hidden_anchor_sequence())
+
+    assert [artifact.name for artifact in artifacts] == ["anchor", "anchor_2"]
+    assert [artifact.frame_count for artifact in artifacts] == [3, 3]
+
+
+@pytest.mark.parametrize("mode, names", [("track", ["anchor", "anchor_2"]), ("label", ["anchor"])])
+def test_same_label_objects(mode, names):
+    frames = [frame(t, ("anchor", shifted(ANCHOR, t)), ("anchor", shifted(OTHER_ANCHOR, -t))) for t in range(4)]
+    artifacts = ArtifactGrouper(mode, iou_threshold=0.3).group(frames)
+
+    assert [artifact.name for artifact in artifacts] == names
+    # Every frame holds both objects, so it belongs to both tracks
+    assert all(artifact.frame_count == 4 for artifact in artifacts)
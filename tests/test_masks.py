@@ -0,0 +1,55 @@
+import json
+import pickle
+
+import cv2
+import numpy as np
+
+from masks import MAX_MASK_SIDE, Mask, decode_masks, strip_polygons
+
+POLYGON = [(412.0, 150.5), (980.0, 210.0), (1105.5, 640.0), (700.0, 820.0), (380.0, 560.0)]
+
+
+def assert_same(mask, other):
+    assert other.box == mask.box
+    assert other.shape == mask.shape
+    assert np.array_equal(other.to_array(), mask.to_array())
+    assert (other.label, other.confidence) == (mask.label, mask.confidence)
+
+
+def test_dict_round_trip():
+    mask = Mask.from_polygon(POLYGON, label="fish", confidence=0.87)
+    assert max(mask.shape) == MAX_MASK_SIDE
+
+    # Through JSON, as stored in the checkpoints and archives
+    assert_same(mask, Mask.from_dict(json.loads(json.dumps(mask.to_dict()))))
+    assert_same(mask, pickle.loads(pickle.dumps(mask)))
+
+
+def test_rasterize_matches_polygon():
+    size = (1280, 960)
+    expected = np.zeros(size[::-1], dtype=np.uint8)
+    cv2.fillPoly(expected, [np.round(POLYGON).astype(np.int32)], 1)
+    mask = Mask.from_dict(Mask.from_polygon(POLYGON).to_dict())
+
+    inside = mask.rasterize((0, 0) + size, size)
+
+    # The 128 cell grid only blurs the edges of the polygon
+    assert inside.shape == expected.shape
+    assert np.mean(inside != expected.astype(bool)) < 0.005
+    assert abs(mask.area - expected.sum()) / expected.sum() < 0.02
+
+
+def test_decode_masks_skips_predictions_without_points():
+    segmentation = {
+        "predictions": [
+            {"class": "fish", "confidence": 0.9, "points": [{"x": x, "y": y} for x, y in POLYGON]},
+            {"class": "fish", "confidence": 0.4, "points": []},
+            {"class": "fish", "confidence": 0.3},
+        ]
+    }
+
+    masks = decode_masks(segmentation)
+
+    assert len(masks) == 1
+    assert masks[0].label == "fish"
+    assert all("points" not in prediction for prediction in strip_polygons(segmentation)["predictions"])
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from preprocessing2 import (
+    FUSED_MAX_ABS_ERROR,
+    FUSED_MEAN_ABS_ERROR,
+    fused_underwater_correction,
+    simple_underwater_correction,
+)
+
+# Frames of at least 480 pixels: on smaller frames the 8 x 8 CLAHE tiles amplify rounding beyond the tolerance
+SIZE = (480, 640)
+
+
+def water_frame(seed, size=SIZE):
+    # Blue-green gradient with sensor noise and a rust-colored object, as in benchmarks/synthetic.py
+    rng = np.random.default_rng(seed)
+    h, w = size
+    depth = np.linspace(0, 1, h, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    frame = (1 - depth) * np.float32([120, 110, 40]) + depth * np.float32([60, 70, 15])
+    frame = np.broadcast_to(frame, (h, w, 3)) + rng.normal(0, 6, (h, w, 3))
+    x, y = rng.integers(0, w // 2), rng.integers(0, h // 2)
+    frame[y : y + h // 3, x : x + w // 4] = rng.integers(40, 200, 3)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def saturated_frame(seed, size=SIZE):
+    # Blocks of fully saturated colors, which the +10 shift of the a/b channels pushes out of the BGR gamut
+    rng = np.random.default_rng(seed)
+    h, w = size
+    colors = np.uint8(
+        [[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 0], [255, 0, 255], [0, 255, 255], [0, 0, 0], [255, 255, 255]]
+    )
+    blocks = colors[rng.integers(0, len(colors), (h // 16, w // 16))]
+    return np.ascontiguousarray(np.repeat(np.repeat(blocks, 16, axis=0), 16, axis=1))
+
+
+def assert_within_tolerance(frame):
+    error = np.abs(
+        fused_underwater_correction(frame).astype(np.int16) - simple_underwater_correction(frame).astype(np.int16)
+    )
+    assert error.max() <= FUSED_MAX_ABS_ERROR
+    assert error.mean() <= FUSED_MEAN_ABS_ERROR
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_fused_correction_within_tolerance(seed):
+    assert_within_tolerance(water_frame(seed))
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_fused_correction_out_of_gamut(seed):
+    assert_within_tolerance(saturated_frame(seed))
+
+
+def test_fused_correction_reallocates_workspace():
+    first, second = water_frame(3), water_frame(4, size=(720, 540))
+    expected = fused_underwater_correction(first)
+
+    # A new frame shape reallocates the buffers of the workspace, and the previous shape again
+    assert_within_tolerance(second)
+    assert fused_underwater_correction(second).shape == second.shape
+    np.testing.assert_array_equal(fused_underwater_correction(first), expected)
+
+
+def test_fused_correction_keeps_input():
+    frame = water_frame(5)
+    original = frame.copy()
+    fused_underwater_correction(frame)
+    np.testing.assert_array_equal(frame, original)
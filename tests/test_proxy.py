@@ -0,0 +1,69 @@
+import pickle
+
+import cv2
+import numpy as np
+import pytest
+
+from preprocessing import CORRECTIONS
+from preprocessing2 import apply_temporal_correction
+from proxy import make_proxies
+from video import VideoSource
+
+
+def saved_artifacts(output_dir):
+    artifacts = []
+    for path in sorted(output_dir.glob("artifact*.pickle")):
+        with open(path, "rb") as f:
+            artifacts.append(pickle.load(f))
+    return artifacts
+
+
+@pytest.mark.parametrize("mode", [[], ["--streaming"]])
+def test_reduced_decode_saves_full_resolution(run_pipeline, sequence, tmp_path, mode):
+    output_dir = run_pipeline(sequence, tmp_path / "out", "--decode-reduction", "2", *mode)
+
+    artifacts = saved_artifacts(output_dir)
+    assert artifacts
+    height, width = cv2.imread(str(next(sequence.glob("*.jpg")))).shape[:2]
+    for artifact in artifacts:
+        assert artifact.best_image.scale == 1.0
+        assert artifact.best_image.image.shape == (height, width, 3)
+
+
+def test_video_proxies_drop_full_resolution(video):
+    frames = list(make_proxies(VideoSource(video), 320))
+    assert all(frame.full_resolution is None and frame.image.shape[1] == 320 for frame in frames)
+
+    # Promoted frames are decoded again at their position
+    capture = cv2.VideoCapture(str(video))
+    expected = [capture.read()[1] for _ in range(len(frames))]
+    capture.release()
+    for frame in frames[::5]:
+        np.testing.assert_array_equal(frame.video_frame.read(), expected[frame.video_frame.position])
+
+
+def test_video_proxy_saves_full_resolution(run_pipeline, video, tmp_path):
+    output_dir = run_pipeline(video, tmp_path / "out", "--is-video", "true", "--proxy-size", "320")
+
+    artifacts = saved_artifacts(output_dir)
+    assert artifacts
+    for artifact in artifacts:
+        image = artifact.best_image
+        assert image.scale == 1.0 and image.image.shape == (360, 640, 3)
+        np.testing.assert_array_equal(image.image, CORRECTIONS["fused"](image.original))
+
+
+@pytest.mark.parametrize("mode", [[], ["--streaming"]])
+def test_temporal_promotion_keeps_estimated_parameters(run_pipeline, video, tmp_path, mode):
+    output_dir = run_pipeline(
+        video, tmp_path / "out", "--is-video", "true", "--proxy-size", "320", "--correction", "temporal", *mode
+    )
+
+    artifacts = saved_artifacts(output_dir)
+    assert artifacts
+    for artifact in artifacts:
+        image = artifact.best_image
+        assert image.scale == 1.0 and image.correction_parameters is not None
+        # The white balance of the sequence, not the frame's own
+        expected = apply_temporal_correction(image.original, image.correction_parameters)
+        np.testing.assert_array_equal(image.image, expected)
@@ -0,0 +1,27 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from artifact import Artifact
+from image import Image
+from reconstruction import MANIFEST_FILE, prepare_reconstruction
+
+
+def artifact(name, seed):
+    rng = np.random.default_rng(seed)
+    frames = [rng.integers(0, 256, (90, 160, 3), dtype=np.uint8) for _ in range(4)]
+    images = [Image(image=frame, original=frame, path=Path(f"{name}_{t}.jpg")) for t, frame in enumerate(frames)]
+    return Artifact(images=images, name=name)
+
+
+def test_sanitized_names_get_their_own_datasets(tmp_path):
+    names = set()
+    artifacts = [artifact("amphora/1", 0), artifact("amphora 1", 1), artifact("amphora_1", 2)]
+
+    directories = [prepare_reconstruction(item, tmp_path, names=names) for item in artifacts]
+
+    assert [directory.name for directory in directories] == ["amphora_1", "amphora_1_1", "amphora_1_2"]
+    for item, directory in zip(artifacts, directories):
+        with open(directory / MANIFEST_FILE) as f:
+            assert json.load(f)["artifact"] == item.name
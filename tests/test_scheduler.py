@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import Scheduler, Stage, run_chain
+
+
+def jittered(item):
+    # Later items finish first, so that the workers complete out of order
+    time.sleep(0.001 * (7 - item % 8))
+    return item * 2
+
+
+def running(item):
+    return item + 1
+
+
+def test_scheduler_preserves_order():
+    stages = [
+        Stage("double", function=jittered, workers=4),
+        Stage("increment", transform=lambda items: map(running, items)),
+    ]
+    results = list(Scheduler(queue_size=2).run(range(64), stages))
+    assert results == list(run_chain(range(64), stages))
+    assert results == [item * 2 + 1 for item in range(64)]
+
+
+def test_scheduler_unordered_stage_yields_every_item():
+    stages = [Stage("double", function=jittered, workers=4, ordered=False)]
+    assert sorted(Scheduler(queue_size=2).run(range(64), stages)) == [item * 2 for item in range(64)]
+
+
+def test_scheduler_propagates_stage_exception():
+    def fail(item):
+        if item == 10:
+            raise ValueError("stage failed")
+        return item
+
+    closed = threading.Event()
+
+    def source():
+        try:
+            yield from range(10_000)
+        finally:
+            closed.set()
+
+    scheduler = Scheduler(queue_size=2)
+    with pytest.raises(ValueError, match="stage failed"):
+        for _ in scheduler.run(source(), [Stage("fail", function=fail, workers=3), Stage("pass", function=running)]):
+            pass
+    # The other stages are cancelled, and the source closed, long before it is exhausted
+    assert closed.is_set()
+    assert scheduler.counters["source"].items < 10_000
+
+
+def test_scheduler_consumer_stop_cancels_stages():
+    scheduler = Scheduler(queue_size=2)
+    results = scheduler.run(iter(range(10_000)), [Stage("double", function=jittered, workers=2)])
+    assert [next(results) for _ in range(3)] == [0, 2, 4]
+    results.close()
+    assert scheduler.counters["source"].items < 10_000
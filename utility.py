@@ -1,14 +1,21 @@
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Iterator, Iterable, Optional, TypeVar, Union
+from itertools import islice
 from pathlib import Path
-from tqdm import tqdm
 import cv2
 import logging
 import os
 import tqdm
 
 from errors import InputError, ProcessingError
-from image import Image, check_image_integrity
+from image import Image
 from artifact import Artifact
+from archive import write_archive
+from encoding import crop_to_roi
+from loader import FrameLoader, list_image_paths
+from video import VideoSource
+
+T = TypeVar("T")
 
 
 def load_prompts(prompt_folder: Path) -> Dict[str, str]:
@@ -47,60 +54,101 @@ def load_prompts(prompt_folder: Path) -> Dict[str, str]:
         raise InputError(f"Error loading prompt files: {str(e)}")
 
 
-def get_image_paths(input_path: Path) -> List[Path]:
-    image_extensions = {".jpg", ".jpeg", ".png", ".bmp", ".tiff"}
-    image_paths = [
-        p
-        for p in input_path.iterdir()
-        if p.is_file()
-        and p.suffix.lower() in image_extensions
-        and check_image_integrity(p)
-    ]
+def get_image_paths(input_path: Path, validation: str = "header") -> List[Path]:
+    # Sorted by name to maintain sequence
+    return list_image_paths(input_path, validation)
 
-    if not image_paths:
-        raise InputError(f"No images found in {input_path}")
 
-    # Sort images by name to maintain sequence
-    image_paths.sort()
+def iter_frames(
+    input_folder: Path,
+    workers: Optional[int] = None,
+    validation: str = "header",
+    reduction: Union[int, str] = 1,
+    max_dimension: Optional[int] = None,
+) -> Iterator[Image]:
+    """
+    Lazily loads the frames of a folder, in sorted order.
 
-    return image_paths
+    Only the list of paths is built upfront, and frames are decoded on a few
+    threads at most a few frames ahead, so the memory footprint does not
+    depend on the number of frames in the folder. See loader.FrameLoader.
+    """
+    return iter(FrameLoader(input_folder, workers, validation, reduction, max_dimension))
 
 
 def load_frames(input_folder: Path) -> List[Image]:
-    image_paths = get_image_paths(input_folder)
+    return list(iter_frames(input_folder))
+
 
-    images = []
-    for path in image_paths:
-        try:
-            img = Image(
-                path=path, image=cv2.imread(str(path)), original=cv2.imread(str(path))
-            )
-            if img.image is not None:
-                images.append(img)
-        except Exception as e:
-            logging.error(f"Error loading image {path}: {str(e)}")
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Splits an iterable into lists of at most `size` elements, without
+    materializing the whole iterable.
+    """
+    if size < 1:
+        raise InputError(f"Chunk size must be positive, got {size}")
 
-    if not images:
-        raise InputError(f"No valid images found in {input_folder}")
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
-    return images
+
+def save_artifact(
+    artifact: Artifact,
+    output_dir: Path,
+    index: int,
+    output_format: str = "pickle",
+    pixel_format: str = "png",
+    crop_margin: Optional[float] = None,
+) -> None:
+    """
+    Saves a single artifact: the best image goes in the artifact folder, the
+    pickled object or its archive (see archive.py) in the output folder.
+    With a `crop_margin`, the best image is cropped around its object (see
+    Image.roi), enlarged by this fraction of its size.
+    """
+    artifact_dir = output_dir / artifact.name
+    artifact_dir.mkdir(exist_ok=True, parents=True)
+
+    best = artifact.best_image
+    if best is not None:
+        image, roi = best.image, best.roi() if crop_margin is not None else None
+        if roi is not None:
+            image, _ = crop_to_roi(image, roi, crop_margin)
+        cv2.imwrite(str(artifact_dir / f"{best.path.stem}_processed.jpg"), image)
+
+    if output_format == "archive":
+        write_archive(artifact, output_dir / f"artifact{index}", pixel_format)
+    else:
+        artifact.to_pickle(saving_path=output_dir / f"artifact{index}.pickle")
 
 
 def save_results(
     artifacts: List[Artifact],
     output_dir: Path,
+    output_format: str = "pickle",
+    pixel_format: str = "png",
+    workers: Optional[int] = None,
+    crop_margin: Optional[float] = None,
 ) -> None:
     try:
         output_dir.mkdir(exist_ok=True, parents=True)
 
-        for artifact in tqdm.tqdm(artifacts):
-            artifact_dir = output_dir / artifact.name
-            artifact_dir.mkdir(exist_ok=True)
-
         logging.info(f"Saving artifacts to {output_dir}")
 
-        for i, artifact in tqdm(enumerate(artifacts)):
-            artifact.to_pickle(saving_path=output_dir / f"artifact{i}.pickle")
+        # Encoding and writing release the GIL, so artifacts are saved on a thread pool
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    save_artifact, artifact, output_dir, i, output_format, pixel_format, crop_margin
+                )
+                for i, artifact in enumerate(artifacts)
+            ]
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                future.result()
 
         logging.info(f"Results saved to {output_dir}")
     except Exception as e:
@@ -108,35 +156,18 @@ def save_results(
 
 
 def extract_frames_from_video(
-    video_path: Path, output_folder: Path, sample_rate: int
+    video_path: Path, output_folder: Path, sample_rate: int, dump_format: str = "png"
 ) -> None:
     try:
-        # Ensure output folder exists
-        output_folder.mkdir(parents=True, exist_ok=True)
-
-        # Open video file
-        cap = cv2.VideoCapture(str(video_path))
-        if not cap.isOpened():
-            raise InputError(f"Cannot open video file: {video_path}")
-
-        frame_count = 0
-        saved_count = 0
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break  # End of video
-
-            # Save every nth frame
-            if frame_count % sample_rate == 0:
-                frame_name = f"frame_{saved_count:03d}.png"
-                frame_path = output_folder / frame_name
-                cv2.imwrite(str(frame_path), frame)
-                saved_count += 1
-
-            frame_count += 1
+        # The frames are written by the source as they are decoded
+        source = VideoSource(
+            video_path,
+            sample_rate=sample_rate,
+            dump_dir=output_folder,
+            dump_format=dump_format,
+        )
+        saved_count = sum(1 for _ in source)
 
-        cap.release()
         logging.info(f"Extracted {saved_count} frames from {video_path}")
 
     except InputError as e:
@@ -0,0 +1,388 @@
+"""
+    VideoSource decodes a video file in memory and yields the sampled frames as Image objects, without the PNG round-trip.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from queue import Queue, Full
+from threading import Thread, Event
+from typing import Iterator, Optional
+import logging
+import re
+
+import cv2
+import numpy as np
+
+from errors import InputError, ProcessingError
+from image import Image
+
+DUMP_FORMATS = ("png", "jpg")
+MOTION_METRICS = ("diff", "flow")
+
+_END = object()
+
+
+@dataclass
+class FrameScore:
+    motion: float
+    sharpness: float
+    exposure: float
+
+    @property
+    def quality(self) -> float:
+        return self.sharpness * self.exposure
+
+
+class AdaptiveKeyframeSampler:
+    """
+    Streaming keyframe selection under a frame budget.
+
+    Frames are scored on a grayscale thumbnail: motion with respect to the
+    previous frame (mean absolute difference, or mean Farneback optical flow
+    magnitude), sharpness (variance of the Laplacian) and exposure (distance
+    of the mean from mid-gray and fraction of clipped pixels). The video is cut
+    into segments, each closed when its accumulated motion reaches the running
+    mean motion times the target interval, so that segments are short when the
+    camera sweeps and long when it hovers. The interval is recomputed from the
+    remaining frames and budget at every segment. Each segment yields its
+    sharpest, best exposed frame: only that frame and the previous thumbnail
+    are held in memory.
+
+    Args:
+        budget (int): Target number of keyframes.
+        total_frames (int): Number of frames that will be pushed.
+        motion_metric (str): One of MOTION_METRICS.
+        thumbnail_width (int): Width of the thumbnail the signals are computed on.
+        max_gap_factor (float): Longest segment, in target intervals, so that static scenes are still
+            covered. Segments are also at least the interval divided by this factor long.
+    """
+
+    def __init__(
+        self,
+        budget: int,
+        total_frames: int,
+        motion_metric: str = "diff",
+        thumbnail_width: int = 160,
+        max_gap_factor: float = 4.0,
+    ):
+        if budget < 1:
+            raise InputError(f"Keyframe budget must be positive, got {budget}")
+        if motion_metric not in MOTION_METRICS:
+            raise InputError(f"Unknown motion metric: {motion_metric}")
+
+        self.budget = budget
+        self.total_frames = max(total_frames, 1)
+        self.motion_metric = motion_metric
+        self.thumbnail_width = thumbnail_width
+        self.max_gap_factor = max_gap_factor
+
+        self.seen = 0
+        self.emitted = 0
+        self._total_motion = 0.0
+        self._previous: Optional[np.ndarray] = None
+        self._segment_start = 0
+        self._segment_motion = 0.0
+        self._best: Optional[tuple] = None
+        self._best_quality = -1.0
+
+    def _thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        h, w = frame.shape[:2]
+        size = (self.thumbnail_width, max(1, round(h * self.thumbnail_width / w)))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+    def _motion(self, thumbnail: np.ndarray) -> float:
+        if self._previous is None:
+            return 0.0
+        if self.motion_metric == "flow":
+            flow = cv2.calcOpticalFlowFarneback(
+                self._previous, thumbnail, None, 0.5, 2, 9, 2, 5, 1.1, 0
+            )
+            return float(np.sqrt((flow**2).sum(axis=2)).mean())
+        return float(cv2.absdiff(self._previous, thumbnail).mean())
+
+    def score(self, frame: np.ndarray) -> FrameScore:
+        thumbnail = self._thumbnail(frame)
+        motion = self._motion(thumbnail)
+        self._previous = thumbnail
+
+        sharpness = float(cv2.Laplacian(thumbnail, cv2.CV_32F).var())
+        clipped = np.count_nonzero((thumbnail < 8) | (thumbnail > 247)) / thumbnail.size
+        exposure = (1.0 - clipped) * (1.0 - abs(float(thumbnail.mean()) - 127.5) / 127.5)
+        return FrameScore(motion, sharpness, exposure)
+
+    def _interval(self) -> float:
+        remaining_frames = self.total_frames - self._segment_start
+        remaining_budget = max(1, self.budget - self.emitted)
+        return max(1.0, remaining_frames / remaining_budget)
+
+    def push(self, position: int, frame: np.ndarray) -> Optional[tuple]:
+        """
+        Scores a frame and returns the (position, frame) keyframe of the
+        segment it closes, if any.
+        """
+        score = self.score(frame)
+        self.seen += 1
+        self._total_motion += score.motion
+        self._segment_motion += score.motion
+
+        keyframe = None
+        length = self.seen - self._segment_start
+        interval = self._interval()
+        threshold = self._total_motion / self.seen * interval
+        # The frame that crosses the threshold starts the next segment. Once the
+        # budget is spent, the last segment runs to the end of the video.
+        if (
+            self.emitted < self.budget - 1
+            and length > max(1.0, interval / self.max_gap_factor)
+            and (
+                (threshold > 0 and self._segment_motion >= threshold)
+                or length > interval * self.max_gap_factor
+            )
+        ):
+            keyframe = self._close(self.seen - 1)
+            self._segment_motion = score.motion
+
+        if score.quality > self._best_quality:
+            self._best, self._best_quality = (position, frame), score.quality
+        return keyframe
+
+    def _close(self, next_start: int) -> Optional[tuple]:
+        keyframe = self._best
+        if keyframe is not None:
+            self.emitted += 1
+        self._best, self._best_quality = None, -1.0
+        self._segment_start = next_start
+        self._segment_motion = 0.0
+        return keyframe
+
+    def flush(self) -> Optional[tuple]:
+        return self._close(self.seen)
+
+
+@dataclass(frozen=True)
+class VideoFrame:
+    """
+    A frame of a video file, decoded again on demand, so that frames without
+    a file of their own need not keep their full-resolution pixels.
+    """
+
+    video_path: Path
+    position: int
+
+    def read(self) -> np.ndarray:
+        cap = cv2.VideoCapture(str(self.video_path))
+        try:
+            if not cap.isOpened():
+                raise ProcessingError(f"Cannot open video file: {self.video_path}")
+            if not cap.set(cv2.CAP_PROP_POS_FRAMES, self.position):
+                for _ in range(self.position):
+                    cap.grab()
+            ret, frame = cap.read()
+        finally:
+            cap.release()
+        if not ret:
+            raise ProcessingError(f"Cannot decode frame {self.position} of {self.video_path}")
+        return frame
+
+
+class VideoSource:
+    """
+    Iterable over the sampled frames of a video.
+
+    Only every `sample_rate`-th frame is decoded to a BGR array: the frames in
+    between are skipped with `grab()`, which demuxes and decodes without the
+    color conversion and the copy to a numpy array, or with a seek when the
+    gap between two kept frames is at least `seek_threshold` frames.
+
+    Args:
+        video_path (Path): Path of the video file.
+        sample_rate (int): Keep every nth frame.
+        dump_dir (Optional[Path]): If given, the kept frames are also written to this folder.
+        dump_format (str): Format of the dumped frames, one of DUMP_FORMATS.
+        threaded (bool): Decode on a background thread, up to `queue_size` frames ahead.
+        queue_size (int): Maximum number of decoded frames waiting to be consumed.
+        seek_threshold (Optional[int]): Minimum gap for seeking instead of grabbing, None to never seek.
+        keyframe_budget (Optional[int]): If given, the sampled frames are candidates of an
+            AdaptiveKeyframeSampler and only about this many keyframes are kept.
+        motion_metric (str): Motion signal of the keyframe sampler, one of MOTION_METRICS.
+    """
+
+    def __init__(
+        self,
+        video_path: Path,
+        sample_rate: int = 1,
+        dump_dir: Optional[Path] = None,
+        dump_format: str = "png",
+        threaded: bool = False,
+        queue_size: int = 8,
+        seek_threshold: Optional[int] = None,
+        keyframe_budget: Optional[int] = None,
+        motion_metric: str = "diff",
+    ):
+        if sample_rate < 1:
+            raise InputError(f"Sample rate must be positive, got {sample_rate}")
+        if dump_format not in DUMP_FORMATS:
+            raise InputError(f"Unsupported frame dump format: {dump_format}")
+
+        self.video_path = Path(video_path)
+        self.sample_rate = sample_rate
+        self.dump_dir = Path(dump_dir) if dump_dir is not None else None
+        self.dump_format = dump_format
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.seek_threshold = seek_threshold
+        self.keyframe_budget = keyframe_budget
+        self.motion_metric = motion_metric
+        # Position of the first frame, see resume_after
+        self.start = 0
+
+    def resume_after(self, path: Path) -> None:
+        """
+        Starts the next iterations after the frame of `path`, a frame path of
+        this source, seeking past the frames before it. With a keyframe budget,
+        the earlier frames are still decoded, since they drive the sampler.
+        """
+        match = re.search(r"frame_(\d+)\.\w+$", Path(path).name)
+        if match is None:
+            raise InputError(f"Cannot resume {self.video_path} after {path}: not a frame of the video")
+        self.start = int(match.group(1)) + self.sample_rate
+
+    def __iter__(self) -> Iterator[Image]:
+        if self.threaded:
+            return self._iter_threaded()
+        return self._iter_frames()
+
+    def _open(self) -> cv2.VideoCapture:
+        cap = cv2.VideoCapture(str(self.video_path))
+        if not cap.isOpened():
+            raise InputError(f"Cannot open video file: {self.video_path}")
+        return cap
+
+    def _frame_path(self, index: int) -> Path:
+        name = f"frame_{index:06d}.{self.dump_format}"
+        if self.dump_dir is not None:
+            return self.dump_dir / name
+        # Virtual path: identifies the frame in the outputs, nothing is written there.
+        return self.video_path.parent / f"{self.video_path.stem}_{name}"
+
+    def _skip(self, cap: cv2.VideoCapture, position: int, count: int) -> bool:
+        if self.seek_threshold is not None and count >= self.seek_threshold:
+            if cap.set(cv2.CAP_PROP_POS_FRAMES, position + count):
+                return True
+        for _ in range(count):
+            if not cap.grab():
+                return False
+        return True
+
+    def _decode(self) -> Iterator[tuple]:
+        cap = self._open()
+        if self.dump_dir is not None:
+            self.dump_dir.mkdir(parents=True, exist_ok=True)
+
+        position = 0
+        try:
+            if self.start and not self.keyframe_budget:
+                # Grabbing is the fallback of containers that cannot seek
+                position = self.start
+                if not cap.set(cv2.CAP_PROP_POS_FRAMES, position):
+                    for _ in range(position):
+                        if not cap.grab():
+                            return
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break  # End of video
+
+                yield position, frame
+
+                if not self._skip(cap, position + 1, self.sample_rate - 1):
+                    break
+                position += self.sample_rate
+        finally:
+            cap.release()
+
+    def _keyframes(self) -> Iterator[tuple]:
+        cap = self._open()
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        if frame_count <= 0:
+            raise InputError(
+                f"Cannot determine the frame count of {self.video_path}, needed for a keyframe budget"
+            )
+
+        sampler = AdaptiveKeyframeSampler(
+            self.keyframe_budget,
+            -(-frame_count // self.sample_rate),
+            motion_metric=self.motion_metric,
+        )
+        for position, frame in self._decode():
+            keyframe = sampler.push(position, frame)
+            if keyframe is not None and keyframe[0] >= self.start:
+                yield keyframe
+        keyframe = sampler.flush()
+        if keyframe is not None and keyframe[0] >= self.start:
+            yield keyframe
+
+        logging.info(
+            f"Selected {sampler.emitted} keyframes out of {sampler.seen} candidates "
+            f"(budget {self.keyframe_budget})"
+        )
+
+    def _to_image(self, position: int, frame: np.ndarray) -> Image:
+        path = self._frame_path(position)
+        if self.dump_dir is not None:
+            cv2.imwrite(str(path), frame)
+        # Preprocessing replaces `image` and leaves `original` untouched, so they can share the frame.
+        # Frames that are not dumped can still be decoded again from the video.
+        video_frame = VideoFrame(self.video_path, position) if self.dump_dir is None else None
+        return Image(image=frame, original=frame, path=path, video_frame=video_frame)
+
+    def _iter_frames(self) -> Iterator[Image]:
+        decoded = 0
+        frames = self._keyframes() if self.keyframe_budget else self._decode()
+        for position, frame in frames:
+            decoded += 1
+            yield self._to_image(position, frame)
+
+        logging.info(f"Decoded {decoded} frames from {self.video_path}")
+
+    def _iter_threaded(self) -> Iterator[Image]:
+        frames: Queue = Queue(maxsize=self.queue_size)
+        stop = Event()
+
+        def offer(item) -> bool:
+            # Blocks until the item is queued or the consumer has gone away
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def producer() -> None:
+            try:
+                for item in self._iter_frames():
+                    if not offer(item):
+                        return
+                offer(_END)
+            except BaseException as e:
+                offer(e)
+
+        thread = Thread(target=producer, name="video-decoder", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = frames.get()
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    if isinstance(item, InputError):
+                        raise item
+                    raise ProcessingError(f"Error decoding video: {str(item)}")
+                yield item
+        finally:
+            # The producer notices within one put timeout and exits
+            stop.set()
+            thread.join()
@@ -0,0 +1,100 @@
+"""
+    PooledWorkflowClient runs Roboflow workflows over a pooled HTTP session, so that concurrent requests reuse their connections.
+"""
+
+from typing import Any, Dict, List, Optional
+import base64
+
+import cv2
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from errors import RoboflowError
+
+
+class WorkflowHTTPError(RoboflowError):
+    """Exception raised when the inference server answers with an error status."""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def encode_workflow_image(image: Any) -> Dict[str, str]:
+    # Same wire format as the inference SDK: numpy frames travel as base64 JPEG
+    if isinstance(image, np.ndarray):
+        ok, buffer = cv2.imencode(".jpg", image)
+        if not ok:
+            raise RoboflowError("Cannot encode frame for the workflow request")
+        return {"type": "base64", "value": base64.b64encode(buffer).decode("utf-8")}
+    if isinstance(image, bytes):
+        return {"type": "base64", "value": base64.b64encode(image).decode("utf-8")}
+    if isinstance(image, str):
+        return {"type": "base64", "value": image}
+    raise RoboflowError(f"Unsupported workflow image type: {type(image)}")
+
+
+class PooledWorkflowClient:
+    """
+    Minimal drop-in for InferenceHTTPClient.run_workflow.
+
+    Args:
+        api_url (str): Base URL of the inference server.
+        api_key (str): Roboflow API key.
+        pool_size (int): Maximum number of kept-alive connections.
+        timeout (float): Timeout of a single request, in seconds.
+    """
+
+    def __init__(
+        self, api_url: str, api_key: str = "", pool_size: int = 8, timeout: float = 120.0
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def run_workflow(
+        self,
+        workspace_name: str,
+        workflow_id: str,
+        images: Optional[Dict[str, Any]] = None,
+        parameters: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        inputs: Dict[str, Any] = {}
+        for name, value in (images or {}).items():
+            if isinstance(value, list):
+                inputs[name] = [encode_workflow_image(image) for image in value]
+            else:
+                inputs[name] = encode_workflow_image(value)
+        inputs.update(parameters or {})
+
+        payload = {"inputs": inputs}
+        if self.api_key:
+            payload["api_key"] = self.api_key
+
+        try:
+            response = self.session.post(
+                f"{self.api_url}/{workspace_name}/workflows/{workflow_id}",
+                json=payload,
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            raise RoboflowError(f"Workflow request failed: {str(e)}")
+
+        if response.status_code >= 400:
+            raise WorkflowHTTPError(
+                f"Workflow request failed with status {response.status_code}: {response.text[:200]}",
+                status_code=response.status_code,
+            )
+
+        try:
+            return response.json()["outputs"]
+        except (ValueError, KeyError) as e:
+            raise RoboflowError(f"Malformed workflow response: {str(e)}")